@@ -0,0 +1,54 @@
+from dataclasses import dataclass, fields
+
+# Settings for the sample analysis in wavetable.py, which the build needs for parsing
+# options and keying caches before (and whether or not) any samples are analysed
+FRAME_RATE = 60  # frames per second played back by the cart
+# bump whenever a change to the analysis alters its output, to invalidate cached results
+ANALYSIS_VERSION = 3
+# shortest period, in samples, that a wave can be taken from
+MIN_PERIOD = 4
+
+
+@dataclass(frozen=True)
+class AnalysisParams:
+    start_offset: int = 10  # smallest lag considered when searching for the period
+    confidence_threshold: float = 1.3  # below this, a block is treated as unpitched noise
+    fallback_freq: float = 220  # frequency to play noise blocks at
+    noise_amplitude: float = 11  # amplitude scale for noise blocks (tonal ones use 16)
+    # frames per second; the hop size is samplerate // frame_rate. The cart plays
+    # FRAME_RATE frames per second, so other values are only useful for experiments
+    frame_rate: int = FRAME_RATE
+
+    def __post_init__(self):
+        # reject values the analysis can't work with: periods too short to fit a spline
+        # through (see wavetable.resample_matrix), or noise amplitudes that don't fit the
+        # 4-bit volume of a frame
+        if self.start_offset < MIN_PERIOD:
+            raise ValueError("start_offset must be at least %d, not %r" % (MIN_PERIOD, self.start_offset))
+        if not 0 <= self.noise_amplitude <= 15:
+            raise ValueError("noise_amplitude must be between 0 and 15, not %r" % self.noise_amplitude)
+        for name in ('confidence_threshold', 'fallback_freq', 'frame_rate'):
+            if not getattr(self, name) > 0:
+                raise ValueError("%s must be greater than 0, not %r" % (name, getattr(self, name)))
+
+    @staticmethod
+    def parse(assignments):
+        # build from a list of "name=value" strings
+        names = {field.name: field.type for field in fields(AnalysisParams)}
+        values = {}
+        for assignment in assignments:
+            name, _, value = assignment.partition('=')
+            name = name.strip().replace('-', '_')
+            if name not in names:
+                raise ValueError("Unknown analysis parameter: %r" % name)
+            values[name] = names[name](value)
+        return AnalysisParams(**values)
+
+
+DEFAULT_PARAMS = AnalysisParams()
+
+
+def analysis_key(backend='amdf', params=DEFAULT_PARAMS):
+    return "v%d:%s:%s" % (ANALYSIS_VERSION, backend, ":".join(
+        "%s=%r" % (field.name, getattr(params, field.name)) for field in fields(params)
+    ))
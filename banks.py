@@ -0,0 +1,123 @@
+import numpy as np
+
+from cartmemory import MAX_BANKS
+from patterncodec import CHANNEL_COUNT
+
+# rounds of moving samples from bank to bank to improve on the first plan
+IMPROVE_ROUNDS = 4
+
+
+def song_samples(patterns, positions):
+    # (rows, channels) array of the sample last played on each channel at each row of the
+    # song, given patterns as from patterncodec.decode_patterns (0 before any has played)
+    cells = patterns[np.asarray(positions)].reshape(-1, CHANNEL_COUNT, 4)
+    played = np.where(cells[..., 0] != 255, cells[..., 1].astype(np.intp), 0)
+    rows = np.arange(len(played))[:, np.newaxis]
+    last_played = np.maximum.accumulate(np.where(played > 0, rows, 0), axis=0)
+    return np.take_along_axis(played, last_played, axis=0)
+
+
+def sample_overlaps(samples, sample_count):
+    # (samples + 1, samples + 1) array counting the rows on which each pair of samples play
+    # together on different channels
+    overlaps = np.zeros((sample_count + 1) ** 2, dtype=np.int64)
+    for a in range(CHANNEL_COUNT):
+        for b in range(CHANNEL_COUNT):
+            if a != b:
+                overlaps += np.bincount(samples[:, a] * (sample_count + 1) + samples[:, b], minlength=len(overlaps))
+    overlaps = overlaps.reshape(sample_count + 1, sample_count + 1)
+    overlaps[0, :] = overlaps[:, 0] = 0
+    return overlaps
+
+
+class BankPlan:
+    # An assignment of samples to banks, each bank holding the frames of its samples and
+    # a dictionary of the waves they use. sample_sizes gives the frame data bytes of each
+    # sample and sample_waves the set of waves it uses (empty for the raw wave layout),
+    # each wave taking wave_size bytes; each bank has room for capacity bytes.
+    def __init__(self, sample_sizes, sample_waves, wave_size, capacity, bank_count):
+        self.sample_sizes = sample_sizes
+        self.sample_waves = sample_waves
+        self.wave_size = wave_size
+        self.capacity = capacity
+        self.banks = [[] for i in range(bank_count)]
+
+    def size(self, samples):
+        waves = set().union(*[self.sample_waves[i] for i in samples])
+        return sum(self.sample_sizes[i] for i in samples) + len(waves) * self.wave_size
+
+    def fits(self, bank, sample):
+        return self.size(self.banks[bank] + [sample]) <= self.capacity
+
+    def bank_of(self, sample):
+        return next(bank for (bank, samples) in enumerate(self.banks) if sample in samples)
+
+
+def plan_banks(sample_sizes, sample_waves, wave_size, capacity, overlaps, max_banks=MAX_BANKS):
+    # Lists of the samples (0-based) to go in each bank, as few banks as there is room in,
+    # keeping samples that play together in the same bank where possible, so that the
+    # player has fewer banks to switch between. Samples without frames go in bank 0.
+    # overlaps is as from sample_overlaps.
+    samples = [i for i in range(len(sample_sizes)) if sample_sizes[i] > 0]
+    for i in samples:
+        if sample_sizes[i] + len(sample_waves[i]) * wave_size > capacity:
+            raise ValueError("sample %d needs %d bytes, more than a bank's %d" % (
+                i + 1, sample_sizes[i] + len(sample_waves[i]) * wave_size, capacity
+            ))
+    # largest first, placing each in the bank where it overlaps most with samples
+    # already there, then where it needs the least room
+    order = sorted(samples, key=lambda i: -sample_sizes[i])
+    for bank_count in range(1, max_banks + 1):
+        plan = BankPlan(sample_sizes, sample_waves, wave_size, capacity, bank_count)
+        for i in order:
+            candidates = [bank for bank in range(bank_count) if plan.fits(bank, i)]
+            if not candidates:
+                break
+            bank = max(candidates, key=lambda bank: (
+                sum(overlaps[i + 1, j + 1] for j in plan.banks[bank]),
+                -(plan.size(plan.banks[bank] + [i]) - plan.size(plan.banks[bank])),
+                -bank,
+            ))
+            plan.banks[bank].append(i)
+        else:
+            break
+    else:
+        raise ValueError("the samples need more than %d banks" % max_banks)
+
+    # then move samples to banks where they overlap more, while there is room
+    for round in range(IMPROVE_ROUNDS):
+        moved = False
+        for i in order:
+            current = plan.bank_of(i)
+            gains = [
+                (sum(overlaps[i + 1, j + 1] for j in plan.banks[bank])
+                 - sum(overlaps[i + 1, j + 1] for j in plan.banks[current] if j != i), bank)
+                for bank in range(len(plan.banks)) if bank != current and plan.fits(bank, i)
+            ]
+            if gains and max(gains)[0] > 0:
+                plan.banks[current].remove(i)
+                plan.banks[max(gains)[1]].append(i)
+                moved = True
+        if not moved:
+            break
+
+    banks = [sorted(bank) for bank in plan.banks if bank]
+    if not banks:
+        banks = [[]]
+    banks[0] = sorted(banks[0] + [i for i in range(len(sample_sizes)) if sample_sizes[i] == 0])
+    return banks
+
+
+def mean_bank_switches(samples, banks):
+    # mean number of banks beyond the first that the channels play from, per row of the
+    # song, given song_samples and the plan from plan_banks
+    bank_of_sample = np.zeros(samples.max(initial=0) + 1, dtype=np.intp)
+    for (bank, bank_samples) in enumerate(banks):
+        for i in bank_samples:
+            if i + 1 < len(bank_of_sample):
+                bank_of_sample[i + 1] = bank
+    playing = samples > 0
+    banks_played = np.zeros((len(samples), len(banks)), dtype=bool)
+    rows = np.broadcast_to(np.arange(len(samples))[:, np.newaxis], samples.shape)
+    banks_played[rows[playing], bank_of_sample[samples[playing]]] = True
+    return float(np.maximum(banks_played.sum(axis=1) - 1, 0).mean()) if len(samples) else 0.0
@@ -0,0 +1,388 @@
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from build import make_cart
+from manifest import manifest_filename_for
+from moddata import build_mod_data, get_average_notes, get_base_freq
+from modfile import ModFile, PERIODS
+from wavetable import BlockLagScores, FrameTable, analyse_wave, decode_sample, resample, DEFAULT_PARAMS
+
+BENCH_VERSION = 1
+REAL_MODULE = "GUITAROU.MOD"
+# build.py's cold start stages timed by bench_startup, each in a fresh interpreter, and
+# the part of the incremental build's manifest to mark out of date before each (None
+# to leave the cart up to date)
+STARTUP_STAGES = [
+    ('up_to_date', None),
+    ('code_only', 'template'),
+    ('cached_data', 'data'),
+]
+# changes smaller than these are timer or allocator noise, whatever the percentage
+MIN_TIME_CHANGE = 0.001
+MIN_MEMORY_CHANGE = 64 * 1024
+
+# name: (instruments, sample length in bytes, patterns)
+SYNTHETIC_SCENARIOS = {
+    'long-samples': (4, 131070, 4),
+    'many-patterns': (8, 8192, 64),
+    'all-instruments': (31, 16384, 16),
+}
+
+
+def make_synthetic_mod(instruments=31, sample_length=16384, patterns=16, seed=0):
+    # Bytes of a 4-channel M.K. module with the given number of instruments, each
+    # sample_length bytes long, and random notes over the given number of patterns.
+    # Instruments are harmonic tones with a decay and some vibrato, except for every
+    # fourth one, which is noise, so both tonal and noise frames are exercised.
+    rng = np.random.default_rng(seed)
+    sample_length = min(sample_length, 131070) & ~1
+    header = bytearray(b'synthetic'.ljust(20, b'\0'))
+    for i in range(31):
+        length = sample_length if i < instruments else 0
+        looped = length and i % 2
+        header += ("inst%d" % (i + 1)).encode('ascii').ljust(22, b'\0')
+        header += (length // 2).to_bytes(2, 'big')
+        header += bytes([0, 64])
+        header += (length // 4 if looped else 0).to_bytes(2, 'big')
+        header += (length // 4 if looped else 1).to_bytes(2, 'big')
+
+    position_count = min(patterns, 128)
+    header += bytes([position_count, 127])
+    header += bytes(range(position_count)).ljust(128, b'\0')
+    header += b'M.K.'
+
+    # one cell in four has a note; a few set the volume (effect C)
+    cells = np.zeros((patterns, 64, 4, 4), dtype=np.uint8)
+    has_note = rng.random((patterns, 64, 4)) < 0.25
+    periods = np.array(PERIODS)[rng.integers(12, 48, size=has_note.shape)] * has_note
+    sample_nums = rng.integers(1, max(instruments, 1) + 1, size=has_note.shape) * has_note
+    effects = np.where(rng.random(has_note.shape) < 0.1, 0x0c, 0) * has_note
+    cells[..., 0] = (sample_nums & 0xf0) | (periods >> 8)
+    cells[..., 1] = periods & 0xff
+    cells[..., 2] = ((sample_nums & 0x0f) << 4) | effects
+    cells[..., 3] = np.where(effects, rng.integers(0, 65, size=has_note.shape), 0)
+
+    t = np.arange(sample_length)
+    sample_data = []
+    for i in range(instruments):
+        if i % 4 == 3:
+            wave = rng.uniform(-1, 1, sample_length)
+        else:
+            period = rng.uniform(20, 200)
+            phase = 2 * np.pi * t / period + 0.3 * np.sin(2 * np.pi * t / 5000)
+            wave = sum(np.sin(phase * h) / h for h in range(1, 5)) / 2
+        wave *= np.exp(-t / (sample_length * rng.uniform(0.5, 2)))
+        sample_data.append((np.clip(wave, -1, 0.99) * 128).astype(np.int8).tobytes())
+
+    return bytes(header) + cells.tobytes() + b''.join(sample_data)
+
+
+def bench_stages(data, params=DEFAULT_PARAMS):
+    # Yield (stage name, callable) pairs covering the conversion of the module in data,
+    # in pipeline order. Each callable runs its stage alone, using the results of the
+    # earlier stages, which are computed once here.
+    yield 'parse', lambda: ModFile(bytearray(data))
+    mod = ModFile(bytearray(data))
+    yield 'pitch', lambda: get_average_notes(mod)
+    notes = get_average_notes(mod)
+    base_freqs = [get_base_freq(notes[i]) for i in range(len(mod.samples))]
+    converted = [i for (i, sample) in enumerate(mod.samples) if sample.length > 0]
+
+    def decode():
+        return [decode_sample(mod.samples[i].data) for i in converted]
+    yield 'decode', decode
+    waves = decode()
+
+    def get_periods():
+        return [
+            BlockLagScores(wave, base_freqs[i], params.frame_rate, params.start_offset)
+            for (i, wave) in zip(converted, waves)
+        ]
+    yield 'get_period', get_periods
+    lag_scores = get_periods()
+
+    # the interpolation stage resamples the same single-period slices as the analysis does
+    resample_inputs = []
+    for scores in lag_scores:
+        if scores.full_count:
+            periods = scores.scores.argmin(axis=1) + params.start_offset
+            for period in np.unique(periods):
+                resample_inputs.append(scores.blocks[periods == period, 0:period])
+    yield 'interpolation', lambda: [resample(slices) for slices in resample_inputs]
+
+    def analyse():
+        return [
+            FrameTable(*analyse_wave(wave, base_freqs[i], params=params, lag_scores=scores))
+            for (i, wave, scores) in zip(converted, waves, lag_scores)
+        ]
+    yield 'analyse', analyse
+    wavetables = [FrameTable.empty() for sample in mod.samples]
+    for (i, table) in zip(converted, analyse()):
+        wavetables[i] = table
+
+    yield 'packed_data', lambda: bytes(FrameTable.concatenate(wavetables).packed_data())
+    yield 'layout', lambda: build_mod_data(mod, params=params, wavetables=wavetables)
+    layout = build_mod_data(mod, params=params, wavetables=wavetables)
+
+    def assemble():
+        f = io.BytesIO()
+        for chunk in make_cart(layout, layout['positions']).chunks:
+            chunk.write(f)
+        return f.getvalue()
+    yield 'cart', assemble
+
+
+def time_call(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def peak_memory(fn):
+    # peak bytes allocated while running fn, as seen by tracemalloc (which numpy reports to)
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_module(data, repeat=5):
+    stages = {}
+    total_start = time.perf_counter()
+    for (name, fn) in bench_stages(data):
+        times = time_call(fn, repeat)
+        stages[name] = {
+            'min_s': min(times),
+            'median_s': statistics.median(times),
+            'peak_bytes': peak_memory(fn),
+        }
+    mod = ModFile(bytearray(data))
+    return {
+        'size': len(data),
+        'samples': sum(1 for sample in mod.samples if sample.length > 0),
+        'sample_bytes': sum(sample.length for sample in mod.samples),
+        'patterns': mod.pattern_count,
+        'stages': stages,
+        'elapsed_s': time.perf_counter() - total_start,
+    }
+
+
+def run_cold(args):
+    # Run args in a fresh Python interpreter from this directory, returning the time it
+    # was started and the time it finished, on the perf_counter clock (which processes
+    # share, so that times from a trace of the run can be compared with them)
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable] + args, cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, check=True
+    )
+    return start, time.perf_counter()
+
+
+def bench_startup(filename, repeat=5):
+    # Time build.py's start up on the MOD file in filename, as in batch and incremental
+    # use: 'import' loads the build module, 'up_to_date' runs an incremental build with
+    # nothing to do, and the other STARTUP_STAGES time from launching an incremental
+    # build to it starting to write the cart (taken from a --trace of the build). Memory
+    # isn't measured, as it happens in other processes.
+    total_start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        output_filename = os.path.join(tmp, 'startup.tic')
+        trace_filename = os.path.join(tmp, 'startup.trace.json')
+        manifest_filename = manifest_filename_for(output_filename)
+        build_args = [
+            'build.py', os.path.abspath(filename), '-o', output_filename, '--incremental',
+            '--cache-dir', os.path.join(tmp, 'cache'),
+        ]
+        # the first build converts the samples into the cache
+        run_cold(build_args)
+
+        def import_build():
+            start, end = run_cold(['-c', 'import build'])
+            return end - start
+
+        def build(stale_part):
+            if stale_part is None:
+                start, end = run_cold(build_args)
+                return end - start
+            with open(manifest_filename) as f:
+                manifest = json.load(f)
+            manifest['keys'][stale_part] = ''
+            with open(manifest_filename, 'w') as f:
+                json.dump(manifest, f)
+            start, end = run_cold(build_args + ['--trace', trace_filename])
+            with open(trace_filename) as f:
+                events = json.load(f)['traceEvents']
+            save_start = min(event['ts'] for event in events if event['name'] == 'save') / 1e6
+            return save_start - start
+
+        stages = {}
+        for (name, fn) in [('import', import_build)] + [
+            (name, lambda stale_part=stale_part: build(stale_part)) for (name, stale_part) in STARTUP_STAGES
+        ]:
+            times = [fn() for i in range(repeat)]
+            stages[name] = {'min_s': min(times), 'median_s': statistics.median(times)}
+
+    # only the header is needed for the summary
+    with ModFile.open(filename, lazy=True) as mod:
+        samples = sum(1 for sample in mod.samples if sample.length > 0)
+        sample_bytes = sum(sample.length for sample in mod.samples)
+    return {
+        'size': os.path.getsize(filename),
+        'samples': samples,
+        'sample_bytes': sample_bytes,
+        'patterns': mod.pattern_count,
+        'stages': stages,
+        'elapsed_s': time.perf_counter() - total_start,
+    }
+
+
+def load_scenarios(names, mod_filenames, seed=0):
+    scenarios = {}
+    for name in names:
+        if name == 'real':
+            if os.path.exists(REAL_MODULE):
+                with open(REAL_MODULE, 'rb') as f:
+                    scenarios[name] = f.read()
+        else:
+            instruments, sample_length, patterns = SYNTHETIC_SCENARIOS[name]
+            scenarios[name] = make_synthetic_mod(instruments, sample_length, patterns, seed)
+    for filename in mod_filenames:
+        with open(filename, 'rb') as f:
+            scenarios[os.path.basename(filename)] = f.read()
+    return scenarios
+
+
+def compare(baseline, current, threshold=0.1):
+    # List of (scenario, stage, measure, old, new) for every stage that got slower, or
+    # used more memory, by more than the threshold fraction
+    min_changes = {'min_s': MIN_TIME_CHANGE, 'peak_bytes': MIN_MEMORY_CHANGE}
+    regressions = []
+    for (scenario, result) in current['scenarios'].items():
+        old_result = baseline['scenarios'].get(scenario)
+        if old_result is None:
+            continue
+        for (stage, measures) in result['stages'].items():
+            old_measures = old_result['stages'].get(stage)
+            if old_measures is None:
+                continue
+            for measure in ('min_s', 'peak_bytes'):
+                if measure not in measures or measure not in old_measures:
+                    continue
+                old, new = old_measures[measure], measures[measure]
+                if new > old * (1 + threshold) and new - old >= min_changes[measure]:
+                    regressions.append((scenario, stage, measure, old, new))
+    return regressions
+
+
+def format_measure(measure, value):
+    if measure == 'peak_bytes':
+        return "%.1f MB" % (value / 1e6)
+    return "%.2f ms" % (value * 1000)
+
+
+def print_results(results, baseline=None):
+    for (scenario, result) in results['scenarios'].items():
+        old_result = (baseline or {}).get('scenarios', {}).get(scenario)
+        print("%s: %d samples (%d bytes), %d patterns" % (
+            scenario, result['samples'], result['sample_bytes'], result['patterns']
+        ))
+        for (stage, measures) in result['stages'].items():
+            line = "  %-14s %10s %10s" % (
+                stage, format_measure('min_s', measures['min_s']),
+                format_measure('peak_bytes', measures['peak_bytes']) if 'peak_bytes' in measures else ""
+            )
+            old_measures = old_result and old_result['stages'].get(stage)
+            if old_measures and old_measures['min_s'] > 0:
+                line += "  %+6.1f%%" % (100 * (measures['min_s'] / old_measures['min_s'] - 1))
+            print(line)
+
+
+def print_regressions(regressions, threshold):
+    if not regressions:
+        print("No regressions beyond %d%%" % (threshold * 100))
+        return
+    print("Regressions beyond %d%%:" % (threshold * 100))
+    for (scenario, stage, measure, old, new) in regressions:
+        print("  %s %s %s: %s -> %s" % (
+            scenario, stage, 'time' if measure == 'min_s' else 'memory',
+            format_measure(measure, old), format_measure(measure, new)
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time each stage of the conversion pipeline on real and synthetic modules"
+    )
+    parser.add_argument('--scenario', action='append',
+        choices=['real'] + list(SYNTHETIC_SCENARIOS) + ['startup'],
+        help="scenario to run; may be repeated (default: all). 'real' is %s, and 'startup' "
+             "times build.py's cold start on it" % REAL_MODULE)
+    parser.add_argument('--mod', action='append', default=[], metavar='FILE',
+        help="also benchmark this MOD file; may be repeated")
+    parser.add_argument('--repeat', type=int, default=5,
+        help="runs per stage; the fastest is reported (default: 5)")
+    parser.add_argument('--seed', type=int, default=0, help="seed for synthetic modules (default: 0)")
+    parser.add_argument('-o', '--output', help="write results to this JSON file")
+    parser.add_argument('--baseline', metavar='FILE',
+        help="compare the results against an earlier JSON file, and exit with status 1 on regressions")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+        help="compare two earlier JSON files instead of running the benchmark")
+    parser.add_argument('--threshold', type=float, default=10,
+        help="percentage slowdown or memory growth reported as a regression (default: 10)")
+    args = parser.parse_args()
+    threshold = args.threshold / 100
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            results = json.load(f)
+    else:
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        names = args.scenario or ['real'] + list(SYNTHETIC_SCENARIOS) + ['startup']
+        scenarios = load_scenarios([name for name in names if name != 'startup'], args.mod, args.seed)
+        results = {
+            'version': BENCH_VERSION,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'repeat': args.repeat,
+            'scenarios': {},
+        }
+        for (name, data) in scenarios.items():
+            results['scenarios'][name] = bench_module(data, args.repeat)
+        if 'startup' in names and os.path.exists(REAL_MODULE):
+            results['scenarios']['startup'] = bench_startup(REAL_MODULE, args.repeat)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    print_results(results, baseline)
+    if baseline is not None:
+        regressions = compare(baseline, results, threshold)
+        print_regressions(regressions, threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,372 +1,587 @@
-from modfile import ModFile
-from wavetable import make_wavetable
-from io import BytesIO
+import argparse
+import json
+import os
+import sys
+import time
+from analysisparams import analysis_key, AnalysisParams, FRAME_RATE, DEFAULT_PARAMS
+from wavecache import WavetableCache, default_cache_dir
+from manifest import BuildManifest, hash_bytes, manifest_filename_for
+from profiling import Profiler, profiler, set_profiler, run_profiled
+from cartmemory import sync_mask, BANK_SIZE, MAX_BANKS
+from playercode import make_program, template_key
+from visualisers import VISUALISERS, parse_visualisers, plan_visualisers, visualiser_data
 from ticfile import TICFile, Chunk, ChunkType
-from collections import defaultdict
-
-mod = ModFile.open("GUITAROU.MOD")
-
-wavetable_data_buffer = BytesIO()
-wavetable_data_length = 0
-sample_meta = []
-
-# determine the average pitch used for each sample
-pitch_sums_by_sample = defaultdict(lambda:0)
-note_counts_by_sample = defaultdict(lambda:0)
-for pattern in mod.patterns:
-    for row in pattern:
-        for (note, sample, effect, param) in row:
-            if note is not None:
-                pitch_sums_by_sample[sample-1] += note
-                note_counts_by_sample[sample-1] += 1
-
-avg_notes_by_sample = {}
-for i in range(0, len(mod.samples)):
-    if note_counts_by_sample[i]:
-        avg_notes_by_sample[i] = int(pitch_sums_by_sample[i] / note_counts_by_sample[i])
-    else:
-        avg_notes_by_sample[i] = 29
-
 
-for (i, sample) in enumerate(mod.samples):
-    base_note = avg_notes_by_sample[i]
-    if sample.length > 0:
-        wave_data = [
-            (v/128 if v < 128 else (v-256)/128)
-            for v in sample.data
+MAX_MOD_DATA = BANK_SIZE  # TILES + SPRITES + MAP, in one bank
+DEFAULT_INPUT = "GUITAROU.MOD"
+DEFAULT_OUTPUT = "ticmodplayer.tic"
+
+
+def player_banks(layout, stream=None):
+    # what the player plays from, for each bank: the mod data, or a register stream
+    # built from it
+    return [stream['data']] if stream is not None else [bank['data'] for bank in layout['banks']]
+
+
+def program_inputs(layout, visualisers=None, visualiser_budget=None, stream=None):
+    # the parts of a build_mod_data layout (or of a register stream from
+    # build_register_stream) that the player code depends on, and the visualisers
+    # chosen (see plan_visualisers) to fit the memory left after it in the fullest bank;
+    # their lookup tables go there in every bank, so that switching banks keeps them
+    data_size = max(len(data) for data in player_banks(layout, stream))
+    program = {
+        'player': 'sequencer' if stream is None else 'stream',
+        'visualisers': plan_visualisers(MAX_MOD_DATA - data_size, visualisers, visualiser_budget),
+        'visualiser_data_addr': 0x4000 + data_size,
+    }
+    if stream is not None:
+        program['stream'] = {'record_data_offset': stream['record_data_offset'], 'spans': stream['spans']}
+    else:
+        program.update({
+            'sample_meta': layout['sample_meta'],
+            'semitone_shifts': layout['semitone_shifts'],
+            'pattern_offsets': layout['pattern_offsets'],
+            'pattern_data_size': len(layout['pattern_data']),
+            'wave_data_sizes': [len(bank['wave_data']) for bank in layout['banks']],
+            # the sections of cart memory to copy in when switching banks
+            'sync_mask': sync_mask(max(len(bank['data']) for bank in layout['banks'])),
+            'frame_size': layout['frame_size'],
+            'wave_layout': layout['wave_layout'],
+        })
+    return program
+
+
+def make_code_chunk(program, positions):
+    with profiler().stage('program'):
+        return Chunk(ChunkType.CODE, 0, make_program(program, positions))
+
+
+def make_data_chunks(banks):
+    # TILES, SPRITES and MAP chunks holding the data for each bank, as far as it goes
+    chunks = []
+    for (bank, data) in enumerate(banks):
+        chunks.append(Chunk(ChunkType.TILES, bank, data[0:0x2000]))
+        if len(data) > 0x2000:
+            chunks.append(Chunk(ChunkType.SPRITES, bank, data[0x2000:0x4000]))
+        if len(data) > 0x4000:
+            chunks.append(Chunk(ChunkType.MAP, bank, data[0x4000:MAX_MOD_DATA]))
+    return chunks
+
+
+def cart_banks(layout, program, stream=None):
+    # the player's data for each bank, followed by the lookup tables of the visualisers
+    # in program, at the same address in each
+    data_size = program['visualiser_data_addr'] - 0x4000
+    tables = visualiser_data(program['visualisers'])
+    banks = player_banks(layout, stream)
+    return [data.ljust(data_size, b'\0') + tables for data in banks] if tables else banks
+
+
+def make_cart(layout, positions, visualisers=None, visualiser_budget=None, stream=None):
+    # TICFile holding the player code and the mod data from build_mod_data, or with
+    # stream, a register stream built from it
+    program = program_inputs(layout, visualisers, visualiser_budget, stream)
+    chunks = [
+        make_code_chunk(program, positions),
+        Chunk(ChunkType.DEFAULT, 0, b''),
+    ] + make_data_chunks(cart_banks(layout, program, stream))
+    for chunk in chunks:
+        profiler().count('bytes_%s' % chunk.type.name, len(chunk.data))
+    return TICFile(chunks)
+
+
+DATA_CHUNK_TYPES = (ChunkType.TILES, ChunkType.SPRITES, ChunkType.MAP)
+
+
+def patch_cart(tic, chunks, types):
+    # Replace all chunks of the given types in tic with chunks, which go where the first
+    # of the replaced ones was; other chunks are left as they are
+    positions = [i for (i, chunk) in enumerate(tic.chunks) if chunk.type in types]
+    insert_at = positions[0] if positions else len(tic.chunks)
+    kept = [chunk for chunk in tic.chunks if chunk.type not in types]
+    insert_at -= sum(1 for i in positions if i < insert_at)
+    tic.chunks = kept[:insert_at] + list(chunks) + kept[insert_at:]
+    for chunk in chunks:
+        profiler().count('bytes_%s' % chunk.type.name, len(chunk.data))
+
+
+def build_options_key(options, player='sequencer', visualisers=None, visualiser_budget=None):
+    # hash of the build_mod_data options that affect the mod data, of the player it is
+    # prepared for, and of the choice of visualisers, whose lookup tables go with it
+    params = options.get('params', DEFAULT_PARAMS)
+    return hash_bytes(repr((
+        analysis_key(params=params), options.get('wave_layout', 'auto'), options.get('max_waves', 'fit'),
+        options.get('keyframe_threshold', 0.0), options.get('banks', 1),
+        player, visualisers, visualiser_budget,
+    )).encode('utf-8'))
+
+
+def build_cart(mod_filename, output_filename, jobs=1, cache=None, incremental=False,
+               player='sequencer', visualisers=None, visualiser_budget=None, **options):
+    # player is 'sequencer' to sequence the mod data at run time, or 'stream' to play a
+    # register stream (see registerstream.py) worked out from it at build time.
+    # visualisers and visualiser_budget are passed on to plan_visualisers, and other
+    # options to build_mod_data. With incremental=True, a manifest kept
+    # alongside the cart records what it was built from, and only the parts of an
+    # existing cart that are out of date (the player code and/or the mod data) are rebuilt
+    prof = profiler()
+    with prof.stage('read'):
+        with open(mod_filename, 'rb') as f:
+            mod_bytes = f.read()
+    keys = {
+        'mod': hash_bytes(mod_bytes),
+        'data': build_options_key(options, player, visualisers, visualiser_budget),
+        'template': template_key(),
+    }
+    manifest_filename = manifest_filename_for(output_filename)
+
+    stale = {'code', 'data'}
+    tic = manifest = None
+    if incremental:
+        manifest = BuildManifest.load(manifest_filename)
+        if manifest is not None and os.path.exists(output_filename):
+            stale = manifest.stale_parts(keys)
+            if options.get('metrics') and manifest.result['metrics'] is None:
+                stale = {'code', 'data'}
+            if stale:
+                with prof.stage('read_cart'):
+                    tic = TICFile.open(output_filename)
+
+    if 'data' in stale:
+        # parsing and converting the mod needs numpy, so these are only loaded when the
+        # data has to be rebuilt; up to date carts, and those needing only new player
+        # code, are dealt with without them
+        from modfile import ModFile
+        from moddata import build_mod_data
+        from patterncodec import unpacked_size
+        from registerstream import build_register_stream
+        from wavecodec import WAVE_SIZE
+        with prof.stage('parse'):
+            mod = ModFile(bytearray(mod_bytes))
+        with prof.stage('layout'):
+            layout = build_mod_data(mod, jobs, cache, **options)
+        positions = layout['positions']
+        stream = None
+        if player == 'stream':
+            with prof.stage('stream'):
+                stream = build_register_stream(layout, positions)
+            if len(stream['data']) > MAX_MOD_DATA:
+                raise ValueError(
+                    "register stream is %d bytes, over the %d byte limit (the mod data is %d bytes)"
+                    % (len(stream['data']), MAX_MOD_DATA, len(layout['mod_data']))
+                )
+        program = program_inputs(layout, visualisers, visualiser_budget, stream)
+        result = {
+            'title': mod.title.rstrip('\x00 '),
+            'mod_data_size': len(layout['mod_data']),
+            'pattern_data_size': len(layout['pattern_data']),
+            'patterns_used': len(layout['pattern_offsets']),
+            'pattern_count': layout['pattern_count'],
+            'unpacked_pattern_size': unpacked_size(layout['pattern_count']),
+            'wave_layout': layout['wave_layout'],
+            'frame_count': layout['frame_count'],
+            'unique_waves': layout['unique_waves'],
+            'dedup_saving': layout['dedup_saving'],
+            'quantised_waves': layout['quantised_waves'],
+            'quantise_error': layout['quantise_error'],
+            'quantise_saving': (
+                (layout['unique_waves'] - layout['quantised_waves']) * WAVE_SIZE
+                if layout['quantised_waves'] is not None else None
+            ),
+            'keyframe_stats': layout['keyframe_stats'],
+            'bank_sizes': [len(bank['data']) for bank in layout['banks']],
+            'bank_samples': [[i + 1 for i in bank['samples']] for bank in layout['banks']],
+            'bank_switches': layout['bank_switches'],
+            'metrics': layout['metrics'],
+            'visualisers': program['visualisers'],
+            'player': player,
+            'stream_size': len(stream['data']) if stream is not None else None,
+            'stream_ticks': stream['ticks'] if stream is not None else None,
+            'stream_loop_tick': stream['loop_tick'] if stream is not None else None,
+            'stream_raw_size': stream['raw_size'] if stream is not None else None,
+        }
+        if tic is None:
+            tic = make_cart(layout, positions, visualisers, visualiser_budget, stream)
+        else:
+            patch_cart(tic, [make_code_chunk(program, positions)], (ChunkType.CODE,))
+            patch_cart(tic, make_data_chunks(cart_banks(layout, program, stream)), DATA_CHUNK_TYPES)
+        if layout['metrics'] is not None:
+            with open(metrics_filename_for(output_filename), 'w') as f:
+                json.dump(layout['metrics'], f, indent=2)
+    else:
+        positions = manifest.positions
+        program = manifest.program
+        result = manifest.result
+        if 'code' in stale:
+            patch_cart(tic, [make_code_chunk(program, positions)], (ChunkType.CODE,))
+
+    if stale:
+        with prof.stage('save'):
+            tic.save(output_filename)
+    if incremental:
+        BuildManifest(keys, program, positions, result).save(manifest_filename)
+    return dict(result, rebuilt=sorted(stale))
+
+
+def metrics_filename_for(output_filename):
+    return os.path.splitext(output_filename)[0] + '.metrics.json'
+
+
+def build_one(mod_filename, output_filename, jobs=1, cache=None, options=None, incremental=False):
+    # Build a single cart, catching failures so that one bad file doesn't stop a batch
+    options = options or {}
+    result = {'input': mod_filename, 'output': output_filename, 'error': None, 'unsupported': False}
+    start_time = time.perf_counter()
+    try:
+        with profiler().scope(os.path.basename(mod_filename)):
+            result.update(build_cart(mod_filename, output_filename, jobs, cache, incremental, **options))
+    except UnicodeDecodeError as e:
+        result['error'] = "not a MOD file (%s)" % e
+    except Exception as e:
+        # modfile is imported here rather than up front, as it brings in numpy; it is
+        # already loaded if the error came from parsing the MOD file
+        from modfile import UnsupportedModError
+        if isinstance(e, UnsupportedModError):
+            result['error'] = str(e)
+            result['unsupported'] = True
+        else:
+            result['error'] = "%s: %s" % (type(e).__name__, e)
+    result['time'] = time.perf_counter() - start_time
+    if cache is not None:
+        result['cache_hits'] = cache.hits
+        result['cache_misses'] = cache.misses
+    return result
+
+
+def is_mod_filename(filename):
+    # Amiga-style "mod.name" as well as "name.mod"
+    name = os.path.basename(filename).lower()
+    return name.endswith('.mod') or name.startswith('mod.')
+
+
+def find_inputs(paths):
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                inputs.extend(
+                    os.path.join(dirpath, filename)
+                    for filename in sorted(filenames) if is_mod_filename(filename)
+                )
+        else:
+            inputs.append(path)
+    return inputs
+
+
+def output_filename_for(input_filename, output_dir):
+    name = os.path.basename(input_filename)
+    if name.lower().endswith('.mod'):
+        name = name[:-4]
+    elif name.lower().startswith('mod.'):
+        name = name[4:]
+    return os.path.join(output_dir, name + '.tic')
+
+
+def find_jobs(paths, output_dir):
+    # (input, output) filename pairs for the MOD files in paths. Files found in a directory
+    # keep their path relative to it under output_dir, so that files with the same name in
+    # different subdirectories get carts of their own.
+    jobs = []
+    for path in paths:
+        for filename in find_inputs([path]):
+            subdir = os.path.relpath(os.path.dirname(filename), path) if os.path.isdir(path) else ''
+            jobs.append((filename, os.path.normpath(output_filename_for(filename, os.path.join(output_dir, subdir)))))
+    return jobs
+
+
+def duplicate_outputs(jobs):
+    # the output filenames that more than one input would be built to
+    inputs = {}
+    for (mod_filename, output_filename) in jobs:
+        inputs.setdefault(output_filename, []).append(mod_filename)
+    return {output_filename: names for (output_filename, names) in inputs.items() if len(names) > 1}
+
+
+def describe_result(result):
+    if result['error']:
+        return ("unsupported: " if result['unsupported'] else "failed: ") + result['error']
+    size = result['mod_data_size']
+    status = "%d bytes (max: %d)" % (size, MAX_MOD_DATA)
+    if len(result['bank_sizes']) > 1:
+        status = "%d bytes in %d banks (max: %d per bank)" % (size, len(result['bank_sizes']), MAX_MOD_DATA)
+    if result.get('player') == 'stream':
+        status = "register stream %d bytes (max: %d), mod data %d bytes" % (result['stream_size'], MAX_MOD_DATA, size)
+    if result['metrics'] is not None:
+        metrics = result['metrics']
+        status += ", SNR %s dB, LSD %s dB, %.0f%% noise" % (
+            "%.1f" % metrics['snr_db'] if metrics['snr_db'] is not None else "-",
+            "%.1f" % metrics['log_spectral_distance_db'] if metrics['log_spectral_distance_db'] is not None else "-",
+            100 * (metrics['noise_fraction'] or 0),
+        )
+    if result['quantise_error'] is not None:
+        status += ", waves quantised to %d (RMS error %.2f)" % (result['quantised_waves'], result['quantise_error'])
+    if player_data_size(result) > MAX_MOD_DATA:
+        status += " - TOO LARGE, truncated"
+    if result.get('rebuilt') == []:
+        status += " (up to date)"
+    elif result.get('rebuilt') == ['code']:
+        status += " (player code rebuilt, mod data reused)"
+    return status
+
+
+def player_data_size(result):
+    # bytes of data the cart's player plays from, in the fullest bank
+    return result['stream_size'] if result.get('player') == 'stream' else max(result['bank_sizes'])
+
+
+def input_name(result, output_dir):
+    # the input's path relative to the directory it was found in, taken from where its
+    # cart was put under output_dir (see find_jobs)
+    subdir = os.path.relpath(os.path.dirname(result['output']), output_dir)
+    return os.path.normpath(os.path.join(subdir, os.path.basename(result['input'])))
+
+
+def print_summary(results, output_dir='.'):
+    names = [input_name(r, output_dir) for r in results]
+    name_width = max([len(name) for name in names] + [4])
+    print()
+    print("%-*s  %8s  %6s  %7s  %s" % (name_width, "File", "Size", "Used", "Time", "Status"))
+    for (name, r) in zip(names, results):
+        if r['error']:
+            size = used = "-"
+            status = "UNSUPPORTED" if r['unsupported'] else "FAILED"
+        else:
+            size = str(player_data_size(r))
+            used = "%d%%" % (100 * player_data_size(r) / MAX_MOD_DATA)
+            status = "TOO LARGE" if player_data_size(r) > MAX_MOD_DATA else "ok"
+        print("%-*s  %8s  %6s  %6.2fs  %s" % (
+            name_width, name, size, used, r['time'], status
+        ))
+    built = sum(1 for r in results if not r['error'])
+    unsupported = sum(1 for r in results if r['unsupported'])
+    too_large = sum(1 for r in results if not r['error'] and player_data_size(r) > MAX_MOD_DATA)
+    print("%d built (%d too large), %d unsupported, %d failed" % (
+        built, too_large, unsupported, len(results) - built - unsupported
+    ))
+
+
+def build_batch(jobs_list, jobs=1, cache=None, options=None, incremental=False):
+    # Build several carts concurrently, one file per worker, reporting progress as each finishes
+    options = options or {}
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    prof = profiler()
+    results = []
+    with ProcessPoolExecutor(max_workers=min(jobs, len(jobs_list))) as pool:
+        futures = [
+            pool.submit(run_profiled, prof.trace, build_one, mod_filename, output_filename, 1, cache, options, incremental)
+            if prof.enabled else
+            pool.submit(build_one, mod_filename, output_filename, 1, cache, options, incremental)
+            for (mod_filename, output_filename) in jobs_list
         ]
-        base_freq = 11084 * 2**((base_note - 29)/12)
-        wavetable = make_wavetable(wave_data, base_freq)
-        for frame in wavetable:
-            wavetable_data_buffer.write(frame.packed_data())
-
-    block_count = len(wavetable)
-    block_size = base_freq // 60
-    sample_meta.append({
-        'start': wavetable_data_length,
-        'length': block_count,
-        'repeat_from': wavetable_data_length + int(sample.repeat_from / block_size) * 18,
-        'repeat_length': int(sample.repeat_length / block_size),
-        'base_note': base_note,
-    })
-    wavetable_data_length += block_count * 18
-
-sample_meta_string = ",\n".join([
-    "{%d,%d,%d,%d,%d}" % (s['start'], s['length'], s['repeat_from'], s['repeat_length'], s['base_note'])
-    for s in sample_meta
-])
-
-pattern_data_buffer = BytesIO()
-for pattern in mod.patterns:
-    for row in pattern:
-        for (note, sample, effect, param) in row:
-            pattern_data_buffer.write(bytes([255 if note is None else note, sample, effect, param]))
-
-pattern_data = pattern_data_buffer.getvalue()
-pattern_data_start_addr = 0x4000
-sample_data_start_addr = pattern_data_start_addr + len(pattern_data)
-mod_data = pattern_data + wavetable_data_buffer.getvalue()
-
-print("Mod data: %d bytes (max: 49152)" % len(mod_data))
-
-
-positions = "{%s}" % (",".join([
-    str(v) for v in mod.positions[:mod.position_count]
-]))
-
-program_data = f'''-- title:  ticmodplayer
--- author: Gasman / Wavesitter
--- desc:   MOD playback on TIC-80
--- script: lua
-
--- 1=start address of sample (0-based)
--- 2=sample length in frames
--- 3=address to repeat from (0-based)
--- 4=repeat length in frames
--- 5=sample's native note frequency
-samples_meta = {{
-    {sample_meta_string}
-}}
-
-positions = {positions}
-
--- 1=sample address pointer
--- 2=sample number
--- 3=frames left until sample ends or repeats
--- 4=semitone shift from sample's native frequency
--- 5=vol multiplier
-channel_states = {{
-    {{0, 0, 0, 0, 0, 0}},
-    {{0, 0, 0, 0, 0, 0}},
-    {{0, 0, 0, 0, 0, 0}},
-    {{0, 0, 0, 0, 0, 0}},
-}}
-
-t=0
-
-row_duration = 1.2*6
-next_row_time = 0
-row_num = -1
-position_num = 1
-pattern_num = positions[1]
-pattern_data_start_addr = {pattern_data_start_addr}
-sample_data_start_addr = {sample_data_start_addr}
-
-function play_frame()
-  if next_row_time <= t then
-    -- read new row
-    row_num = row_num + 1
-
-    if row_num == 64 then
-      -- read new pattern
-      row_num = 0
-      position_num = (position_num % #positions) + 1
-      pattern_num = positions[position_num]
-    end
-
-    pattern_addr = pattern_data_start_addr + pattern_num * 64 * 4 * 4
-    row_addr = pattern_addr + row_num * 4 * 4
-    for chan=1,4 do
-      cell_addr = row_addr + (chan - 1) * 4
-      note_num = peek(cell_addr)
-      if note_num ~= 255 then
-        sample_num = peek(cell_addr + 1)
-        sample_meta=samples_meta[sample_num]
-        channel_states[chan][1] = sample_meta[1]+sample_data_start_addr
-        channel_states[chan][2] = sample_num
-        channel_states[chan][3] = sample_meta[2]
-        channel_states[chan][4] = note_num - sample_meta[5]
-        effect = peek(cell_addr + 2)
-        if effect == 0x0c then
-          param = peek(cell_addr + 3)
-          channel_states[chan][5] = param / 64
-        else
-          channel_states[chan][5] = 1
-        end
-        if effect == 0x0f then
-          param = peek(cell_addr + 3)
-          if param <= 32 then
-            row_duration = 1.2*param
-          else
-            row_duration = 900/param
-          end
-        end
-      end
-    end
-    -- advance next_row_time
-    next_row_time = next_row_time + row_duration
-  end
-
-  for chan=1,4 do
-    chan_addr = 0xff9c+(chan-1)*18
-    state=channel_states[chan]
-    if state[2] > 0 then
-      sample_meta=samples_meta[state[2]]
-      if state[3]==0 then
-        -- sample end reached
-        if sample_meta[4] > 0 then
-          -- repeating
-          state[1]=sample_meta[3]+sample_data_start_addr
-          state[3]=sample_meta[4]
-        else
-          -- non-repeating - stop sample
-          state[2]=0
-        end
-      end
-    end
-
-    if state[2]>0 then
-      addr=state[1]
-      b1=peek(addr)
-      b2=peek(addr+1)
-      addr = addr + 2
-      wave_freq=b1|((b2 & 0x0f) << 8)
-      freq=((wave_freq*(2^(state[4]/12)))+0.5)//1
-      wave_vol=b2>>4
-      vol=wave_vol*state[5]//1
-      poke(chan_addr,freq&0xff)
-      poke(chan_addr+1,(freq>>8)|(vol<<4))
-      chan_addr = chan_addr + 2
-      for i=0,15 do
-        poke(chan_addr+i,peek(addr))
-        addr = addr + 1
-      end
-      state[1]=addr
-      state[3]=state[3] - 1
-    else
-      poke(chan_addr+1,0)
-    end
-  end
-
-  t=t+1
-end
-
-scrolltext = "Hello! I'm Gasman, and you're listening to Guitarous by The Warlock / Grace... quite possibly the first MOD file I ever listened to, from some music collection that ran on a PC speaker (erk). So it seemed quite appropriate to borrow it for the world's first MOD player for TIC-80. The TIC-80 still doesn't do real sample playback, so this is a continuation of the technique from my Mercedes Benz demo: first, chop each sample into 1/60s slices, and do some statistical analysis on it to work out where the waveform repeats. (Which seems like it should be FFT, but... isn't, really.) Then take one of those waves, and squish it down into the 32 nibbles that the TIC-80 provides for a waveform on a single frame. Do that 60 times a second, and as long as that sample is something close to a musical note, we can play it back in a more or less recognisable form. Even better, we can pitch-shift it by altering the playback frequency... and combining that with the TIC-80's four channels, you've got everything you need for a MOD player. It's a very limited one, of course (not least since I've only been hacking on it over the Christmas holidays) - there's some hacky code to deal with drum samples, trying to work out when the pitch matching breaks down and ham-fistedly dropping some noise in instead. Hardly any effects are implemented right now, and we're also constrained by the TIC-80 memory map, so there's a 48Kb limit on the crunched sample and pattern data. Is this the future of music on the TIC-80? Probably not, assuming people don't want their soundtracks to sound like vacuum cleaners full of nails. But at the end of the day all we're really doing here is massively increasing the 16 waveforms that the native TIC-80 tracker gives us... I reckon that if we used this technique on original tracks written with the TIC-80 in mind, with some combination of sampled, synthesised and simple chip instruments - rather than expecting an automatic conversion to do a good job across the board - we could get some really nice-sounding results, and maybe even bless the TIC-80 with its very own 'signature sound'. That would be pretty awesome, wouldn't it? Maybe we can make 2023 the year that we really start pushing TIC-80 demos beyond the arena of size-coding :-) Greetings to Field-FX, Slipstream, TUHB, ScenePT All-Stars, Bitshifters, RBBS, Poo-Brain, MountainBytes, Marquee Design, pestis, ilmenit, dave84, p01 and my fellow Demozoo conspirators. Happy holidays and a prosperous 2023 to you all! Gasman signing off at the end of 2022...                        "
-
-scroll_x = 0
-scroll_next_char_index = 1
-scroll_buffer = "                              "
-
-function get_width(s)
-  return print(s, 0, -100, 6, false, 2)
-end
-
-scroll_first_char_width = get_width(string.sub(scroll_buffer, 1, 1))
-scroll_buffer_width = get_width(scroll_buffer)
-
-function oscilloscope()
-  cls()
-  for chan=0,3 do
-    addr = 0xff9c+chan*18
-    a=0
-    b1 = peek(addr)
-    b2 = peek(addr+1)
-    freq = b1 | ((b2 & 0x0f) << 8)
-    ampl = b2 >> 4
-    step = freq/480
-    wave_addr = (addr + 2) * 2
-    for x=0,239 do
-      v = ampl * (peek4(wave_addr + a) - 7)
-      pix(x, v/16 + chan*24 + 16, chan+4)
-      a = (a + step) % 32
-    end
-  end
-end
-
-function firescope()
-  for y=0,95 do
-    for x=0,239 do
-      v = (pix(x,y)+pix(x-1,y+1)+pix(x,y+1)+pix(x+1,y+1))/4.1
-      pix(x, y, v)
-    end
-  end
-  for chan=0,3 do
-    addr = 0xff9c+chan*18
-    a=0
-    b1 = peek(addr)
-    b2 = peek(addr+1)
-    freq = b1 | ((b2 & 0x0f) << 8)
-    ampl = b2 >> 4
-    step = freq/480
-    wave_addr = (addr + 2) * 2
-    for x=0,119 do
-      v = ampl * (peek4(wave_addr + a) - 7)
-      pix(x + 120*(chan%2), v/16 + (chan//2)*48 + 32, 12)
-      a = (a + step) % 32
-    end
-  end
-  -- clear scroller area
-  rect(0,96,240,135,0)
-end
-
-function zoomscope()
-  for y=0,47 do
-    for x=0,119 do
-      pix(119-x,47-y,pix(119-x*1.1-1,47-y*1.1-1))
-      pix(120+x,47-y,pix(120+x*1.1+1,47-y*1.1-1))
-      pix(120+x,48+y,pix(120+x*1.1+1,48+y*1.1+1))
-      pix(119-x,48+y,pix(119-x*1.1-1,48+y*1.1+1))
-    end
-  end
-  for chan=0,3 do
-    addr = 0xff9c+chan*18
-    a=0
-    b1 = peek(addr)
-    b2 = peek(addr+1)
-    freq = b1 | ((b2 & 0x0f) << 8)
-    ampl = b2 >> 4
-    step = freq/480
-    wave_addr = (addr + 2) * 2
-    rot = time() / 2000 + math.pi * chan / 2
-    for i=0,239 do
-      x = i - 120
-      y = ampl * (peek4(wave_addr + a) - 7) / 8 + 32
-      pix(120 + x*math.cos(rot) + y*math.sin(rot), 48 + y*math.cos(rot) - x*math.sin(rot), ampl)
-      a = (a + step) % 32
-    end
-  end
-  -- clear scroller area
-  rect(0,96,240,135,0)
-end
-
-waves = {{}}
-for chan=0,3 do
-  waves[chan] = {{}}
-end
-
-function circularscope()
-  for chan=0,3 do
-    addr = 0xff9c+chan*18
-    a=0
-    b1 = peek(addr)
-    b2 = peek(addr+1)
-    freq = b1 | ((b2 & 0x0f) << 8)
-    ampl = b2 >> 4
-    step = freq/480
-    wave_addr = (addr + 2) * 2
-    for x=0,239 do
-      waves[chan][x] = ampl * (peek4(wave_addr + a) - 7) / 128
-      a = (a + step) % 32
-    end
-  end
-
-  t0=time()/1000
-  for x=0,239 do
-    for y=0,96 do
-      x0 = x - 119.5
-      y0 = y - 47.5
-      z = (math.atan2(x0,y0) / math.pi * 119 + 120) // 1
-      band = math.sqrt(x0*x0+y0*y0) / 24 - t0
-      pix(x,y,(band+waves[(band+0.5)%4//1][z]/2)%4+8)
-    end
-  end
-  -- clear scroller area
-  rect(0,96,240,135,0)
-end
-
-function TIC()
-  play_frame()
-  fx = (time() // 15360) % 4
-  if fx == 0 then
-    oscilloscope()
-  elseif fx == 1 then
-    firescope()
-  elseif fx == 2 then
-    circularscope()
-  else
-    zoomscope()
-  end
-
-  if -scroll_x >= scroll_first_char_width then
-    scroll_buffer = string.sub(scroll_buffer, 2)
-    scroll_x = scroll_x + scroll_first_char_width
-    scroll_buffer_width = scroll_buffer_width - scroll_first_char_width
-    scroll_first_char_width = get_width(string.sub(scroll_buffer, 1, 1))
-  end
-
-  if scroll_buffer_width < 260 then
-    next_char = string.sub(scrolltext, scroll_next_char_index, scroll_next_char_index)
-    scroll_buffer_width = scroll_buffer_width + get_width(next_char)
-    scroll_buffer = scroll_buffer .. next_char
-    scroll_next_char_index = (scroll_next_char_index % #scrolltext) + 1
-  end
-
-  print(scroll_buffer, scroll_x, 110, 6, false, 2)
-  scroll_x = scroll_x - 2
-end
-'''.encode('ascii')
-
-# print(program_data)
-
-chunks = [
-    Chunk(ChunkType.CODE, 0, program_data),
-    Chunk(ChunkType.DEFAULT, 0, b''),
-    Chunk(ChunkType.TILES, 0, mod_data[0:0x2000]),
-]
-if len(mod_data) > 0x2000:
-    chunks.append(Chunk(ChunkType.SPRITES, 0, mod_data[0x2000:0x4000]))
-if len(mod_data) > 0x4000:
-    chunks.append(Chunk(ChunkType.MAP, 0, mod_data[0x4000:0xc000]))
-
-tic = TICFile(chunks)
-tic.save("ticmodplayer.tic")
+        for future in as_completed(futures):
+            result = future.result()
+            if prof.enabled:
+                result, profile = result
+                prof.merge(profile)
+            results.append(result)
+            print("[%d/%d] %s: %s (%.2fs)" % (
+                len(results), len(jobs_list), result['input'], describe_result(result), result['time']
+            ), flush=True)
+    # in job order, by output, as the same input may be built to more than one cart
+    order = {output_filename: i for (i, (mod_filename, output_filename)) in enumerate(jobs_list)}
+    results.sort(key=lambda r: order[r['output']])
+    return results
+
+
+def write_profile(prof, output_filename=None, trace_filename=None):
+    if prof is None:
+        return
+    print()
+    print(prof.report())
+    if output_filename:
+        profile = prof.export()
+        del profile['events']
+        with open(output_filename, 'w') as f:
+            json.dump(profile, f, indent=2)
+    if trace_filename:
+        with open(trace_filename, 'w') as f:
+            json.dump(prof.chrome_trace(), f)
+
+
+def parse_max_waves(value):
+    if value in ('fit', 'off'):
+        return None if value == 'off' else value
+    return int(value)
+
+
+def parse_banks(value):
+    banks = int(value)
+    if not 1 <= banks <= MAX_BANKS:
+        raise argparse.ArgumentTypeError("must be from 1 to %d" % MAX_BANKS)
+    return banks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build TIC-80 cartridges that play .mod files")
+    parser.add_argument('inputs', nargs='*',
+        help="MOD files, or directories to search for them (default: %s)" % DEFAULT_INPUT)
+    parser.add_argument('-o', '--output',
+        help="output filename, when building a single file (default: %s for %s, "
+             "otherwise the input name with a .tic extension)" % (DEFAULT_OUTPUT, DEFAULT_INPUT))
+    parser.add_argument('--output-dir', default='.',
+        help="directory to write carts to (default: current directory)")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help="number of worker processes, for converting samples or, in a batch, files "
+             "(default: number of CPUs)")
+    parser.add_argument('--wave-layout', choices=['auto', 'raw', 'dedup', 'keyframe'], default='auto',
+        help="store each frame's wave inline ('raw'), or each distinct wave once with frames "
+             "referring to it by index ('dedup') or in runs of frames sharing a wave, holding "
+             "repeated frames ('keyframe'); 'auto' picks the smallest (default: auto)")
+    parser.add_argument('--keyframe-threshold', type=float, default=0.0, metavar='RMS',
+        help="with --wave-layout keyframe, keep the last keyframe's wave until the wave has "
+             "drifted by more than this many nibbles RMS from it (default: 0, only when it "
+             "changes)")
+    parser.add_argument('--max-waves', type=parse_max_waves, default='fit',
+        help="limit the number of distinct waves to N by merging similar ones; 'fit' (the "
+             "default) does this only when needed to fit in %d bytes, and 'off' never does" % MAX_MOD_DATA)
+    parser.add_argument('--banks', type=parse_banks, default=1, metavar='N',
+        help="spread the samples over up to N banks of cart data (1 to %d) when they don't fit "
+             "in one, each with a copy of the patterns, and have the player switch banks with "
+             "sync() as it plays them (default: 1)" % MAX_BANKS)
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+        help="override an analysis parameter (see analysisparams.AnalysisParams); may be repeated")
+    parser.add_argument('--player', choices=['sequencer', 'stream'], default='sequencer',
+        help="'sequencer' plays the patterns and sample frames, working out the sound "
+             "registers each frame; 'stream' works them all out at build time and plays "
+             "them from a compressed register stream, leaving almost all of each frame to "
+             "the visualisers, if the stream fits in %d bytes (default: sequencer)" % MAX_MOD_DATA)
+    parser.add_argument('--visualisers', type=parse_visualisers, metavar='NAME,...',
+        help="visualisers to include, from %s (default: all)" % ", ".join(VISUALISERS))
+    parser.add_argument('--visualiser-budget', type=int, metavar='N',
+        help="leave out visualisers that take more than N Lua instructions per frame, as "
+             "measured by playercost.py, to keep playback at 60fps on slower machines "
+             "(default: no limit)")
+    parser.add_argument('--metrics', action='store_true',
+        help="measure conversion quality against the original samples, writing the results "
+             "as JSON alongside each cart (as NAME.metrics.json)")
+    parser.add_argument('--incremental', action='store_true',
+        help="keep a manifest of what each cart was built from (as NAME.manifest.json), and "
+             "only rebuild the parts of an existing cart whose inputs have changed")
+    parser.add_argument('--profile', action='store_true',
+        help="report time spent in each stage and counts of analysis events, overall and per sample")
+    parser.add_argument('--profile-output', metavar='FILE',
+        help="write the profile as JSON to FILE (implies --profile)")
+    parser.add_argument('--trace', metavar='FILE',
+        help="write a Chrome trace of every stage to FILE, for chrome://tracing or Perfetto "
+             "(implies --profile)")
+    parser.add_argument('--cache-dir',
+        help="directory for cached sample conversions (default: %s)" % default_cache_dir())
+    parser.add_argument('--cache-size', type=int, default=64,
+        help="maximum size of the conversion cache in megabytes (default: 64)")
+    parser.add_argument('--no-cache', action='store_true',
+        help="always convert samples from scratch, without reading or writing the cache")
+    args = parser.parse_args()
+    jobs = max(1, args.jobs)
+    try:
+        params = AnalysisParams.parse(args.param)
+    except ValueError as e:
+        parser.error(str(e))
+    if params.frame_rate != FRAME_RATE:
+        parser.error("the player plays %d frames per second, so frame_rate can't be changed" % FRAME_RATE)
+    options = {
+        'params': params,
+        'wave_layout': args.wave_layout,
+        'max_waves': args.max_waves,
+        'keyframe_threshold': args.keyframe_threshold,
+        'banks': args.banks,
+        'metrics': args.metrics,
+        'player': args.player,
+        'visualisers': args.visualisers,
+        'visualiser_budget': args.visualiser_budget,
+    }
+
+    prof = None
+    if args.profile or args.profile_output or args.trace:
+        prof = Profiler(trace=bool(args.trace))
+        set_profiler(prof)
+
+    cache = None
+    if not args.no_cache:
+        cache = WavetableCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+
+    build_jobs = find_jobs(args.inputs or [DEFAULT_INPUT], args.output_dir)
+    if not build_jobs:
+        parser.error("no MOD files found")
+    if args.output and len(build_jobs) > 1:
+        parser.error("--output can only be used with a single input file")
+    for (output_filename, names) in duplicate_outputs(build_jobs).items():
+        parser.error("%s would all be built to %s" % (", ".join(names), output_filename))
+
+    if len(build_jobs) == 1:
+        mod_filename, output_filename = build_jobs[0]
+        if args.output:
+            output_filename = args.output
+        elif not args.inputs:
+            output_filename = os.path.join(args.output_dir, DEFAULT_OUTPUT)
+        if os.path.dirname(output_filename):
+            os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+        result = build_one(mod_filename, output_filename, jobs, cache, options, args.incremental)
+        if result['error']:
+            print("%s: %s" % (result['input'], describe_result(result)), file=sys.stderr)
+            sys.exit(1)
+        print("Mod data: %s" % describe_result(result))
+        print("Patterns: %d of %d played, packed into %d bytes (%d bytes unpacked)" % (
+            result['patterns_used'], result['pattern_count'], result['pattern_data_size'],
+            result['unpacked_pattern_size']
+        ))
+        print("Wave dedup: %d frames, %d distinct waves, %d bytes saved (using %s layout)" % (
+            result['frame_count'], result['unique_waves'], result['dedup_saving'], result['wave_layout']
+        ))
+        if result['keyframe_stats'] is not None:
+            stats = result['keyframe_stats']
+            print("Keyframes: %d frames in %d bytes (%.1fx smaller than raw frames); per sample: %s" % (
+                sum(s['frames'] for s in stats), sum(s['bytes'] for s in stats),
+                sum(s['ratio'] * s['bytes'] for s in stats) / max(1, sum(s['bytes'] for s in stats)),
+                ", ".join("%d %.1fx" % (s['sample'], s['ratio']) for s in stats)
+            ))
+        if result['quantise_error'] is not None:
+            print("Wave quantisation: %d distinct waves merged into %d (%d bytes saved), RMS error %.3f nibbles" % (
+                result['unique_waves'], result['quantised_waves'],
+                result['quantise_saving'], result['quantise_error']
+            ))
+        if result['player'] == 'stream':
+            print("Register stream: %d bytes for %d ticks (%d bytes as raw registers), looping to tick %d; "
+                  "%d bytes of pattern and wavetable data with the sequencer player" % (
+                result['stream_size'], result['stream_ticks'], result['stream_raw_size'],
+                result['stream_loop_tick'], result['mod_data_size']
+            ))
+        if len(result['bank_sizes']) > 1:
+            for (bank, (size, samples)) in enumerate(zip(result['bank_sizes'], result['bank_samples'])):
+                print("Bank %d: %d bytes (%d%%), samples %s" % (
+                    bank, size, 100 * size / MAX_MOD_DATA, ", ".join(str(i) for i in samples) or "none"
+                ))
+            print("Bank switches: %.2f per row on average" % result['bank_switches'])
+        print("Visualisers: %s" % (", ".join(result['visualisers']) or "none"))
+        if cache is not None:
+            print(cache.report())
+        write_profile(prof, args.profile_output, args.trace)
+        return
+
+    for output_dir in set(os.path.dirname(output_filename) for (mod_filename, output_filename) in build_jobs):
+        os.makedirs(output_dir or '.', exist_ok=True)
+    results = build_batch(build_jobs, jobs, cache, options, args.incremental)
+    print_summary(results, args.output_dir)
+    if cache is not None:
+        print("Wavetable cache: %d hits, %d misses (%s)" % (
+            sum(r.get('cache_hits', 0) for r in results),
+            sum(r.get('cache_misses', 0) for r in results),
+            cache.path,
+        ))
+    write_profile(prof, args.profile_output, args.trace)
+    if any(r['error'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
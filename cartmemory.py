@@ -0,0 +1,19 @@
+# Each bank of cart data fills TILES, SPRITES and MAP, which TIC-80 has at 0x4000 in RAM,
+# and sync(mask, bank) copies the sections picked by mask in from another bank
+SECTIONS = [  # (sync mask bit, bytes)
+    (1, 0x2000),  # TILES
+    (2, 0x2000),  # SPRITES
+    (4, 0x7f80),  # MAP
+]
+BANK_SIZE = sum(size for (bit, size) in SECTIONS)
+MAX_BANKS = 8
+
+
+def sync_mask(size):
+    # the sections that data of the given size from the start of a bank spans
+    mask = 0
+    for (bit, section_size) in SECTIONS:
+        if size > 0:
+            mask |= bit
+        size -= section_size
+    return mask
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+import tempfile
+
+MANIFEST_VERSION = 8
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def manifest_filename_for(output_filename):
+    return os.path.splitext(output_filename)[0] + '.manifest.json'
+
+
+class BuildManifest:
+    # What went into a cart, for incremental builds: hashes of the inputs that each
+    # part of the cart depends on ('mod' for the MOD file, 'data' for the options that
+    # affect the mod data, 'template' for the player code), along with the layout
+    # details the player code is generated from and the build's result summary, so that
+    # the code can be regenerated without converting the samples again.
+    def __init__(self, keys, program, positions, result):
+        self.keys = keys
+        self.program = program
+        self.positions = positions
+        self.result = result
+
+    @staticmethod
+    def load(filename):
+        # the manifest in filename, or None if there isn't a usable one
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get('version') != MANIFEST_VERSION:
+            return None
+        return BuildManifest(data['keys'], data['program'], data['positions'], data['result'])
+
+    def save(self, filename):
+        directory = os.path.dirname(filename) or '.'
+        fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'version': MANIFEST_VERSION,
+                'keys': self.keys,
+                'program': self.program,
+                'positions': self.positions,
+                'result': self.result,
+            }, f, indent=2)
+        os.replace(tmp_filename, filename)
+
+    def stale_parts(self, keys):
+        # the parts of the cart ('code' and/or 'data') that the changed keys invalidate;
+        # the player code depends on the layout of the mod data, so stale data means stale code
+        if self.keys.get('mod') != keys['mod'] or self.keys.get('data') != keys['data']:
+            return {'code', 'data'}
+        if self.keys.get('template') != keys['template']:
+            return {'code'}
+        return set()
@@ -0,0 +1,149 @@
+import argparse
+import json
+import sys
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from synth import Synth
+from wavetable import FRAME_RATE, decode_sample
+
+
+def resynthesise(table, samplerate, frame_rate=FRAME_RATE):
+    # Play a FrameTable back at the sample's own rate, inverting the nibble and amplitude
+    # scaling of make_frame; all-zero waves with nonzero amplitude play as noise
+    noisy = ~table.waves.any(axis=1) & (table.amplitudes > 0)
+    levels = (table.waves.astype(float) - 8) / 7
+    amplitudes = np.where(noisy, table.amplitudes / 11, table.amplitudes / 16)
+    synth = Synth(samplerate, channel_count=1, tick_rate=frame_rate)
+    return synth.render_levels(
+        table.frequencies[:, None].astype(float), amplitudes[:, None], levels[:, None, :], noisy[:, None]
+    )
+
+
+def frame_spectra(signal, hop):
+    # log power spectrum (dB) of each hop-sized frame, Hann windowed
+    frames = sliding_window_view(signal, hop)[::hop]
+    spectra = np.abs(np.fft.rfft(frames * np.hanning(hop), axis=1)) ** 2
+    return 10 * np.log10(spectra + 1e-10)
+
+
+def aligned_energies(original, resynthesised, hop):
+    # Energies of the original and of its difference from the resynthesis over the whole
+    # hop-sized frames of the original. The resynthesis starts each frame's wave at a
+    # phase unrelated to the original's, so each frame of it is first shifted by up to a
+    # hop either way to where it differs least from the original.
+    frame_count = len(original) // hop
+    if frame_count == 0:
+        return 0.0, 0.0
+    originals = original[:frame_count * hop].reshape(frame_count, hop)
+    padding = np.zeros(hop)
+    padded = np.concatenate([padding, resynthesised[:frame_count * hop], padding])
+    # frame k of the original against the resynthesis from hop k-1 to hop k+2
+    windows = sliding_window_view(padded, 3 * hop)[::hop][:frame_count]
+    size = 4 * hop
+    correlations = np.fft.irfft(
+        np.fft.rfft(windows, size) * np.conj(np.fft.rfft(originals, size)), size
+    )[:, :2 * hop + 1]
+    cumulative = np.concatenate([np.zeros((frame_count, 1)), np.cumsum(windows ** 2, axis=1)], axis=1)
+    shifted_energies = cumulative[:, hop:] - cumulative[:, :2 * hop + 1]
+    original_energies = np.sum(originals ** 2, axis=1)
+    errors = original_energies[:, None] + shifted_energies - 2 * correlations
+    return float(original_energies.sum()), float(np.maximum(errors.min(axis=1), 0).sum())
+
+
+def finite_or_none(value):
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def sample_metrics(data, table, samplerate, frame_rate=FRAME_RATE):
+    # Compare a converted sample against the original sample data. Returns a dict with
+    # the raw sums needed to combine samples as well as the metrics themselves.
+    original = decode_sample(data)
+    resynthesised = resynthesise(table, samplerate, frame_rate)
+    length = min(len(original), len(resynthesised))
+    original = original[:length]
+    resynthesised = resynthesised[:length]
+    hop = int(samplerate // frame_rate)
+
+    signal_energy, error_energy = aligned_energies(original, resynthesised, hop)
+    if length >= hop:
+        distances = np.sqrt(np.mean(
+            (frame_spectra(original, hop) - frame_spectra(resynthesised, hop)) ** 2, axis=1
+        ))
+    else:
+        distances = np.empty(0)
+    noise_frames = int(np.count_nonzero(~table.waves.any(axis=1) & (table.amplitudes > 0)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = 10 * np.log10(signal_energy / error_energy)
+    return {
+        'frames': len(table),
+        'noise_frames': noise_frames,
+        'noise_fraction': finite_or_none(noise_frames / len(table)) if len(table) else None,
+        'snr_db': finite_or_none(snr),
+        'log_spectral_distance_db': finite_or_none(distances.mean()) if len(distances) else None,
+        'signal_energy': signal_energy,
+        'error_energy': error_energy,
+        'spectral_distance_sum': float(distances.sum()),
+        'spectral_frames': len(distances),
+    }
+
+
+def module_metrics(mod, wavetables, base_freqs, frame_rate=FRAME_RATE):
+    # Per-sample metrics for every non-empty sample, plus totals for the module
+    samples = []
+    for (i, (sample, table)) in enumerate(zip(mod.samples, wavetables)):
+        if sample.length == 0 or len(table) == 0:
+            continue
+        metrics = sample_metrics(sample.data, table, base_freqs[i], frame_rate)
+        metrics['sample'] = i + 1
+        metrics['name'] = sample.name
+        samples.append(metrics)
+
+    signal_energy = sum(s['signal_energy'] for s in samples)
+    error_energy = sum(s['error_energy'] for s in samples)
+    frames = sum(s['frames'] for s in samples)
+    noise_frames = sum(s['noise_frames'] for s in samples)
+    spectral_frames = sum(s['spectral_frames'] for s in samples)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = 10 * np.log10(signal_energy / error_energy) if samples else np.nan
+    return {
+        'title': mod.title.rstrip('\x00 '),
+        'frames': frames,
+        'noise_fraction': noise_frames / frames if frames else None,
+        'snr_db': finite_or_none(snr),
+        'log_spectral_distance_db': (
+            sum(s['spectral_distance_sum'] for s in samples) / spectral_frames if spectral_frames else None
+        ),
+        'samples': samples,
+    }
+
+
+def main():
+    from build import parse_max_waves
+    from moddata import build_mod_data
+    from modfile import ModFile
+
+    parser = argparse.ArgumentParser(
+        description="Measure how closely the converted samples of a .mod file match the originals"
+    )
+    parser.add_argument('input', help="MOD file")
+    parser.add_argument('-o', '--output', help="JSON file to write (default: standard output)")
+    parser.add_argument('--max-waves', type=parse_max_waves, default='fit',
+        help="wave limit, as for build.py")
+    args = parser.parse_args()
+
+    mod = ModFile.open(args.input)
+    layout = build_mod_data(mod, max_waves=args.max_waves, metrics=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(layout['metrics'], f, indent=2)
+    else:
+        json.dump(layout['metrics'], sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
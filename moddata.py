@@ -0,0 +1,334 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from modfile import PERIODS
+from wavetable import convert_sample, FrameTable, FRAME_SIZE, DEFAULT_PARAMS
+from patterncodec import encode_patterns, decode_patterns
+from wavecodec import (
+    WaveDictionary, encode_frame_refs, encode_keyframes, keyframe_waves, quantise_wavetables, FRAME_REF_SIZE,
+    WAVE_SIZE, HOLD, KEYFRAME_RUN_LENGTH,
+)
+from metrics import module_metrics
+from profiling import profiler, run_profiled
+from banks import mean_bank_switches, plan_banks, sample_overlaps, song_samples
+from cartmemory import BANK_SIZE
+
+
+def get_note_histograms(mod):
+    # (256, notes) array counting how often each sample number plays each note
+    cells = mod.pattern_array.reshape(-1)
+    cells = cells[cells['note'] >= 0]
+    note_count = len(PERIODS)
+    histograms = np.bincount(
+        cells['sample'].astype(np.intp) * note_count + cells['note'], minlength=256 * note_count
+    )
+    return histograms.reshape(256, note_count)
+
+
+def get_average_notes(mod):
+    # determine the average pitch used for each sample
+    histograms = get_note_histograms(mod)[1:len(mod.samples) + 1]
+    note_counts = histograms.sum(axis=1).tolist()
+    pitch_sums = (histograms @ np.arange(histograms.shape[1])).tolist()
+
+    avg_notes_by_sample = {}
+    for i in range(0, len(mod.samples)):
+        if note_counts[i]:
+            avg_notes_by_sample[i] = int(pitch_sums[i] / note_counts[i])
+        else:
+            avg_notes_by_sample[i] = 29
+    return avg_notes_by_sample
+
+
+def get_base_freq(base_note):
+    return 11084 * 2**((base_note - 29)/12)
+
+
+def convert_sample_profiled(trace, label, data, samplerate, params=DEFAULT_PARAMS):
+    # convert_sample in a worker process, returning the wavetable and the worker's profile
+    def convert():
+        with profiler().for_sample(label), profiler().stage('convert'):
+            return convert_sample(data, samplerate, params)
+    return run_profiled(trace, convert)
+
+
+def convert_samples(mod, base_notes, jobs=1, cache=None, params=DEFAULT_PARAMS):
+    # Samples are independent, so convert them in a process pool. Workers are sent the
+    # raw sample bytes, and results come back in sample order.
+    prof = profiler()
+    wavetables = [FrameTable.empty() for sample in mod.samples]
+    tasks = []
+    for (i, sample) in enumerate(mod.samples):
+        if sample.length == 0:
+            continue
+        data = bytes(sample.data)
+        base_freq = get_base_freq(base_notes[i])
+        key = None
+        if cache is not None:
+            key = cache.key(data, base_freq, params)
+            wavetable = cache.get(key)
+            with prof.for_sample(i + 1):
+                prof.count('cache_hits' if wavetable is not None else 'cache_misses')
+            if wavetable is not None:
+                wavetables[i] = wavetable
+                continue
+        tasks.append((i, data, base_freq, key))
+
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+            if prof.enabled:
+                # workers profile themselves, and their results are merged in here
+                futures = [
+                    pool.submit(convert_sample_profiled, prof.trace, prof.sample_label(i + 1), data, base_freq, params)
+                    for (i, data, base_freq, key) in tasks
+                ]
+                results = []
+                for future in futures:
+                    wavetable, profile = future.result()
+                    prof.merge(profile)
+                    results.append(wavetable)
+            else:
+                results = list(pool.map(
+                    convert_sample,
+                    [data for (i, data, base_freq, key) in tasks],
+                    [base_freq for (i, data, base_freq, key) in tasks],
+                    [params] * len(tasks),
+                ))
+    else:
+        results = []
+        for (i, data, base_freq, key) in tasks:
+            with prof.for_sample(i + 1), prof.stage('convert'):
+                results.append(convert_sample(data, base_freq, params))
+
+    for ((i, data, base_freq, key), wavetable) in zip(tasks, results):
+        wavetables[i] = wavetable
+        if cache is not None:
+            cache.put(key, wavetable)
+    return wavetables
+
+
+def build_mod_data(
+    mod, jobs=1, cache=None, wave_layout='auto', max_waves='fit', metrics=False,
+    params=DEFAULT_PARAMS, wavetables=None, keyframe_threshold=0.0, banks=1
+):
+    # Lays out pattern data (packed by patterncodec.encode_patterns, leaving out patterns
+    # the song never plays, with the positions renumbered to match), then (for the 'dedup'
+    # and 'keyframe' wave layouts) the dictionary of distinct waves that the frames refer
+    # to, then per-frame data for each sample.
+    # With banks > 1, samples that don't fit in one bank (BANK_SIZE) are spread over up to that
+    # many banks (see banks.plan_banks), each with a copy of the pattern data and its own
+    # wave dictionary; otherwise, everything goes in one, which may be too large.
+    # 'raw' stores each frame's wave inline, 'dedup' refers to a wave for each frame and
+    # 'keyframe' stores runs of frames that share a wave or hold the same registers (see
+    # wavecodec.encode_keyframes); 'auto' picks whichever is smallest. For 'keyframe',
+    # waves that have drifted by no more than keyframe_threshold RMS nibbles since the
+    # last keyframe are replaced by its wave (see wavecodec.keyframe_waves).
+    # max_waves limits the number of distinct waves by clustering similar ones; with
+    # 'fit' this is only done if needed, to the largest number that fits the banks.
+    # With metrics=True, the result includes quality metrics for the converted samples.
+    # Samples are converted with the given AnalysisParams, unless already converted
+    # ones are passed as wavetables.
+    prof = profiler()
+    with prof.stage('pitch'):
+        avg_notes_by_sample = get_average_notes(mod)
+    if wavetables is None:
+        with prof.stage('convert_samples'):
+            wavetables = convert_samples(mod, avg_notes_by_sample, jobs, cache, params)
+    with prof.stage('patterns'):
+        pattern_data, pattern_offsets, positions = encode_patterns(
+            mod.pattern_array, mod.positions[:mod.position_count], len(mod.samples)
+        )
+
+    # the frame each sample repeats from, and the number of frames it repeats
+    repeats = []
+    for (i, sample) in enumerate(mod.samples):
+        block_size = get_base_freq(avg_notes_by_sample[i]) // params.frame_rate
+        repeats.append((int(sample.repeat_from / block_size), int(sample.repeat_length / block_size)))
+
+    if wave_layout == 'keyframe' and keyframe_threshold > 0:
+        with prof.stage('keyframes'):
+            wavetables = [
+                keyframe_waves(wavetable, keyframe_threshold, [repeat_from])[0]
+                for (wavetable, (repeat_from, repeat_length)) in zip(wavetables, repeats)
+            ]
+
+    def encode_waves(wavetables):
+        # the dictionary of distinct waves, each frame's index in it, and the keyframe
+        # runs of each sample
+        with prof.stage('dedup'):
+            dictionary = WaveDictionary()
+            wave_indices = [dictionary.add(wavetable.packed_waves()) for wavetable in wavetables]
+        with prof.stage('keyframes'):
+            runs = [
+                encode_keyframes(wavetable, indices, [repeat_from])
+                for (wavetable, indices, (repeat_from, repeat_length)) in zip(wavetables, wave_indices, repeats)
+            ]
+        return dictionary, wave_indices, runs
+
+    frame_count = sum(len(wavetable) for wavetable in wavetables)
+    raw_size = frame_count * FRAME_SIZE
+    dictionary, wave_indices, runs = encode_waves(wavetables)
+    distinct_waves = len(dictionary)
+    dedup_size = frame_count * FRAME_REF_SIZE + len(dictionary) * WAVE_SIZE
+    dedup_saving = raw_size - dedup_size
+
+    def keyframe_size(runs):
+        return sum(len(data) for (data, offsets) in runs) + 1
+
+    # every bank starts with the pattern data
+    capacity = BANK_SIZE - len(pattern_data)
+    quantise_error = None
+    if max_waves == 'fit':
+        sizes = (raw_size, dedup_size, keyframe_size(runs) + len(dictionary) * WAVE_SIZE)
+        if min(sizes) > capacity * banks:
+            frame_data_size = keyframe_size(runs) if wave_layout == 'keyframe' else frame_count * FRAME_REF_SIZE
+            max_waves = (capacity * banks - frame_data_size) // WAVE_SIZE
+        else:
+            max_waves = None
+    if max_waves is not None and max_waves < len(dictionary):
+        try:
+            with prof.stage('quantise'):
+                wavetables, quantise_error = quantise_wavetables(wavetables, max_waves)
+        except ValueError:
+            pass  # the frames alone don't fit
+        else:
+            dictionary, wave_indices, runs = encode_waves(wavetables)
+            dedup_size = frame_count * FRAME_REF_SIZE + len(dictionary) * WAVE_SIZE
+            if wave_layout != 'keyframe':
+                wave_layout = 'dedup'
+
+    if wave_layout == 'auto':
+        sizes = {'raw': raw_size, 'dedup': dedup_size, 'keyframe': keyframe_size(runs) + len(dictionary) * WAVE_SIZE}
+        wave_layout = min(sizes, key=sizes.get)
+    frame_size = {'raw': FRAME_SIZE, 'dedup': FRAME_REF_SIZE, 'keyframe': None}[wave_layout]
+
+    bank_samples = [list(range(len(mod.samples)))]
+    bank_switches = 0.0
+    if banks > 1:
+        with prof.stage('banks'):
+            if wave_layout == 'keyframe':
+                sample_sizes = [len(data) for (data, offsets) in runs]
+                capacity -= 1  # for the hold at the end of the frames
+            else:
+                sample_sizes = [len(wavetable) * frame_size for wavetable in wavetables]
+            sample_waves = [set() if wave_layout == 'raw' else set(indices.tolist()) for indices in wave_indices]
+            samples = song_samples(decode_patterns(pattern_data, pattern_offsets), positions)
+            bank_samples = plan_banks(
+                sample_sizes, sample_waves, WAVE_SIZE, capacity, sample_overlaps(samples, len(mod.samples)), banks
+            )
+            bank_switches = mean_bank_switches(samples, bank_samples)
+
+    with prof.stage('packed_data'):
+        bank_layouts = [
+            lay_out_bank(pattern_data, wavetables, samples, wave_layout, repeats) for samples in bank_samples
+        ]
+
+    sample_meta = [None] * len(mod.samples)
+    first_frame = 0
+    for (bank, (bank_layout, offsets)) in enumerate(bank_layouts):
+        for i in bank_layout['samples']:
+            (start, repeat_offset, size) = offsets[i]
+            sample_meta[i] = {
+                'bank': bank,
+                'start': start,
+                'length': len(wavetables[i]),
+                'repeat_from': start + repeat_offset,
+                'repeat_length': repeats[i][1],
+                'base_note': avg_notes_by_sample[i],
+                # frame numbers within the frames of all the banks, in order
+                'first_frame': first_frame,
+                'repeat_frame': first_frame + repeats[i][0],
+            }
+            first_frame += len(wavetables[i])
+        if wave_layout == 'keyframe':
+            first_frame += KEYFRAME_RUN_LENGTH  # the frames of the hold after the bank's samples
+
+    keyframe_stats = None
+    if wave_layout == 'keyframe':
+        sample_bytes = {
+            i: size for (bank_layout, offsets) in bank_layouts for (i, (start, repeat, size)) in offsets.items()
+        }
+        keyframe_stats = [
+            {
+                'sample': i + 1, 'frames': len(wavetables[i]), 'bytes': sample_bytes[i],
+                # against storing each frame in full
+                'ratio': len(wavetables[i]) * FRAME_SIZE / sample_bytes[i],
+            }
+            for i in range(len(mod.samples)) if len(wavetables[i])
+        ]
+
+    if metrics:
+        with prof.stage('metrics'):
+            metrics = module_metrics(
+                mod, wavetables, [get_base_freq(avg_notes_by_sample[i]) for i in range(len(mod.samples))],
+                params.frame_rate
+            )
+    else:
+        metrics = None
+
+    return {
+        'sample_meta': sample_meta,
+        'pattern_data': pattern_data,
+        'pattern_offsets': pattern_offsets,
+        'positions': positions,
+        'pattern_count': mod.pattern_count,
+        'banks': [bank_layout for (bank_layout, offsets) in bank_layouts],
+        'bank_switches': bank_switches,
+        'wave_layout': wave_layout,
+        'frame_size': frame_size,
+        'frame_count': frame_count,
+        'unique_waves': distinct_waves,
+        'dedup_saving': dedup_saving,
+        'quantised_waves': len(dictionary) if quantise_error is not None else None,
+        'quantise_error': quantise_error,
+        'keyframe_stats': keyframe_stats,
+        'semitone_shifts': get_semitone_shifts(decode_patterns(pattern_data, pattern_offsets), sample_meta),
+        'mod_data': b''.join(bank_layout['data'] for (bank_layout, offsets) in bank_layouts),
+        'metrics': metrics,
+    }
+
+
+def lay_out_bank(pattern_data, wavetables, samples, wave_layout, repeats):
+    # One bank of mod data, holding the frames of the given samples (0-based), as a dict
+    # of the samples and its bytes ('data'): the pattern data, then the dictionary of the
+    # waves those samples use ('wave_data', empty for the 'raw' layout), then the samples'
+    # frames ('frame_data'). Also returns the (start, repeat point, size) of each sample's
+    # frames, as byte offsets within frame_data and from the sample's start.
+    dictionary = WaveDictionary()
+    frame_data = []
+    offsets = {}
+    start = 0
+    for i in samples:
+        table = wavetables[i]
+        repeat_from = repeats[i][0]
+        if wave_layout == 'raw':
+            data = bytes(table.packed_data())
+            repeat_offset = repeat_from * FRAME_SIZE
+        elif wave_layout == 'dedup':
+            data = encode_frame_refs(table, dictionary.add(table.packed_waves())).tobytes()
+            repeat_offset = repeat_from * FRAME_REF_SIZE
+        else:
+            data, frame_offsets = encode_keyframes(table, dictionary.add(table.packed_waves()), [repeat_from])
+            repeat_offset = int(frame_offsets[repeat_from]) if repeat_from < len(table) else len(data)
+        offsets[i] = (start, repeat_offset, len(data))
+        frame_data.append(data)
+        start += len(data)
+    if wave_layout == 'keyframe':
+        # a hold after the last sample, for repeats that run past its frames to play
+        frame_data.append(bytes([HOLD | (KEYFRAME_RUN_LENGTH - 1)]))
+    frame_data = b''.join(frame_data)
+    wave_data = dictionary.packed_data()
+    return {
+        'samples': list(samples),
+        'wave_data': wave_data,
+        'frame_data': frame_data,
+        'data': pattern_data + wave_data + frame_data,
+    }, offsets
+
+
+def get_semitone_shifts(patterns, sample_meta):
+    # distinct shifts between the notes played (in an array from
+    # patterncodec.decode_patterns) and the native notes of their samples
+    cells = patterns.reshape(-1, 4)
+    cells = cells[(cells[:, 0] != 255) & (cells[:, 1] >= 1) & (cells[:, 1] <= len(sample_meta))]
+    base_notes = np.array([s['base_note'] for s in sample_meta], dtype=int)
+    return sorted(set((cells[:, 0].astype(int) - base_notes[cells[:, 1].astype(int) - 1]).tolist()))
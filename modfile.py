@@ -1,3 +1,57 @@
+import mmap
+
+import numpy as np
+
+
+NOTELIST = ["C-", "C#", "D-", "D#", "E-", "F-", "F#", "G-", "G#", "A-", "A#", "B-"]
+PERIODS = [1712,1616,1525,1440,1357,1281,1209,1141,1077,1017, 961, 907,
+        856, 808, 762, 720, 678, 640, 604, 570, 538, 508, 480, 453,
+        428, 404, 381, 360, 339, 320, 302, 285, 269, 254, 240, 226,
+        214, 202, 190, 180, 170, 160, 151, 143, 135, 127, 120, 113,
+        107, 101,  95,  90,  85,  80,  76,  71,  67,  64,  60,  57,
+]
+
+# note number for every possible 12-bit period, or -1 for periods that are not a note
+PERIOD_NOTES = np.full(4096, -1, dtype=np.int16)
+PERIOD_NOTES[PERIODS] = np.arange(len(PERIODS))
+
+CELL_DTYPE = np.dtype([('note', np.int16), ('sample', np.uint8), ('effect', np.uint8), ('param', np.uint8)])
+
+
+class UnsupportedModError(ValueError):
+    # raised for MOD variants the player can't play
+    pass
+
+
+def period_notenr(period):
+    # note number of a period, or -1 if it isn't a note (including periods too large for
+    # the 12 bits a pattern cell holds)
+    return int(PERIOD_NOTES[period]) if 0 <= period < len(PERIOD_NOTES) else -1
+
+
+def period2note(period):
+    notenr = period_notenr(period)
+    if notenr >= 0:
+        return NOTELIST[notenr % 12] + str(notenr // 12)
+    else:
+        return "---"
+
+
+def period2notenum(period):
+    notenr = period_notenr(period)
+    return None if notenr < 0 else notenr
+
+
+def decode_cells(cells):
+    # split an array of raw 4-byte pattern cells (last axis) into a structured array
+    # of note number (-1 for none), sample number, effect and effect parameter
+    decoded = np.empty(cells.shape[:-1], dtype=CELL_DTYPE)
+    decoded['sample'] = (cells[..., 0] & 0xf0) | (cells[..., 2] >> 4)
+    decoded['note'] = PERIOD_NOTES[((cells[..., 0].astype(np.uint16) & 0x0f) << 8) | cells[..., 1]]
+    decoded['effect'] = cells[..., 2] & 0x0f
+    decoded['param'] = cells[..., 3]
+    return decoded
+
 
 def nibbles(bt):
     h = bt >> 4
@@ -32,6 +86,20 @@ class Sample:
         self.volume = volume
         self.repeat_from = repeat_from
         self.repeat_length = repeat_length
+        self.offset = None
+        self._source = None
+        self._data = None
+
+    @property
+    def data(self):
+        # samples from a lazily loaded file are sliced out of the mapped file on first access
+        if self._data is None and self._source is not None:
+            self._data = memoryview(self._source)[self.offset:self.offset+self.length]
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
 
     def __repr__(self):
         return "<Sample: %r>" % self.name
@@ -39,13 +107,20 @@ class Sample:
 
 class ModFile:
     @staticmethod
-    def open(filename):
+    def open(filename, lazy=False):
+        # With lazy=True the file is memory-mapped and only the header and sample table
+        # are parsed up front; patterns are decoded, and sample data exposed as
+        # memoryviews into the mapping, on first access.
         with open(filename, 'rb') as fh:
-            f=fh.read()
-            barr=bytearray(f)
-        return ModFile(barr)
+            if lazy:
+                barr=mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                f=fh.read()
+                barr=bytearray(f)
+        return ModFile(barr, lazy=lazy)
 
-    def __init__(self, barr):
+    def __init__(self, barr, lazy=False):
+        self._buffer = barr
         samples = []
 
         #https://wiki.multimedia.cx/index.php/Protracker_Module
@@ -113,7 +188,7 @@ class ModFile:
         if d: print (format,"format detected: "+formdesc)
         if not compatible:
             errmsg="Format "+format+" ("+formdesc+") is not supported!"
-            raise ValueError(errmsg)
+            raise UnsupportedModError(errmsg)
 
         songtitle=barr[0:20].decode("utf-8")
 
@@ -141,7 +216,7 @@ class ModFile:
         offset=offset+1
         dummy127=barr[offset]
         offset=offset+1
-        pattern_table=barr[offset:offset+128]
+        pattern_table=bytearray(barr[offset:offset+128])  # a copy, and the same type for mmaps
         offset=offset+128
         if d: print ("offset:",offset)
         if not format == "STK.":# Only other format then Ultimate Soundtracker have bytes to specify format
@@ -163,59 +238,82 @@ class ModFile:
         pattern_table=pattern_table[:nr_playedpatterns]
         if d: print ("nr patterns stored: ",nr_patterns_stored)
 
-        notelist = ["C-", "C#", "D-", "D#", "E-", "F-", "F#", "G-", "G#", "A-", "A#", "B-"]
-        periods=[1712,1616,1525,1440,1357,1281,1209,1141,1077,1017, 961, 907,
-                856, 808, 762, 720, 678, 640, 604, 570, 538, 508, 480, 453,
-                428, 404, 381, 360, 339, 320, 302, 285, 269, 254, 240, 226,
-                214, 202, 190, 180, 170, 160, 151, 143, 135, 127, 120, 113,
-                107, 101,  95,  90,  85,  80,  76,  71,  67,  64,  60,  57,
-        ]
-        def period2note(period):
-            notenr=-1
-            for nr,val in enumerate(periods):
-                if val==period:
-                    notenr=nr % 12
-                    oct=nr//12
-            if notenr>=0:
-                note=notelist[notenr]+str(oct)
+        self.title = songtitle
+        self.format = format
+        self.samples = samples
+        self.positions = pattern_table
+        self.position_count = nr_playedpatterns
+        self.pattern_count = nr_patterns_stored
+        self.channel_count = nr_channels
+
+        self.pattern_offset = offset
+        self._pattern_data = None
+        self._pattern_array = None
+        self._patterns = None
+        offset += nr_patterns_stored * 64 * nr_channels * 4
+
+        for sample in self.samples:
+            sample.offset = offset
+            if lazy:
+                sample._source = barr
             else:
-                note="---"
-            return note
+                sample.data = barr[offset:offset+sample.length]
+            offset += sample.length
 
-        def period2notenum(period):
-            for nr,val in enumerate(periods):
-                if val==period:
-                    return nr
-            return None
+        if not lazy:
+            if d: print("---patterns---")
+            self._pattern_array = decode_cells(self.pattern_data)
 
-        if d: print("---patterns---")
-        patterns = []
-        for pattern in range (0,nr_patterns_stored):
-            pattern=[]
-            if d: print (len(patterns),": offset ",offset)
-            for row in range (0,64):
-                row=[]
-                for channel in range (0,nr_channels):
-                    bytes=barr[offset:offset+4]
-
-                    samplenr = (bytes[0] & 0xf0) | (bytes[2] >> 4)
-                    noteperiod = ((bytes[0] & 0x0f) << 8) | bytes[1]
-                    effect = bytes[2] & 0x0f
-                    param = bytes[3]
-
-                    note=period2notenum(noteperiod)
-                    row.append((note, samplenr, effect, param))
-                    offset=offset+4
-                pattern.append(row)
-            patterns.append(pattern)
-
-            self.title = songtitle
-            self.format = format
-            self.samples = samples
-            self.patterns = patterns
-            self.positions = pattern_table
-            self.position_count = nr_playedpatterns
+    @property
+    def pattern_data(self):
+        # each cell is 4 bytes; view the whole pattern block as (patterns, rows, channels, 4)
+        if self._pattern_data is None:
+            self._pattern_data = np.frombuffer(
+                self._buffer, dtype=np.uint8,
+                count=self.pattern_count * 64 * self.channel_count * 4, offset=self.pattern_offset
+            ).reshape(self.pattern_count, 64, self.channel_count, 4)
+        return self._pattern_data
 
+    @property
+    def pattern_array(self):
+        if self._pattern_array is None:
+            self._pattern_array = decode_cells(self.pattern_data)
+        return self._pattern_array
+
+    def close(self):
+        # Release the memory mapping of a lazily loaded file, after dropping this file's
+        # own views of it. Raises BufferError, leaving the mapping open, if sample data or
+        # pattern views are still referenced elsewhere.
+        self._pattern_data = None
         for sample in self.samples:
-            sample.data = barr[offset:offset+sample.length]
-            offset += sample.length
+            if sample._source is not None:
+                sample._source = None
+                sample._data = None
+        if isinstance(self._buffer, mmap.mmap) and not self._buffer.closed:
+            try:
+                self._buffer.close()
+            except BufferError as e:
+                raise BufferError("views of the MOD file's data are still in use") from e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def patterns(self):
+        # nested lists of (note, sample, effect, param) tuples per pattern and row,
+        # built from pattern_array on first access
+        if self._patterns is None:
+            self._patterns = [
+                [
+                    [
+                        (None if note < 0 else note, sample, effect, param)
+                        for (note, sample, effect, param) in row
+                    ]
+                    for row in pattern
+                ]
+                for pattern in self.pattern_array.tolist()
+            ]
+        return self._patterns
@@ -0,0 +1,98 @@
+import numpy as np
+
+ROW_COUNT = 64
+CHANNEL_COUNT = 4
+
+# The patterns that the song's positions reach are stored one after another, renumbered
+# in order of first use. Each row starts with a byte whose low nibble has a bit set for
+# each channel with a note to play, and whose high nibble has a bit set for each of those
+# with an effect that the player acts on. The notes follow in channel order, as the note
+# number and sample, then the effect and param if flagged. A byte with an empty low nibble
+# instead stands for a run of rows with no notes, (byte >> 4) + 1 of them; runs don't carry
+# over from one pattern into the next.
+PLAYED_EFFECTS = (0x0c, 0x0f)  # set volume, set speed
+MAX_EMPTY_RUN = 16
+
+
+def used_patterns(positions):
+    # the patterns that positions refer to, in order of first use, and the positions
+    # renumbered to index that list
+    patterns, first_use, inverse = np.unique(np.asarray(positions), return_index=True, return_inverse=True)
+    order = np.argsort(first_use)
+    renumbered = np.empty_like(order)
+    renumbered[order] = np.arange(len(order))
+    return patterns[order], renumbered[inverse].tolist()
+
+
+def encode_patterns(cells, positions, sample_count):
+    # Packs the patterns of a (patterns, 64, channels) array of cells (as in
+    # ModFile.pattern_array) that positions reach, returning the packed bytes, the offset
+    # of each packed pattern within them and the renumbered positions. Notes without a
+    # sample from 1 to sample_count can't be played, so are left out.
+    patterns, positions = used_patterns(positions)
+    cells = cells[patterns]
+    played = (cells['note'] >= 0) & (cells['sample'] >= 1) & (cells['sample'] <= sample_count)
+    has_effect = played & np.isin(cells['effect'], PLAYED_EFFECTS)
+    channel_bits = 1 << np.arange(CHANNEL_COUNT)
+    masks = (played * channel_bits).sum(axis=2) | ((has_effect * channel_bits).sum(axis=2) << 4)
+
+    # for each empty row, the rows from the start of its run, and those left to the end
+    empty = masks == 0
+    rows = np.broadcast_to(np.arange(ROW_COUNT), empty.shape)
+    follows_empty = np.zeros_like(empty)
+    follows_empty[:, 1:] = empty[:, :-1]
+    precedes_empty = np.zeros_like(empty)
+    precedes_empty[:, :-1] = empty[:, 1:]
+    run_start = np.maximum.accumulate(np.where(empty & ~follows_empty, rows, 0), axis=1)
+    run_end = np.minimum.accumulate(
+        np.where(empty & ~precedes_empty, rows, ROW_COUNT - 1)[:, ::-1], axis=1
+    )[:, ::-1]
+    run_heads = empty & ((rows - run_start) % MAX_EMPTY_RUN == 0)
+    run_lengths = np.minimum(run_end - rows + 1, MAX_EMPTY_RUN)
+
+    # every byte a row could have, and which of them it does
+    row_bytes = np.empty(empty.shape + (1 + CHANNEL_COUNT * 4,), dtype=np.uint8)
+    row_bytes[..., 0] = np.where(empty, (run_lengths - 1) << 4, masks)
+    cell_bytes = row_bytes[..., 1:].reshape(empty.shape + (CHANNEL_COUNT, 4))
+    cell_bytes[..., 0] = np.where(played, cells['note'], 0)
+    cell_bytes[..., 1] = cells['sample']
+    cell_bytes[..., 2] = cells['effect']
+    cell_bytes[..., 3] = cells['param']
+    stored = np.empty(row_bytes.shape, dtype=bool)
+    stored[..., 0] = ~empty | run_heads
+    stored_cells = stored[..., 1:].reshape(cell_bytes.shape)
+    stored_cells[..., 0:2] = played[..., np.newaxis]
+    stored_cells[..., 2:4] = has_effect[..., np.newaxis]
+
+    sizes = stored.reshape(len(patterns), -1).sum(axis=1)
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).tolist()
+    return row_bytes[stored].tobytes(), offsets, positions
+
+
+def decode_patterns(data, offsets):
+    # (patterns, 64, channels, 4) array of note (255 for none), sample, effect, param,
+    # unpacked from the data and offsets from encode_patterns
+    patterns = np.zeros((len(offsets), ROW_COUNT, CHANNEL_COUNT, 4), dtype=np.uint8)
+    patterns[..., 0] = 255
+    for (pattern, addr) in enumerate(offsets):
+        row = 0
+        while row < ROW_COUNT:
+            mask = data[addr]
+            addr += 1
+            if mask & 0x0f == 0:
+                row += (mask >> 4) + 1
+                continue
+            for chan in range(CHANNEL_COUNT):
+                if mask & (1 << chan):
+                    patterns[pattern, row, chan, 0:2] = list(data[addr:addr + 2])
+                    addr += 2
+                    if mask & (0x10 << chan):
+                        patterns[pattern, row, chan, 2:4] = list(data[addr:addr + 2])
+                        addr += 2
+            row += 1
+    return patterns
+
+
+def unpacked_size(pattern_count):
+    # bytes the patterns would take at 4 bytes per cell
+    return pattern_count * ROW_COUNT * CHANNEL_COUNT * 4
@@ -0,0 +1,435 @@
+import re
+import textwrap
+from functools import lru_cache
+from string import Template
+
+from manifest import hash_bytes
+import visualisers
+from visualisers import make_visualiser_code
+
+# The cart's Lua code is put together from the templates at the end of this file, with
+# $name slots for what depends on the mod data. The templates for each kind of player
+# are assembled and compiled (see CodeTemplate) once per process, so that generating a
+# cart's code only formats the slot values and joins them with the template's bytes.
+
+
+class CodeTemplate:
+    # Lua source with $name (or ${name}) slots, compiled to its bytes with the slots
+    # taken out and the offset where each goes, in order
+    SLOT = re.compile(r'\$(?:(\w+)|\{(\w+)\})')
+
+    def __init__(self, source):
+        data = []
+        self.slots = []  # (offset in data, slot name)
+        offset = 0
+        for (i, part) in enumerate(self.SLOT.split(source)):
+            if i % 3 == 0:
+                data.append(part.encode('ascii'))
+                offset += len(data[-1])
+            elif part is not None:
+                self.slots.append((offset, part))
+        self.data = b''.join(data)
+
+    def fill(self, values):
+        # the code with each slot filled in from values (which may be of any type whose
+        # str() is ASCII)
+        data = memoryview(self.data)
+        parts = []
+        start = 0
+        for (offset, name) in self.slots:
+            parts.append(data[start:offset])
+            parts.append(str(values[name]).encode('ascii'))
+            start = offset
+        parts.append(data[start:])
+        return b''.join(parts)
+
+
+def sequencer_source(wave_layout, multi_bank):
+    # the source of the sequencer's template for the given wave layout, with or without
+    # switching banks
+    if wave_layout == 'keyframe':
+        read_frame = READ_KEYFRAME_CODE
+    else:
+        read_frame = Template(READ_FRAME_CODE).safe_substitute(frame_wave_addr=FRAME_WAVE_ADDRS[wave_layout])
+    channel_code = Template(CHANNEL_CODE).safe_substitute(
+        read_frame=read_frame, bank_switch=BANK_SWITCH_CODE if multi_bank else ""
+    )
+    if multi_bank:
+        channel_loop = Template(BANKED_CHANNEL_LOOP_CODE).safe_substitute(
+            channel_code=textwrap.indent(channel_code, "        ", lambda line: line.strip())
+        )
+    else:
+        channel_loop = Template(CHANNEL_LOOP_CODE).safe_substitute(
+            channel_code=textwrap.indent(channel_code, "    ", lambda line: line.strip())
+        )
+    return Template(SEQUENCER_CODE).safe_substitute(
+        channel_loop=channel_loop,
+        bank_comment="\n-- 6=bank holding the sample's frames" if multi_bank else "",
+        # bank 0 is in memory to begin with
+        bank_state="\ncurrent_bank = 0" if multi_bank else "",
+    )
+
+
+@lru_cache(maxsize=None)
+def program_template(player, wave_layout=None, multi_bank=False):
+    # the compiled template for a cart with the given player ('sequencer' or 'stream')
+    # and, for the sequencer, wave layout and whether the mod data is in several banks
+    if player == 'stream':
+        player_code = STREAM_CODE
+    else:
+        player_code = sequencer_source(wave_layout, multi_bank)
+    return CodeTemplate(Template(PROGRAM_CODE).safe_substitute(player_code=player_code))
+
+
+def sequencer_slots(program, positions, pattern_data_start_addr=0x4000):
+    # the sequencer template's slot values for the mod data described by program; each
+    # bank has the pattern data, then its wave dictionary, then its samples' frames
+    wave_data_start_addr = pattern_data_start_addr + program['pattern_data_size']
+    multi_bank = len(program['wave_data_sizes']) > 1
+    sample_meta_rows = []
+    for s in program['sample_meta']:
+        sample_data_start_addr = wave_data_start_addr + program['wave_data_sizes'][s['bank']]
+        row = [
+            sample_data_start_addr + s['start'], s['length'], sample_data_start_addr + s['repeat_from'],
+            s['repeat_length'], s['base_note']
+        ] + ([s['bank']] if multi_bank else [])
+        sample_meta_rows.append("{%s}" % ",".join(str(v) for v in row))
+    return {
+        'samples_meta': ",\n".join(sample_meta_rows),
+        'positions': "{%s}" % ",".join(str(v) for v in positions),
+        'pattern_addrs': "{[0]=%s}" % ",".join(
+            str(pattern_data_start_addr + offset) for offset in program['pattern_offsets']
+        ),
+        # written with repr so that Lua reads back exactly the doubles Python computed
+        'pitch_multipliers': ",".join(
+            "[%d]=%r" % (shift, 2**(shift/12)) for shift in program['semitone_shifts']
+        ),
+        'wave_data_start_addr': wave_data_start_addr,
+        'frame_size': program['frame_size'],
+        'sync_mask': program['sync_mask'],
+    }
+
+
+def stream_slots(stream, data_start_addr=0x4000):
+    # the stream player template's slot values for a register stream (see
+    # registerstream.py)
+    return {
+        'channel_states': ",\n".join(
+            "    {0, 0, %d, 0}" % (data_start_addr + spans['start']) for spans in stream['spans']
+        ),
+        'span_ends': ",".join(str(data_start_addr + spans['end']) for spans in stream['spans']),
+        'loop_spans': ",".join(str(data_start_addr + spans['loop']) for spans in stream['spans']),
+        'record_data_addr': data_start_addr + stream['record_data_offset'],
+        'data_start_addr': data_start_addr,
+    }
+
+
+def make_program(program, positions, data_start_addr=0x4000):
+    # player code for the data described by program (see build.program_inputs), as bytes
+    if program['player'] == 'stream':
+        template = program_template('stream')
+        slots = stream_slots(program['stream'], data_start_addr)
+    else:
+        template = program_template(
+            'sequencer', program['wave_layout'], len(program['wave_data_sizes']) > 1
+        )
+        slots = sequencer_slots(program, positions, data_start_addr)
+    slots['visualiser_code'] = make_visualiser_code(program['visualisers'], program['visualiser_data_addr'])
+    return template.fill(slots)
+
+
+@lru_cache(maxsize=None)
+def template_key():
+    # hash of the code that generates the player code, for telling whether carts built
+    # earlier are stale
+    source = b''
+    for filename in (__file__, visualisers.__file__):
+        with open(filename, 'rb') as f:
+            source += f.read()
+    return hash_bytes(source)
+
+
+# frames refer to a wave in the dictionary by a 16-bit index ('dedup'), or have it inline
+FRAME_WAVE_ADDRS = {
+    'dedup': "wave_data_start_addr+(peek(addr+2)|(peek(addr+3)<<8))*16",
+    'raw': "addr+2",
+}
+
+PROGRAM_CODE = '''-- title:  ticmodplayer
+-- author: Gasman / Wavesitter
+-- desc:   MOD playback on TIC-80
+-- script: lua
+
+$player_code
+scrolltext = "Hello! I'm Gasman, and you're listening to Guitarous by The Warlock / Grace... quite possibly the first MOD file I ever listened to, from some music collection that ran on a PC speaker (erk). So it seemed quite appropriate to borrow it for the world's first MOD player for TIC-80. The TIC-80 still doesn't do real sample playback, so this is a continuation of the technique from my Mercedes Benz demo: first, chop each sample into 1/60s slices, and do some statistical analysis on it to work out where the waveform repeats. (Which seems like it should be FFT, but... isn't, really.) Then take one of those waves, and squish it down into the 32 nibbles that the TIC-80 provides for a waveform on a single frame. Do that 60 times a second, and as long as that sample is something close to a musical note, we can play it back in a more or less recognisable form. Even better, we can pitch-shift it by altering the playback frequency... and combining that with the TIC-80's four channels, you've got everything you need for a MOD player. It's a very limited one, of course (not least since I've only been hacking on it over the Christmas holidays) - there's some hacky code to deal with drum samples, trying to work out when the pitch matching breaks down and ham-fistedly dropping some noise in instead. Hardly any effects are implemented right now, and we're also constrained by the TIC-80 memory map, so there's a 48Kb limit on the crunched sample and pattern data. Is this the future of music on the TIC-80? Probably not, assuming people don't want their soundtracks to sound like vacuum cleaners full of nails. But at the end of the day all we're really doing here is massively increasing the 16 waveforms that the native TIC-80 tracker gives us... I reckon that if we used this technique on original tracks written with the TIC-80 in mind, with some combination of sampled, synthesised and simple chip instruments - rather than expecting an automatic conversion to do a good job across the board - we could get some really nice-sounding results, and maybe even bless the TIC-80 with its very own 'signature sound'. That would be pretty awesome, wouldn't it? Maybe we can make 2023 the year that we really start pushing TIC-80 demos beyond the arena of size-coding :-) Greetings to Field-FX, Slipstream, TUHB, ScenePT All-Stars, Bitshifters, RBBS, Poo-Brain, MountainBytes, Marquee Design, pestis, ilmenit, dave84, p01 and my fellow Demozoo conspirators. Happy holidays and a prosperous 2023 to you all! Gasman signing off at the end of 2022...                        "
+
+scroll_x = 0
+scroll_next_char_index = 1
+scroll_buffer = "                              "
+
+function get_width(s)
+  return print(s, 0, -100, 6, false, 2)
+end
+
+scroll_first_char_width = get_width(string.sub(scroll_buffer, 1, 1))
+scroll_buffer_width = get_width(scroll_buffer)
+
+$visualiser_code
+function TIC()
+  play_frame()
+  if #visualisers > 0 then
+    visualisers[(time() // 15360) % #visualisers + 1]()
+  else
+    cls()
+  end
+
+  if -scroll_x >= scroll_first_char_width then
+    scroll_buffer = string.sub(scroll_buffer, 2)
+    scroll_x = scroll_x + scroll_first_char_width
+    scroll_buffer_width = scroll_buffer_width - scroll_first_char_width
+    scroll_first_char_width = get_width(string.sub(scroll_buffer, 1, 1))
+  end
+
+  if scroll_buffer_width < 260 then
+    next_char = string.sub(scrolltext, scroll_next_char_index, scroll_next_char_index)
+    scroll_buffer_width = scroll_buffer_width + get_width(next_char)
+    scroll_buffer = scroll_buffer .. next_char
+    scroll_next_char_index = (scroll_next_char_index % #scrolltext) + 1
+  end
+
+  print(scroll_buffer, scroll_x, 110, 6, false, 2)
+  scroll_x = scroll_x - 2
+end
+'''
+
+SEQUENCER_CODE = '''-- 1=start address of sample
+-- 2=sample length in frames
+-- 3=address to repeat from
+-- 4=repeat length in frames
+-- 5=sample's native note frequency$bank_comment
+samples_meta = {
+    $samples_meta
+}
+
+positions = $positions
+
+-- start address of each pattern's packed rows (see patterncodec.py)
+pattern_addrs = $pattern_addrs
+
+-- frequency multiplier for each semitone shift (from a sample's native note) in the song
+pitch_multipliers = {${pitch_multipliers}}
+
+-- 1=sample address pointer
+-- 2=sample number
+-- 3=frames left until sample ends or repeats
+-- 4=frequency multiplier for the semitone shift from sample's native note
+-- 5=vol multiplier
+-- with keyframe wave layout:
+-- 6=frames left of the current run (0 to start a new one)
+-- 7=address of the current run's wave
+-- 8=1 if the current run holds the last frame's registers
+-- 9,10=last frame's frequency/volume bytes
+channel_states = {
+    {0, 0, 0, 0, 0, 0, 0, 0, 0, 0},
+    {0, 0, 0, 0, 0, 0, 0, 0, 0, 0},
+    {0, 0, 0, 0, 0, 0, 0, 0, 0, 0},
+    {0, 0, 0, 0, 0, 0, 0, 0, 0, 0},
+}
+
+t=0
+
+row_duration = 1.2*6
+next_row_time = 0
+row_num = -1
+position_num = 1
+pattern_num = positions[1]
+row_addr = pattern_addrs[pattern_num]
+-- rows left of the current run of empty rows
+empty_rows = 0
+wave_data_start_addr = $wave_data_start_addr$bank_state
+
+function play_frame()
+  if next_row_time <= t then
+    -- read new row
+    row_num = row_num + 1
+
+    if row_num == 64 then
+      -- read new pattern
+      row_num = 0
+      position_num = (position_num % #positions) + 1
+      pattern_num = positions[position_num]
+      row_addr = pattern_addrs[pattern_num]
+      empty_rows = 0
+    end
+
+    if empty_rows > 0 then
+      empty_rows = empty_rows - 1
+    else
+      local mask = peek(row_addr)
+      row_addr = row_addr + 1
+      if mask & 0x0f == 0 then
+        -- this row and the next (mask >> 4) have no notes
+        empty_rows = mask >> 4
+      else
+        for chan=1,4 do
+          if mask & 1 ~= 0 then
+            local note_num, sample_num = peek(row_addr), peek(row_addr + 1)
+            local effect, param = 0, 0
+            if mask & 0x10 ~= 0 then
+              effect, param = peek(row_addr + 2), peek(row_addr + 3)
+              row_addr = row_addr + 4
+            else
+              row_addr = row_addr + 2
+            end
+            local sample_meta = samples_meta[sample_num]
+            local state = channel_states[chan]
+            state[1] = sample_meta[1]
+            state[2] = sample_num
+            state[3] = sample_meta[2]
+            state[4] = pitch_multipliers[note_num - sample_meta[5]]
+            state[6] = 0
+            if effect == 0x0c then
+              state[5] = param / 64
+            else
+              state[5] = 1
+            end
+            if effect == 0x0f then
+              if param <= 32 then
+                row_duration = 1.2*param
+              else
+                row_duration = 900/param
+              end
+            end
+          end
+          mask = mask >> 1
+        end
+      end
+    end
+    -- advance next_row_time
+    next_row_time = next_row_time + row_duration
+  end
+
+$channel_loop
+  t=t+1
+end
+'''
+
+CHANNEL_LOOP_CODE = '''  local chan_addr = 0xff9c
+  for chan=1,4 do
+    local state = channel_states[chan]
+    local sample_num = state[2]
+${channel_code}    chan_addr = chan_addr + 18
+  end
+'''
+
+# channels playing from the bank already in memory go first, then the others,
+# switching banks as needed
+BANKED_CHANNEL_LOOP_CODE = '''  local first_bank = current_bank
+  for pass=1,2 do
+    local chan_addr = 0xff9c
+    for chan=1,4 do
+      local state = channel_states[chan]
+      local sample_num = state[2]
+      if (sample_num == 0 or samples_meta[sample_num][6] == first_bank) == (pass == 1) then
+${channel_code}      end
+      chan_addr = chan_addr + 18
+    end
+  end
+'''
+
+CHANNEL_CODE = '''if sample_num > 0 and state[3] == 0 then
+  -- sample end reached
+  local sample_meta = samples_meta[sample_num]
+  if sample_meta[4] > 0 then
+    -- repeating
+    state[1] = sample_meta[3]
+    state[3] = sample_meta[4]
+    state[6] = 0
+  else
+    -- non-repeating - stop sample
+    state[2] = 0
+    sample_num = 0
+  end
+end
+
+if sample_num > 0 then
+  ${bank_switch}local addr = state[1]
+  $read_frame
+  local freq = ((b1 | ((b2 & 0x0f) << 8)) * state[4] + 0.5) // 1
+  local vol = (b2 >> 4) * state[5] // 1
+  poke(chan_addr, freq & 0xff)
+  poke(chan_addr + 1, (freq >> 8) | (vol << 4))
+  memcpy(chan_addr + 2, wave_addr, 16)
+  state[3] = state[3] - 1
+else
+  poke(chan_addr + 1, 0)
+end
+'''
+
+BANK_SWITCH_CODE = '''local bank = samples_meta[sample_num][6]
+  if bank ~= current_bank then
+    sync($sync_mask, bank)
+    current_bank = bank
+  end
+  '''
+
+READ_FRAME_CODE = '''local b1, b2 = peek(addr), peek(addr + 1)
+  local wave_addr = $frame_wave_addr
+  state[1] = addr + $frame_size'''
+
+# frames come in runs sharing a wave (see wavecodec.py); the run being played and
+# the last frame's registers are kept in the channel state
+READ_KEYFRAME_CODE = '''if state[6] == 0 then
+    -- start a new run
+    local run = peek(addr)
+    addr = addr + 1
+    if run < 0x40 then
+      state[7] = wave_data_start_addr + (peek(addr) | (peek(addr + 1) << 8)) * 16
+      addr = addr + 2
+    end
+    state[6] = (run & 0x3f) + 1
+    state[8] = run >> 7
+  end
+  if state[8] == 0 then
+    state[9], state[10] = peek(addr), peek(addr + 1)
+    addr = addr + 2
+  end
+  local b1, b2 = state[9], state[10]
+  local wave_addr = state[7]
+  state[1] = addr
+  state[6] = state[6] - 1'''
+
+STREAM_CODE = '''-- 1=address of the next record
+-- 2=ticks left in the span
+-- 3=address of the next span
+-- 4=bytes to step between records (0 to hold one)
+channel_states = {
+$channel_states
+}
+span_ends = {${span_ends}}
+loop_spans = {${loop_spans}}
+
+function play_frame()
+  local chan_addr = 0xff9c
+  for chan=1,4 do
+    local state = channel_states[chan]
+    if state[2] == 0 then
+      local span = state[3]
+      if span == span_ends[chan] then
+        span = loop_spans[chan]
+      end
+      local count = peek(span + 2)
+      state[1] = $record_data_addr + (peek(span) | (peek(span + 1) << 8)) * 4
+      state[2] = count & 0x7f
+      state[4] = count < 0x80 and 4 or 0
+      state[3] = span + 3
+    end
+    local addr = state[1]
+    memcpy(chan_addr, addr, 2)
+    memcpy(chan_addr + 2, $data_start_addr + (peek(addr + 2) | (peek(addr + 3) << 8)) * 16, 16)
+    state[1] = addr + state[4]
+    state[2] = state[2] - 1
+    chan_addr = chan_addr + 18
+  end
+end
+'''
@@ -0,0 +1,242 @@
+import argparse
+import importlib.util
+import json
+import sys
+import time
+
+from ticfile import TICFile, ChunkType
+
+# where each bank-0 chunk of cart data appears in TIC-80 RAM
+CHUNK_ADDRESSES = {ChunkType.TILES: 0x4000, ChunkType.SPRITES: 0x6000, ChunkType.MAP: 0x8000}
+CHUNK_SIZES = {ChunkType.TILES: 0x2000, ChunkType.SPRITES: 0x2000, ChunkType.MAP: 0x7f80}
+RAM_SIZE = 0x18000
+SCREEN_WIDTH = 240
+SCREEN_HEIGHT = 136
+SOUND_REGISTERS = 0xff9c
+SOUND_REGISTERS_SIZE = 4 * 18
+
+
+class CartRunner:
+    # Runs the Lua code of a cart against a minimal emulation of the TIC-80 API (memory,
+    # sound registers, pixels and bank syncing; drawing primitives other than pix do
+    # nothing), counting Lua VM instructions and API calls. Instruction counts come from
+    # the Lua that lupa provides (5.3, as in TIC-80, where available), so they are
+    # indicative of, rather than equal to, the cost under TIC-80 itself.
+    def __init__(self, tic, lua_runtime):
+        self.memory = bytearray(RAM_SIZE)
+        self.banks = {}
+        code = None
+        for chunk in tic.chunks:
+            if chunk.type == ChunkType.CODE:
+                code = chunk.data.decode('ascii')
+            elif chunk.type in CHUNK_ADDRESSES:
+                self.banks[(chunk.type, chunk.bank)] = chunk.data
+        if code is None:
+            raise ValueError("Cart has no code")
+        self.sync(0, 0)
+
+        self.frame = 0
+        self.api_calls = {}
+        self.lua = lua_runtime()
+        api = self.lua.globals()
+        for (name, fn) in self.api_functions().items():
+            setattr(api, name, self.counted(name, fn))
+        # TIC-80 builds Lua with the 5.2 compatibility functions, which lupa's may lack
+        self.lua.execute('math.atan2 = math.atan2 or math.atan')
+        self.lua.execute(code)
+        self.lua.execute('''
+            instruction_count = 0
+            function count_instructions()
+              instruction_count = instruction_count + 1
+            end
+        ''')
+
+    def counted(self, name, fn):
+        self.api_calls[name] = 0
+
+        def call(*args):
+            self.api_calls[name] += 1
+            return fn(*args)
+        return call
+
+    def api_functions(self):
+        memory = self.memory
+
+        def peek(addr, bits=8):
+            return memory[int(addr)]
+
+        def poke(addr, value, bits=8):
+            memory[int(addr)] = int(value) & 0xff
+
+        def peek4(addr):
+            addr = int(addr)
+            byte = memory[addr >> 1]
+            return (byte >> 4) if addr & 1 else (byte & 0x0f)
+
+        def poke4(addr, value):
+            addr = int(addr)
+            value = int(value) & 0x0f
+            byte = memory[addr >> 1]
+            memory[addr >> 1] = ((byte & 0x0f) | (value << 4)) if addr & 1 else ((byte & 0xf0) | value)
+
+        def memcpy(dest, src, size):
+            dest, src, size = int(dest), int(src), int(size)
+            memory[dest:dest + size] = memory[src:src + size]
+
+        def memset(dest, value, size):
+            dest, size = int(dest), int(size)
+            memory[dest:dest + size] = bytes([int(value) & 0xff]) * size
+
+        def pix(x, y, color=None):
+            x, y = int(x), int(y)
+            if not (0 <= x < SCREEN_WIDTH and 0 <= y < SCREEN_HEIGHT):
+                return 0
+            if color is None:
+                return peek4(x + y * SCREEN_WIDTH)
+            poke4(x + y * SCREEN_WIDTH, color)
+
+        def cls(color=0):
+            memset(0, (int(color) & 0x0f) * 0x11, SCREEN_WIDTH * SCREEN_HEIGHT // 2)
+
+        return {
+            'peek': peek, 'poke': poke, 'peek4': peek4, 'poke4': poke4,
+            'memcpy': memcpy, 'memset': memset, 'sync': self.sync,
+            'pix': pix, 'cls': cls,
+            'print': lambda text, *args: 6 * len(str(text)),
+            'rect': lambda *args: None, 'rectb': lambda *args: None,
+            'line': lambda *args: None, 'circ': lambda *args: None,
+            'spr': lambda *args: None, 'map': lambda *args: None,
+            'vbank': lambda *args: 0, 'trace': lambda *args: None,
+            'time': lambda: self.frame * 1000 / 60,
+        }
+
+    def sync(self, mask=0, bank=0, to_cart=False):
+        # copy the given bank of cart data into RAM (to_cart is not supported)
+        mask, bank = int(mask), int(bank)
+        for (chunk_type, bit) in ((ChunkType.TILES, 1), (ChunkType.SPRITES, 2), (ChunkType.MAP, 4)):
+            if mask == 0 or mask & bit:
+                address = CHUNK_ADDRESSES[chunk_type]
+                size = CHUNK_SIZES[chunk_type]
+                data = self.banks.get((chunk_type, bank), b'')[:size]
+                self.memory[address:address + size] = data.ljust(size, b'\0')
+
+    def run(self, function_name, frames, before=None):
+        # call the named global function once per frame, returning per-frame statistics;
+        # the function named by before (if any) is called first each frame, unmeasured
+        fn = self.lua.globals()[function_name]
+        before_fn = self.lua.globals()[before] if before else None
+        sethook = self.lua.eval('debug.sethook')
+        counter = self.lua.globals().count_instructions
+        results = []
+        for i in range(frames):
+            if before_fn is not None:
+                before_fn()
+            self.lua.globals().instruction_count = 0
+            api_calls = dict(self.api_calls)
+            start = time.perf_counter()
+            sethook(counter, "", 1)
+            fn()
+            sethook()
+            elapsed = time.perf_counter() - start
+            results.append({
+                'instructions': self.lua.globals().instruction_count,
+                'api_calls': {
+                    name: count - api_calls[name] for (name, count) in self.api_calls.items()
+                    if count > api_calls[name]
+                },
+                'seconds': elapsed,
+            })
+            self.frame += 1
+        return results
+
+    def sound_registers(self):
+        return bytes(self.memory[SOUND_REGISTERS:SOUND_REGISTERS + SOUND_REGISTERS_SIZE])
+
+
+def summarise(results):
+    # mean and worst case of the per-frame statistics from CartRunner.run
+    frames = len(results)
+    names = sorted({name for result in results for name in result['api_calls']})
+    return {
+        'frames': frames,
+        'instructions_mean': sum(r['instructions'] for r in results) / frames,
+        'instructions_max': max(r['instructions'] for r in results),
+        'api_calls_mean': {
+            name: sum(r['api_calls'].get(name, 0) for r in results) / frames for name in names
+        },
+        'api_calls_max': {
+            name: max(r['api_calls'].get(name, 0) for r in results) for name in names
+        },
+        # wall time under the emulation, including the instruction counting hook
+        'seconds_mean': sum(r['seconds'] for r in results) / frames,
+    }
+
+
+def default_lua_runtime():
+    # TIC-80 embeds Lua 5.3; use the same version where lupa provides it
+    try:
+        from lupa.lua53 import LuaRuntime
+    except ImportError:
+        from lupa import LuaRuntime
+    return LuaRuntime
+
+
+def measure_cart(filename, player_frames=600, tic_frames=0, functions=(), function_frames=60, lua_runtime=None):
+    # per-frame cost of the cart's play_frame over player_frames frames; if tic_frames > 0,
+    # of its whole TIC function (player and visualisers) over that many; and of each of
+    # the named functions (such as a single visualiser) over function_frames, each frame
+    # after running the player
+    if lua_runtime is None:
+        lua_runtime = default_lua_runtime()
+    costs = {}
+    runner = CartRunner(TICFile.open(filename), lua_runtime)
+    costs['play_frame'] = summarise(runner.run('play_frame', player_frames))
+    if tic_frames:
+        runner = CartRunner(TICFile.open(filename), lua_runtime)
+        costs['TIC'] = summarise(runner.run('TIC', tic_frames))
+    for function_name in functions:
+        runner = CartRunner(TICFile.open(filename), lua_runtime)
+        costs[function_name] = summarise(runner.run(function_name, function_frames, before='play_frame'))
+    return costs
+
+
+def print_costs(costs):
+    for (function_name, cost) in costs.items():
+        print("%s over %d frames: %.0f Lua instructions per frame (max %d)" % (
+            function_name, cost['frames'], cost['instructions_mean'], cost['instructions_max']
+        ))
+        print("  API calls per frame: %s" % ", ".join(
+            "%s %.1f (max %d)" % (name, mean, cost['api_calls_max'][name])
+            for (name, mean) in cost['api_calls_mean'].items()
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the per-frame cost of a built cart's player code, by running it "
+                    "under Lua against an emulated TIC-80 API (requires lupa)"
+    )
+    parser.add_argument('cart', help=".tic file built by build.py")
+    parser.add_argument('--frames', type=int, default=600,
+        help="frames of play_frame to run (default: 600)")
+    parser.add_argument('--tic-frames', type=int, default=0,
+        help="also run the whole TIC function, including visualisers, for this many frames")
+    parser.add_argument('--function', action='append', default=[], metavar='NAME',
+        help="also measure this function of the cart (such as a visualiser), called after "
+             "play_frame each frame; may be repeated")
+    parser.add_argument('--function-frames', type=int, default=60,
+        help="frames to run each --function for (default: 60)")
+    parser.add_argument('--json', help="write the measurements to this file")
+    args = parser.parse_args()
+
+    if importlib.util.find_spec('lupa') is None:
+        sys.exit("playercost.py needs the lupa package (pip install lupa)")
+    costs = measure_cart(args.cart, args.frames, args.tic_frames, args.function, args.function_frames)
+    print_costs(costs)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(costs, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
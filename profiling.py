@@ -0,0 +1,175 @@
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class Profiler:
+    # Wall-clock time per named stage and event counters, in total and broken down by
+    # the sample being converted. With trace=True, every stage run is also kept as an
+    # event for export in the Chrome trace format (chrome://tracing, Perfetto).
+    # Stages may nest; each stage's time includes any stages run inside it.
+    enabled = True
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.stage_times = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.samples = {}
+        self.events = []
+        self.scope_label = None
+        self.sample = None
+
+    def sample_entry(self, sample):
+        if sample not in self.samples:
+            self.samples[sample] = {'stages': defaultdict(float), 'counters': defaultdict(int)}
+        return self.samples[sample]
+
+    @contextmanager
+    def stage(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stage_times[name] += elapsed
+            self.stage_calls[name] += 1
+            if self.sample is not None:
+                self.sample_entry(self.sample)['stages'][name] += elapsed
+            if self.trace:
+                if self.sample is not None:
+                    args['sample'] = self.sample
+                self.events.append({
+                    'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                    'ts': start * 1e6, 'dur': elapsed * 1e6, 'args': args,
+                })
+
+    def count(self, name, n=1):
+        n = int(n)
+        self.counters[name] += n
+        if self.sample is not None:
+            self.sample_entry(self.sample)['counters'][name] += n
+
+    def sample_label(self, sample):
+        # sample 3 within the scope "FILE.MOD" is labelled "FILE.MOD#3"
+        return sample if self.scope_label is None else "%s#%s" % (self.scope_label, sample)
+
+    @contextmanager
+    def scope(self, label):
+        # prefix the labels of samples within, to tell apart samples of different files
+        previous = self.scope_label
+        self.scope_label = label
+        try:
+            yield
+        finally:
+            self.scope_label = previous
+
+    @contextmanager
+    def for_sample(self, sample):
+        # attribute the stages and counts within to sample (a sample number or label)
+        previous = self.sample
+        self.sample = self.sample_label(sample)
+        try:
+            yield
+        finally:
+            self.sample = previous
+
+    def export(self):
+        # plain data, for returning from worker processes and saving as JSON
+        return {
+            'stages': {
+                name: {'time_s': self.stage_times[name], 'calls': self.stage_calls[name]}
+                for name in self.stage_times
+            },
+            'counters': dict(self.counters),
+            'samples': {
+                sample: {'stages': dict(entry['stages']), 'counters': dict(entry['counters'])}
+                for (sample, entry) in self.samples.items()
+            },
+            'events': self.events,
+        }
+
+    def merge(self, data):
+        # add in the results of export() from another profiler
+        for (name, stage) in data['stages'].items():
+            self.stage_times[name] += stage['time_s']
+            self.stage_calls[name] += stage['calls']
+        for (name, n) in data['counters'].items():
+            self.counters[name] += n
+        for (sample, entry) in data['samples'].items():
+            own = self.sample_entry(sample)
+            for (name, elapsed) in entry['stages'].items():
+                own['stages'][name] += elapsed
+            for (name, n) in entry['counters'].items():
+                own['counters'][name] += n
+        self.events.extend(data['events'])
+
+    def chrome_trace(self):
+        return {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+
+    def report(self):
+        lines = ["Stage                      Time   Calls"]
+        for name in sorted(self.stage_times, key=self.stage_times.get, reverse=True):
+            lines.append("  %-20s %8.2fms %7d" % (name, self.stage_times[name] * 1000, self.stage_calls[name]))
+        lines.append("Counters")
+        for name in sorted(self.counters):
+            lines.append("  %-20s %10d" % (name, self.counters[name]))
+        if self.samples:
+            stage_names = sorted({name for entry in self.samples.values() for name in entry['stages']})
+            counter_names = sorted({name for entry in self.samples.values() for name in entry['counters']})
+            lines.append("Per sample (ms for stages)")
+            lines.append("  %-16s" % "sample" + "".join(" %12s" % name[:12] for name in stage_names + counter_names))
+            for (sample, entry) in self.samples.items():
+                lines.append("  %-16s" % str(sample)[:16] + "".join(
+                    [" %12.2f" % (entry['stages'].get(name, 0) * 1000) for name in stage_names] +
+                    [" %12d" % entry['counters'].get(name, 0) for name in counter_names]
+                ))
+        return "\n".join(lines)
+
+
+NULL_CONTEXT = nullcontext()
+
+
+class NullProfiler:
+    # Stand-in used when profiling is off: every call does nothing
+    enabled = False
+
+    def stage(self, name, **args):
+        return NULL_CONTEXT
+
+    def count(self, name, n=1):
+        pass
+
+    def scope(self, label):
+        return NULL_CONTEXT
+
+    def for_sample(self, sample):
+        return NULL_CONTEXT
+
+
+_profiler = NullProfiler()
+
+
+def profiler():
+    return _profiler
+
+
+def set_profiler(new_profiler):
+    # install a Profiler (or NullProfiler), returning the previous one
+    global _profiler
+    previous = _profiler
+    _profiler = new_profiler
+    return previous
+
+
+def run_profiled(trace, fn, *args):
+    # Call fn under a fresh Profiler, returning its result along with the profiler's
+    # export(); for work done in another process, to be merged into the caller's profiler
+    worker_profiler = Profiler(trace)
+    previous = set_profiler(worker_profiler)
+    try:
+        result = fn(*args)
+        return result, worker_profiler.export()
+    finally:
+        set_profiler(previous)
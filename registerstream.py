@@ -0,0 +1,193 @@
+import numpy as np
+
+from sequencer import Sequencer, CHANNEL_COUNT, REGISTER_SIZE
+from wavecodec import WaveDictionary, WAVE_SIZE
+
+# A register stream holds the sound register contents of every tick of the song, as
+# worked out by the sequencer at build time, so that the player only has to copy them
+# into place. It is laid out as:
+# - the distinct waves the registers hold, WAVE_SIZE bytes each
+# - records of RECORD_SIZE bytes: the two frequency/volume register bytes, then the
+#   index of the wave as a little-endian 16-bit value
+# - for each channel, a list of spans of SPAN_SIZE bytes: the index of a record as a
+#   little-endian 16-bit value, then the number of ticks to play (up to MAX_SPAN_TICKS),
+#   with the HOLD bit set to play the same record for all of them rather than successive
+#   ones. Spans may refer back to records stored for earlier ones, on any channel.
+# After the last span, each channel goes back to its loop span.
+RECORD_SIZE = 4
+SPAN_SIZE = 3
+MAX_SPAN_TICKS = 0x7f
+HOLD = 0x80
+# shortest run of records worth a span of its own, when copying or holding
+MIN_MATCH = 2
+MIN_HOLD = 3
+# earlier occurrences of a pair of records to try extending into a match
+MATCH_CANDIDATES = 64
+
+
+def song_passes(mod_data, positions):
+    # the sound registers (ticks, channels, 18) of the first two passes through the
+    # song, and the sequencer's channel states after each of their ticks
+    sequencer = Sequencer(mod_data, positions)
+    passes = ([], [])
+    states = ([], [])
+    while sequencer.passes_completed < 2:
+        registers = sequencer.tick()
+        if sequencer.passes_completed < 2:
+            passes[sequencer.passes_completed].append(registers)
+            states[sequencer.passes_completed].append([tuple(state) for state in sequencer.channel_states])
+    return [np.stack(registers) for registers in passes], states
+
+
+def find_loop(first, second, first_states, second_states):
+    # The ticks to store and the tick to loop back to after them. Notes still sounding
+    # from the end of the first pass make the start of the second differ from the first,
+    # so the stream goes on into the second pass until it has caught up with the first,
+    # and loops back to the tick where it does.
+    if len(first) == len(second):
+        differing = np.flatnonzero((first != second).reshape(len(first), -1).any(axis=1))
+        loop_tick = int(differing[-1]) + 1 if len(differing) else 0
+        if loop_tick < len(first):
+            return np.concatenate([first, second[:loop_tick]]), loop_tick
+
+    # Rows are a fractional number of ticks long, so the second pass may start its rows
+    # a tick earlier or later than the first; loop back once every channel is in the
+    # state it was in within a tick of the same point of the first pass, leaving the
+    # same timing jitter on later passes as the sequencer has
+    loop_tick = 0
+    for chan in range(CHANNEL_COUNT):
+        caught_up = next((
+            tick for tick in range(len(second)) if any(
+                0 <= tick + shift < len(first) and first_states[tick + shift][chan] == second_states[tick][chan]
+                for shift in (0, -1, 1)
+            )
+        ), None)
+        if caught_up is None:
+            # this channel never catches up; repeat the whole second pass
+            return np.concatenate([first, second]), len(first)
+        loop_tick = max(loop_tick, caught_up + 1)
+    return np.concatenate([first, second[:loop_tick]]), loop_tick
+
+
+class RecordStore:
+    # The record storage of a stream, with an index of where each pair of successive
+    # records occurs, for finding runs to copy
+    def __init__(self):
+        self.records = []
+        self.pairs = {}
+        self.positions = {}
+
+    def add(self, record):
+        position = len(self.records)
+        self.records.append(record)
+        self.positions.setdefault(record, position)
+        if position > 0:
+            self.pairs.setdefault((self.records[position - 1], record), []).append(position - 1)
+        return position
+
+    def position_of(self, record):
+        # where the record is stored, adding it if it isn't
+        position = self.positions.get(record)
+        return self.add(record) if position is None else position
+
+    def longest_match(self, records, start):
+        # (position, length) of the longest run of stored records matching records[start:]
+        best_position, best_length = None, 0
+        for position in self.pairs.get(tuple(records[start:start + 2]), [])[-MATCH_CANDIDATES:]:
+            length = 0
+            while (start + length < len(records) and position + length < len(self.records)
+                   and self.records[position + length] == records[start + length]):
+                length += 1
+            if length > best_length:
+                best_position, best_length = position, length
+        return best_position, best_length
+
+
+def encode_spans(records, store):
+    # [record position, ticks, hold] spans playing records (a list of one channel's
+    # records), adding records to store as needed; each span is either a run of identical
+    # records, a copy of records stored earlier, or new records stored for it
+    spans = []
+    i = 0
+    while i < len(records):
+        hold_length = 1
+        while i + hold_length < len(records) and records[i + hold_length] == records[i]:
+            hold_length += 1
+        position, match_length = store.longest_match(records, i)
+        if hold_length >= MIN_HOLD and hold_length >= match_length:
+            spans.append([store.position_of(records[i]), hold_length, True])
+            i += hold_length
+        elif match_length >= MIN_MATCH:
+            spans.append([position, match_length, False])
+            i += match_length
+        else:
+            position = store.add(records[i])
+            if spans and not spans[-1][2] and spans[-1][0] + spans[-1][1] == position:
+                spans[-1][1] += 1
+            else:
+                spans.append([position, 1, False])
+            i += 1
+    return spans
+
+
+def pack_spans(spans):
+    data = bytearray()
+    for (position, ticks, hold) in spans:
+        while ticks > 0:
+            count = min(ticks, MAX_SPAN_TICKS)
+            data += bytes([position & 0xff, position >> 8, count | (HOLD if hold else 0)])
+            if not hold:
+                position += count
+            ticks -= count
+    return data
+
+
+def build_register_stream(mod_data, positions):
+    # Register stream for a layout from moddata.build_mod_data, as a dict of the stream
+    # bytes ('data') and the offsets within them that the player needs
+    (first, second), (first_states, second_states) = song_passes(mod_data, positions)
+    registers, loop_tick = find_loop(first, second, first_states, second_states)
+
+    dictionary = WaveDictionary()
+    wave_indices = dictionary.add(registers[:, :, 2:].reshape(-1, WAVE_SIZE)).reshape(registers.shape[:2])
+    # records as integers, in the byte order they are stored in
+    records = (
+        registers[:, :, 0].astype(np.uint32) | (registers[:, :, 1].astype(np.uint32) << 8)
+        | (wave_indices.astype(np.uint32) << 16)
+    )
+
+    store = RecordStore()
+    channel_spans = []
+    for chan in range(CHANNEL_COUNT):
+        channel_records = records[:, chan].tolist()
+        # the loop tick starts a span of its own, so that there is a span to go back to
+        channel_spans.append((
+            pack_spans(encode_spans(channel_records[:loop_tick], store)),
+            pack_spans(encode_spans(channel_records[loop_tick:], store)),
+        ))
+    if len(store.records) > 0x10000:
+        raise ValueError("Register stream needs %d records, more than spans can refer to" % len(store.records))
+
+    wave_data = dictionary.packed_data()
+    record_data = np.array(store.records, dtype='<u4').tobytes()
+    span_offset = len(wave_data) + len(record_data)
+    spans = []
+    for (intro, loop) in channel_spans:
+        spans.append({
+            'start': span_offset,
+            'loop': span_offset + len(intro),
+            'end': span_offset + len(intro) + len(loop),
+        })
+        span_offset += len(intro) + len(loop)
+    return {
+        'data': wave_data + record_data + b''.join(intro + loop for (intro, loop) in channel_spans),
+        'record_data_offset': len(wave_data),
+        'spans': spans,
+        'ticks': len(registers),
+        # the size the registers would take stored as they are
+        'raw_size': len(registers) * CHANNEL_COUNT * REGISTER_SIZE,
+        'loop_tick': loop_tick,
+        'wave_count': len(dictionary),
+        'record_count': len(store.records),
+        'span_bytes': span_offset - len(wave_data) - len(record_data),
+    }
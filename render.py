@@ -0,0 +1,70 @@
+import argparse
+import time
+import wave
+
+import numpy as np
+
+from build import parse_max_waves
+from moddata import build_mod_data
+from modfile import ModFile
+from sequencer import Sequencer
+from synth import Synth, SAMPLE_RATE, TICK_RATE
+
+
+def write_wav(filename, blocks, sample_rate=SAMPLE_RATE):
+    # write float sample blocks as 16-bit mono, one block at a time
+    sample_count = 0
+    with wave.open(filename, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for block in blocks:
+            f.writeframes((np.clip(block, -1, 1) * 32767).astype('<i2').tobytes())
+            sample_count += len(block)
+    return sample_count
+
+
+def render_song(mod_data, positions, chunk_ticks=60, max_ticks=None, sample_rate=SAMPLE_RATE):
+    # generator of audio blocks for one pass through the song
+    sequencer = Sequencer(mod_data, positions)
+    synth = Synth(sample_rate)
+    for registers in sequencer.iter_chunks(chunk_ticks, max_ticks):
+        yield synth.render(registers)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Render a .mod file to WAV as the ticmodplayer cart would play it on TIC-80"
+    )
+    parser.add_argument('input', help="MOD file")
+    parser.add_argument('output', help="WAV file to write")
+    parser.add_argument('--seconds', type=float,
+        help="length to render (default: one pass through the song)")
+    parser.add_argument('--sample-rate', type=int, default=SAMPLE_RATE,
+        help="output sample rate (default: %d)" % SAMPLE_RATE)
+    parser.add_argument('--wave-layout', choices=['auto', 'raw', 'dedup', 'keyframe'], default='auto',
+        help="wave layout, as for build.py")
+    parser.add_argument('--max-waves', type=parse_max_waves, default='fit',
+        help="wave limit, as for build.py")
+    parser.add_argument('--keyframe-threshold', type=float, default=0.0,
+        help="keyframe threshold, as for build.py")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    mod = ModFile.open(args.input)
+    mod_data = build_mod_data(
+        mod, wave_layout=args.wave_layout, max_waves=args.max_waves, keyframe_threshold=args.keyframe_threshold
+    )
+    max_ticks = None if args.seconds is None else int(args.seconds * TICK_RATE)
+    sample_count = write_wav(
+        args.output,
+        render_song(mod_data, mod_data['positions'], max_ticks=max_ticks, sample_rate=args.sample_rate),
+        args.sample_rate
+    )
+    elapsed = time.perf_counter() - start_time
+    duration = sample_count / args.sample_rate
+    print("Rendered %.1fs of audio in %.2fs (%.0fx real time)" % (duration, elapsed, duration / elapsed))
+
+
+if __name__ == '__main__':
+    main()
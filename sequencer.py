@@ -0,0 +1,141 @@
+import numpy as np
+
+from patterncodec import decode_patterns as unpack_patterns
+from wavecodec import decode_keyframes, WAVE_SIZE
+from wavetable import FrameTable, FRAME_SIZE
+
+
+CHANNEL_COUNT = 4
+REGISTER_SIZE = 18  # bytes of TIC-80 sound registers per channel
+
+
+def decode_bank_frames(bank, wave_layout, frame_size):
+    # the packed frames of one bank of a layout, in the order they are stored
+    frame_data = np.frombuffer(bank['frame_data'], dtype=np.uint8)
+    waves = np.frombuffer(bank['wave_data'], dtype=np.uint8).reshape(-1, WAVE_SIZE)
+    if wave_layout == 'keyframe':
+        return np.concatenate(decode_keyframes(bank['frame_data'], waves), axis=1)
+    elif wave_layout == 'dedup':
+        records = frame_data.reshape(-1, frame_size)
+        wave_indices = records[:, 2].astype(np.intp) | (records[:, 3].astype(np.intp) << 8)
+        return np.concatenate([records[:, 0:2], waves[wave_indices]], axis=1)
+    else:
+        return frame_data.reshape(-1, FRAME_SIZE)
+
+
+def decode_frames(mod_data):
+    # Unpack the frame records of a layout from moddata.build_mod_data back into a
+    # FrameTable covering all samples, numbered as in the samples' first_frame (through
+    # the banks in order)
+    packed = np.concatenate([
+        decode_bank_frames(bank, mod_data['wave_layout'], mod_data['frame_size'])
+        for bank in mod_data['banks']
+    ])
+    return FrameTable.from_packed(packed.tobytes())
+
+
+def decode_patterns(mod_data):
+    # (patterns, 64, channels, 4) array of note (255 for none), sample, effect, param
+    return unpack_patterns(mod_data['pattern_data'], mod_data['pattern_offsets'])
+
+
+class Sequencer:
+    # Python equivalent of the generated play_frame: steps through the song one tick
+    # (1/60s) at a time and produces the sound register contents for each tick.
+    def __init__(self, mod_data, positions):
+        self.sample_meta = mod_data['sample_meta']
+        self.patterns = decode_patterns(mod_data)
+        frames = decode_frames(mod_data)
+        self.frame_headers = frames.packed_headers()
+        self.frame_waves = frames.packed_waves()
+        self.positions = list(positions)
+
+        self.t = 0
+        self.row_duration = 1.2*6
+        self.next_row_time = 0
+        self.row_num = -1
+        self.position_num = 0
+        self.pattern_num = self.positions[0]
+        self.song_ended = False
+        self.passes_completed = 0
+        # per channel: frame index, sample number, frames left, semitone shift, volume multiplier
+        self.channel_states = [[0, 0, 0, 0, 1] for chan in range(CHANNEL_COUNT)]
+        self.registers = np.zeros((CHANNEL_COUNT, REGISTER_SIZE), dtype=np.uint8)
+
+    def read_row(self):
+        self.row_num += 1
+        if self.row_num == 64:
+            self.row_num = 0
+            self.position_num = (self.position_num + 1) % len(self.positions)
+            if self.position_num == 0:
+                self.song_ended = True
+                self.passes_completed += 1
+            self.pattern_num = self.positions[self.position_num]
+
+        for (chan, (note_num, sample_num, effect, param)) in enumerate(self.patterns[self.pattern_num, self.row_num]):
+            # the Lua player has no handling for notes without a sample number; skip them
+            if note_num == 255 or sample_num == 0:
+                continue
+            meta = self.sample_meta[sample_num - 1]
+            state = self.channel_states[chan]
+            state[0] = meta['first_frame']
+            state[1] = sample_num
+            state[2] = meta['length']
+            state[3] = int(note_num) - meta['base_note']
+            state[4] = param / 64 if effect == 0x0c else 1
+            if effect == 0x0f:
+                self.row_duration = 1.2*param if param <= 32 else 900/param
+        self.next_row_time += self.row_duration
+
+    def tick(self):
+        # advance one tick, returning the (channels, 18) sound registers
+        if self.next_row_time <= self.t:
+            self.read_row()
+
+        registers = self.registers
+        for (chan, state) in enumerate(self.channel_states):
+            if state[1] > 0 and state[2] == 0:
+                # sample end reached
+                meta = self.sample_meta[state[1] - 1]
+                if meta['repeat_length'] > 0:
+                    state[0] = meta['repeat_frame']
+                    state[2] = meta['repeat_length']
+                else:
+                    state[1] = 0
+
+            if state[1] > 0:
+                if state[0] < len(self.frame_headers):
+                    b1, b2 = self.frame_headers[state[0]]
+                    registers[chan, 2:] = self.frame_waves[state[0]]
+                else:
+                    # past the end of the mod data, which would be truncated in the cart
+                    b1 = b2 = 0
+                    registers[chan, 2:] = 0
+                wave_freq = int(b1) | ((int(b2) & 0x0f) << 8)
+                freq = int(wave_freq * 2**(state[3]/12) + 0.5)
+                vol = int((b2 >> 4) * state[4])
+                registers[chan, 0] = freq & 0xff
+                registers[chan, 1] = ((freq >> 8) | (vol << 4)) & 0xff
+                state[0] += 1
+                state[2] -= 1
+            else:
+                registers[chan, 1] = 0
+
+        self.t += 1
+        return registers.copy()
+
+    def iter_chunks(self, chunk_ticks=60, max_ticks=None):
+        # Yield (ticks, channels, 18) register arrays until the song has played through
+        # once (or max_ticks have passed)
+        ticks = 0
+        while not self.song_ended and (max_ticks is None or ticks < max_ticks):
+            count = chunk_ticks if max_ticks is None else min(chunk_ticks, max_ticks - ticks)
+            chunk = []
+            for i in range(count):
+                registers = self.tick()
+                if self.song_ended:
+                    break
+                chunk.append(registers)
+            if chunk:
+                ticks += len(chunk)
+                yield np.stack(chunk)
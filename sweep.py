@@ -0,0 +1,249 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields, replace
+
+from analysisparams import AnalysisParams, DEFAULT_PARAMS
+from build import find_inputs, MAX_MOD_DATA
+from moddata import build_mod_data, get_average_notes, get_base_freq
+from modfile import ModFile
+from wavetable import BlockLagScores, FrameTable, analyse_wave, decode_sample
+
+
+class ModuleEvaluator:
+    # Converts one module under many analysis settings. The module is memory-mapped and
+    # its samples decoded once, and the per-block lag scores of each sample are kept so
+    # that settings which only differ in how those scores are used don't recompute them.
+    def __init__(self, filename):
+        self.filename = filename
+        self.mod = ModFile.open(filename, lazy=True)
+        notes = get_average_notes(self.mod)
+        self.base_freqs = [get_base_freq(notes[i]) for i in range(len(self.mod.samples))]
+        self.waves = [
+            decode_sample(sample.data) if sample.length > 0 else None
+            for sample in self.mod.samples
+        ]
+        self.lag_scores = {}
+
+    def get_lag_scores(self, i, frame_rate):
+        key = (i, frame_rate)
+        if key not in self.lag_scores:
+            self.lag_scores[key] = BlockLagScores(self.waves[i], self.base_freqs[i], frame_rate)
+        return self.lag_scores[key]
+
+    def evaluate(self, params, max_waves='fit'):
+        wavetables = []
+        for (i, wave) in enumerate(self.waves):
+            if wave is None:
+                wavetables.append(FrameTable.empty())
+            else:
+                lag_scores = self.get_lag_scores(i, params.frame_rate)
+                wavetables.append(FrameTable(*analyse_wave(
+                    wave, self.base_freqs[i], params=params, lag_scores=lag_scores
+                )))
+        layout = build_mod_data(
+            self.mod, max_waves=max_waves, metrics=True, params=params, wavetables=wavetables
+        )
+        metrics = layout['metrics']
+        return {
+            'size': len(layout['mod_data']),
+            'snr_db': metrics['snr_db'],
+            'log_spectral_distance_db': metrics['log_spectral_distance_db'],
+            'noise_fraction': metrics['noise_fraction'],
+            'frames': metrics['frames'],
+        }
+
+
+def evaluate_settings(filename, settings, max_waves='fit'):
+    evaluator = ModuleEvaluator(filename)
+    with evaluator.mod:
+        return [evaluator.evaluate(params, max_waves) for params in settings]
+
+
+def parse_values(spec, field_type):
+    # "a,b,c" for a list of values, or "low:high" for a range to sample from
+    if ':' in spec:
+        low, high = spec.split(':')
+        return (field_type(low), field_type(high))
+    return [field_type(value) for value in spec.split(',')]
+
+
+def make_settings(variations, count=None, seed=0):
+    # Every combination of the listed values, or with count, that many random settings
+    # drawn from the lists and ranges in variations (a dict of parameter name to values)
+    if count is None:
+        names = list(variations)
+        for values in variations.values():
+            if isinstance(values, tuple):
+                raise ValueError("Ranges can only be used with a random search")
+        return [
+            replace(DEFAULT_PARAMS, **dict(zip(names, combination)))
+            for combination in itertools.product(*variations.values())
+        ]
+
+    rng = random.Random(seed)
+    types = {field.name: field.type for field in fields(AnalysisParams)}
+    settings = []
+    for i in range(count):
+        values = {}
+        for (name, choices) in variations.items():
+            if isinstance(choices, tuple):
+                low, high = choices
+                values[name] = rng.randint(low, high) if types[name] is int else rng.uniform(low, high)
+            else:
+                values[name] = rng.choice(choices)
+        settings.append(replace(DEFAULT_PARAMS, **values))
+    return settings
+
+
+def run_sweep(filenames, settings, jobs=1, max_waves='fit'):
+    # Evaluate every setting on every module, returning a list of per-module result
+    # lists indexed like settings. Work is split across processes by module, and by
+    # runs of settings within a module when there are more processes than modules.
+    chunk_count = max(1, min(len(settings), jobs // len(filenames)))
+    chunk_size = -(-len(settings) // chunk_count)
+    results = [[None] * len(filenames) for params in settings]
+    tasks = [
+        (f, start, settings[start:start + chunk_size])
+        for f in range(len(filenames))
+        for start in range(0, len(settings), chunk_size)
+    ]
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+            futures = [
+                (f, start, pool.submit(evaluate_settings, filenames[f], chunk, max_waves))
+                for (f, start, chunk) in tasks
+            ]
+            outputs = [(f, start, future.result()) for (f, start, future) in futures]
+    else:
+        outputs = [(f, start, evaluate_settings(filenames[f], chunk, max_waves)) for (f, start, chunk) in tasks]
+
+    for (f, start, chunk_results) in outputs:
+        for (j, result) in enumerate(chunk_results):
+            results[start + j][f] = result
+    return results
+
+
+def summarise(settings, results):
+    # combine per-module results for each setting, and mark those on the quality/size
+    # Pareto front (no other setting is both smaller and closer to the original)
+    summaries = []
+    for (params, module_results) in zip(settings, results):
+        frames = sum(r['frames'] for r in module_results)
+        distances = [r['log_spectral_distance_db'] for r in module_results]
+        snrs = [r['snr_db'] for r in module_results]
+        summaries.append({
+            'params': {field.name: getattr(params, field.name) for field in fields(params)},
+            'total_size': sum(r['size'] for r in module_results),
+            'over_budget': sum(1 for r in module_results if r['size'] > MAX_MOD_DATA),
+            'log_spectral_distance_db': (
+                sum(d * r['frames'] for (d, r) in zip(distances, module_results) if d is not None) / frames
+                if frames else None
+            ),
+            'snr_db': (
+                sum(s for s in snrs if s is not None) / len([s for s in snrs if s is not None])
+                if any(s is not None for s in snrs) else None
+            ),
+            'noise_fraction': (
+                sum(r['noise_fraction'] * r['frames'] for r in module_results if r['noise_fraction'] is not None) / frames
+                if frames else None
+            ),
+            'modules': module_results,
+        })
+
+    def quality(summary, metric):
+        value = summary[metric]
+        if value is None:
+            return float('inf')
+        return -value if metric == 'snr_db' else value
+
+    for metric in ('log_spectral_distance_db', 'snr_db'):
+        for summary in summaries:
+            summary.setdefault('pareto', {})[metric] = not any(
+                quality(other, metric) <= quality(summary, metric) and other['total_size'] <= summary['total_size']
+                and (quality(other, metric) < quality(summary, metric) or other['total_size'] < summary['total_size'])
+                for other in summaries
+            )
+    return summaries
+
+
+def print_ranking(summaries, metric, limit=None):
+    names = [field.name for field in fields(AnalysisParams)]
+    ranked = sorted(
+        summaries,
+        key=lambda s: (float('inf') if s[metric] is None else (-s[metric] if metric == 'snr_db' else s[metric]))
+    )
+    print("  ".join(["%8s" % "LSD dB", "%7s" % "SNR dB", "%6s" % "noise", "%8s" % "size", "P"] + names))
+    for summary in ranked[:limit]:
+        print("  ".join([
+            "%8s" % ("%.2f" % summary['log_spectral_distance_db'] if summary['log_spectral_distance_db'] is not None else "-"),
+            "%7s" % ("%.2f" % summary['snr_db'] if summary['snr_db'] is not None else "-"),
+            "%5.1f%%" % (100 * (summary['noise_fraction'] or 0)),
+            "%8d" % summary['total_size'],
+            "*" if summary['pareto'][metric] else " ",
+        ] + ["%*s" % (len(name), format_param(summary['params'][name])) for name in names]))
+
+
+def format_param(value):
+    # to the precision of the metric columns, as random settings have long fractions
+    return "%.2f" % value if isinstance(value, float) else str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare wavetable analysis settings by conversion quality and packed size"
+    )
+    parser.add_argument('inputs', nargs='+', help="MOD files, or directories to search for them")
+    parser.add_argument('--vary', action='append', default=[], metavar='NAME=VALUES',
+        help="parameter to vary, as a comma-separated list of values or (for --random) a "
+             "low:high range; may be repeated. Parameters: %s" % ", ".join(
+                 field.name for field in fields(AnalysisParams)
+             ))
+    parser.add_argument('--random', type=int, metavar='N',
+        help="evaluate N random settings instead of every combination")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument('--metric', choices=['lsd', 'snr'], default='lsd',
+        help="quality metric to rank by (default: lsd, log-spectral distance)")
+    parser.add_argument('--max-waves', choices=['fit', 'off'], default='fit',
+        help="whether to merge waves to fit the size budget, as for build.py (default: fit)")
+    parser.add_argument('--top', type=int, help="show only the best N settings")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('--json', help="write full results to this file")
+    args = parser.parse_args()
+
+    types = {field.name: field.type for field in fields(AnalysisParams)}
+    variations = {}
+    for spec in args.vary:
+        name, _, values = spec.partition('=')
+        name = name.strip().replace('-', '_')
+        if name not in types:
+            parser.error("Unknown analysis parameter: %r" % name)
+        variations[name] = parse_values(values, types[name])
+    try:
+        settings = make_settings(variations, args.random, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+
+    filenames = find_inputs(args.inputs)
+    if not filenames:
+        parser.error("no MOD files found")
+    start_time = time.perf_counter()
+    results = run_sweep(filenames, settings, max(1, args.jobs), None if args.max_waves == 'off' else 'fit')
+    summaries = summarise(settings, results)
+    print("Evaluated %d settings on %d modules in %.1fs (* = on the quality/size Pareto front)" % (
+        len(settings), len(filenames), time.perf_counter() - start_time
+    ))
+    print_ranking(summaries, 'snr_db' if args.metric == 'snr' else 'log_spectral_distance_db', args.top)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'inputs': filenames, 'results': summaries}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import numpy as np
+
+
+SAMPLE_RATE = 44100
+TICK_RATE = 60
+
+
+class Synth:
+    # Renders TIC-80 sound register contents to audio: each channel loops its 32-nibble
+    # wave at the register frequency, scaled by volume. As on TIC-80, a channel whose
+    # wave is all zeros plays noise instead.
+    def __init__(self, sample_rate=SAMPLE_RATE, channel_count=4, seed=0, tick_rate=TICK_RATE):
+        self.sample_rate = sample_rate
+        self.samples_per_tick = int(sample_rate // tick_rate)
+        self.phases = np.zeros(channel_count)
+        self.noise = np.random.default_rng(seed).choice([-1.0, 1.0], size=0x8000)
+
+    def render(self, registers):
+        # (ticks, channels, 18) registers to a float32 array of ticks * samples_per_tick samples
+        freqs = registers[:, :, 0] | ((registers[:, :, 1].astype(np.intp) & 0x0f) << 8)
+        volumes = (registers[:, :, 1] >> 4) / 15
+        waves = np.empty(registers.shape[:2] + (32,), dtype=np.uint8)
+        waves[:, :, 0::2] = registers[:, :, 2:] & 0x0f
+        waves[:, :, 1::2] = registers[:, :, 2:] >> 4
+        return self.render_levels(freqs, volumes, waves / 7.5 - 1, ~waves.any(axis=2))
+
+    def render_levels(self, freqs, volumes, levels, noisy):
+        # Mix channels given (ticks, channels) arrays of frequency, volume and noise flag,
+        # and a (ticks, channels, 32) array of wave levels
+        tick_count, channel_count = freqs.shape
+
+        # position within the wave (in nibbles) of every output sample, continuing the
+        # phase of each channel from the previous call
+        steps = freqs * 32 / self.sample_rate
+        tick_starts = self.phases + np.concatenate(
+            [np.zeros((1, channel_count)), np.cumsum(steps * self.samples_per_tick, axis=0)]
+        )
+        self.phases = tick_starts[-1] % len(self.noise)  # a multiple of the 32-nibble wave
+        positions = (
+            tick_starts[:-1, :, None]
+            + steps[:, :, None] * np.arange(self.samples_per_tick)
+        ).astype(np.intp)
+
+        ticks = np.arange(tick_count)[:, None, None]
+        channels = np.arange(channel_count)[None, :, None]
+        values = np.where(
+            noisy[:, :, None],
+            self.noise[positions % len(self.noise)],
+            levels[ticks, channels, positions % 32],
+        )
+        mix = (values * volumes[:, :, None]).sum(axis=1) / channel_count
+        return mix.reshape(-1).astype(np.float32)
@@ -0,0 +1,29 @@
+import pytest
+
+from analysisparams import AnalysisParams, DEFAULT_PARAMS
+
+
+def test_parse():
+    params = AnalysisParams.parse(['start_offset=5', 'confidence-threshold=1.1'])
+    assert params.start_offset == 5
+    assert params.confidence_threshold == 1.1
+    assert params.noise_amplitude == DEFAULT_PARAMS.noise_amplitude
+
+
+def test_parse_unknown_name():
+    with pytest.raises(ValueError):
+        AnalysisParams.parse(['no_such_param=1'])
+
+
+@pytest.mark.parametrize('assignment', [
+    'start_offset=0', 'start_offset=3', 'noise_amplitude=16', 'noise_amplitude=-1',
+    'confidence_threshold=0', 'fallback_freq=0', 'fallback_freq=-220', 'frame_rate=0',
+])
+def test_parse_rejects_out_of_range(assignment):
+    with pytest.raises(ValueError):
+        AnalysisParams.parse([assignment])
+
+
+@pytest.mark.parametrize('assignment', ['start_offset=4', 'noise_amplitude=0', 'noise_amplitude=15'])
+def test_parse_accepts_limits(assignment):
+    AnalysisParams.parse([assignment])
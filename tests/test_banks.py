@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from banks import plan_banks, sample_overlaps
+
+
+def test_fits_in_one_bank():
+    overlaps = np.zeros((4, 4), dtype=np.int64)
+    assert plan_banks([100, 0, 200], [set(), set(), set()], 16, 1000, overlaps) == [[0, 1, 2]]
+
+
+def test_samples_playing_together_share_a_bank():
+    # samples 1 and 3 (0-based 0 and 2) always play together, as do 2 and 4
+    samples = np.array([[1, 3, 0, 0], [2, 4, 0, 0]] * 10)
+    overlaps = sample_overlaps(samples, 4)
+    banks = plan_banks([500, 400, 300, 300], [set()] * 4, 16, 800, overlaps)
+    assert sorted(banks) == [[0, 2], [1, 3]]
+
+
+def test_shared_waves_count_once():
+    overlaps = np.zeros((3, 3), dtype=np.int64)
+    waves = [{1, 2, 3}, {1, 2, 3}]
+    assert plan_banks([10, 10], waves, 16, 10 + 10 + 3 * 16, overlaps) == [[0, 1]]
+
+
+def test_sample_too_big():
+    with pytest.raises(ValueError):
+        plan_banks([2000], [set()], 16, 1000, np.zeros((2, 2), dtype=np.int64))
@@ -0,0 +1,38 @@
+from manifest import BuildManifest, MANIFEST_VERSION, manifest_filename_for
+
+KEYS = {'mod': 'm1', 'data': 'd1', 'template': 't1'}
+
+
+def manifest():
+    return BuildManifest(dict(KEYS), {'player': 'sequencer'}, [0, 1], {'mod_data_size': 100})
+
+
+def test_up_to_date():
+    assert manifest().stale_parts(dict(KEYS)) == set()
+
+
+def test_template_changed():
+    assert manifest().stale_parts(dict(KEYS, template='t2')) == {'code'}
+
+
+def test_mod_or_data_changed():
+    assert manifest().stale_parts(dict(KEYS, mod='m2')) == {'code', 'data'}
+    assert manifest().stale_parts(dict(KEYS, data='d2')) == {'code', 'data'}
+    assert manifest().stale_parts(dict(KEYS, data='d2', template='t2')) == {'code', 'data'}
+
+
+def test_save_and_load(tmp_path):
+    filename = manifest_filename_for(str(tmp_path / 'song.tic'))
+    manifest().save(filename)
+    loaded = BuildManifest.load(filename)
+    assert loaded.keys == KEYS
+    assert loaded.positions == [0, 1]
+    assert loaded.stale_parts(dict(KEYS)) == set()
+
+
+def test_load_other_version(tmp_path):
+    filename = str(tmp_path / 'song.manifest.json')
+    with open(filename, 'w') as f:
+        f.write('{"version": %d, "keys": {}}' % (MANIFEST_VERSION - 1))
+    assert BuildManifest.load(filename) is None
+    assert BuildManifest.load(str(tmp_path / 'missing.manifest.json')) is None
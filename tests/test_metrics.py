@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from metrics import aligned_energies
+
+
+def test_aligned_energies_ignore_phase():
+    # a tone against the same tone starting at another phase is a near perfect match
+    t = np.arange(1390)
+    original = np.sin(2 * np.pi * t / 37.3)
+    shifted = np.sin(2 * np.pi * t / 37.3 + 1.7)
+    signal_energy, error_energy = aligned_energies(original, shifted, 139)
+    assert signal_energy == np.sum(original ** 2)
+    assert error_energy < 1e-3 * signal_energy
+    assert np.sum((original - shifted) ** 2) > signal_energy
+
+
+def test_aligned_energies_brute_force():
+    rng = np.random.default_rng(1)
+    original = rng.normal(size=700)
+    resynthesised = rng.normal(size=700)
+    hop = 70
+    padded = np.concatenate([np.zeros(hop), resynthesised, np.zeros(hop)])
+    expected = sum(
+        min(np.sum((original[k * hop:(k + 1) * hop] - padded[k * hop + j:k * hop + j + hop]) ** 2)
+            for j in range(2 * hop + 1))
+        for k in range(len(original) // hop)
+    )
+    assert aligned_energies(original, resynthesised, hop)[1] == pytest.approx(expected)
+
+
+def test_aligned_energies_short():
+    assert aligned_energies(np.ones(50), np.ones(50), 139) == (0.0, 0.0)
@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import pytest
+
+from modfile import CELL_DTYPE, PERIODS, ModFile, decode_cells, period2note, period2notenum
+
+
+def test_period2notenum():
+    assert [period2notenum(period) for period in PERIODS] == list(range(len(PERIODS)))
+    assert period2notenum(0) is None
+    assert period2notenum(1000) is None
+    # beyond the 12 bits of a pattern cell, as a nonstandard module might have
+    assert period2notenum(4096) is None
+    assert period2notenum(70000) is None
+    assert period2notenum(-1) is None
+
+
+def test_period2note():
+    assert period2note(PERIODS[12]) == "C-1"
+    assert period2note(5000) == "---"
+
+
+def test_decode_cells():
+    # sample 0x1a, period PERIODS[5], effect 0xc with param 0x20; then an empty cell
+    period = PERIODS[5]
+    cells = np.array([
+        [0x10 | (period >> 8), period & 0xff, 0xac, 0x20],
+        [0, 0, 0, 0],
+    ], dtype=np.uint8)
+    decoded = decode_cells(cells)
+    assert decoded.dtype == CELL_DTYPE
+    assert decoded.tolist() == [(5, 0x1a, 0x0c, 0x20), (-1, 0, 0, 0)]
+
+
+def guitarou_filename():
+    return os.path.join(os.path.dirname(__file__), '..', 'GUITAROU.MOD')
+
+
+def test_lazy_matches_eager():
+    eager = ModFile.open(guitarou_filename())
+    with ModFile.open(guitarou_filename(), lazy=True) as lazy:
+        assert lazy.positions == eager.positions
+        assert lazy.pattern_count == eager.pattern_count
+        assert np.array_equal(lazy.pattern_array, eager.pattern_array)
+        for (lazy_sample, eager_sample) in zip(lazy.samples, eager.samples):
+            assert bytes(lazy_sample.data) == bytes(eager_sample.data)
+
+
+def test_close_with_views_in_use():
+    mod = ModFile.open(guitarou_filename(), lazy=True)
+    data = np.frombuffer(mod.samples[0].data, dtype=np.int8)
+    with pytest.raises(BufferError):
+        mod.close()
+    del data
+    mod.close()
+    assert mod._buffer.closed
@@ -0,0 +1,45 @@
+import numpy as np
+
+from modfile import CELL_DTYPE
+from patterncodec import CHANNEL_COUNT, PLAYED_EFFECTS, ROW_COUNT, decode_patterns, encode_patterns
+
+
+def random_cells(pattern_count, sample_count, seed=0):
+    # patterns with mostly empty rows, so that both notes and runs of empty rows get packed
+    rng = np.random.default_rng(seed)
+    cells = np.zeros((pattern_count, ROW_COUNT, CHANNEL_COUNT), dtype=CELL_DTYPE)
+    shape = cells.shape
+    cells['note'] = np.where(rng.random(shape) < 0.2, rng.integers(0, 36, shape), -1)
+    cells['sample'] = rng.integers(0, sample_count + 3, shape)
+    cells['effect'] = rng.choice([0x00, 0x0c, 0x0f, 0x0a], shape)
+    cells['param'] = rng.integers(0, 256, shape)
+    return cells
+
+
+def test_round_trip():
+    sample_count = 8
+    cells = random_cells(6, sample_count)
+    positions = [3, 0, 3, 5, 0]
+    data, offsets, renumbered = encode_patterns(cells, positions, sample_count)
+    patterns = decode_patterns(data, offsets)
+
+    # the patterns reached, in order of first use
+    assert len(offsets) == 3
+    assert [[3, 0, 5][i] for i in renumbered] == positions
+    for (i, pattern) in enumerate([3, 0, 5]):
+        original = cells[pattern]
+        played = (original['note'] >= 0) & (original['sample'] >= 1) & (original['sample'] <= sample_count)
+        has_effect = played & np.isin(original['effect'], PLAYED_EFFECTS)
+        assert np.array_equal(patterns[i, ..., 0], np.where(played, original['note'], 255))
+        assert np.array_equal(patterns[i, ..., 1], np.where(played, original['sample'], 0))
+        assert np.array_equal(patterns[i, ..., 2], np.where(has_effect, original['effect'], 0))
+        assert np.array_equal(patterns[i, ..., 3], np.where(has_effect, original['param'], 0))
+
+
+def test_empty_patterns():
+    cells = np.zeros((1, ROW_COUNT, CHANNEL_COUNT), dtype=CELL_DTYPE)
+    cells['note'] = -1
+    data, offsets, renumbered = encode_patterns(cells, [0], 1)
+    # runs of up to 16 empty rows
+    assert len(data) == ROW_COUNT // 16
+    assert (decode_patterns(data, offsets)[..., 0] == 255).all()
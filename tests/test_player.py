@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+
+from bench import make_synthetic_mod
+from build import build_cart
+from moddata import build_mod_data
+from modfile import ModFile
+from registerstream import build_register_stream, song_passes
+from sequencer import Sequencer
+from visualisers import VISUALISERS
+
+pytest.importorskip('lupa')
+from playercost import CartRunner, default_lua_runtime  # noqa: E402
+from ticfile import TICFile  # noqa: E402
+
+GUITAROU = os.path.join(os.path.dirname(__file__), '..', 'GUITAROU.MOD')
+TICKS = 1500
+
+
+def cart_registers(filename, ticks, function='play_frame'):
+    # (ticks, channels, 18) sound registers after each call of the cart's function
+    runner = CartRunner(TICFile.open(filename), default_lua_runtime())
+    fn = runner.lua.globals()[function]
+    registers = []
+    for i in range(ticks):
+        fn()
+        registers.append(runner.sound_registers())
+        runner.frame += 1
+    return np.frombuffer(b''.join(registers), dtype=np.uint8).reshape(ticks, 4, 18)
+
+
+def sequencer_registers(mod_filename, ticks, **options):
+    layout = build_mod_data(ModFile.open(mod_filename), **options)
+    sequencer = Sequencer(layout, layout['positions'])
+    return np.concatenate(list(sequencer.iter_chunks(max_ticks=ticks)))
+
+
+@pytest.mark.parametrize('wave_layout', ['raw', 'dedup', 'keyframe'])
+def test_cart_plays_as_sequencer(tmp_path, wave_layout):
+    cart = str(tmp_path / 'cart.tic')
+    build_cart(GUITAROU, cart, wave_layout=wave_layout)
+    expected = sequencer_registers(GUITAROU, TICKS, wave_layout=wave_layout)
+    assert np.array_equal(cart_registers(cart, TICKS), expected)
+
+
+@pytest.mark.parametrize('visualiser', VISUALISERS)
+def test_visualisers_leave_playback_alone(tmp_path, visualiser):
+    # each visualiser runs after play_frame in TIC, sharing memory with the player's data
+    cart = str(tmp_path / 'cart.tic')
+    build_cart(GUITAROU, cart, visualisers=[visualiser])
+    expected = sequencer_registers(GUITAROU, 30)
+    assert np.array_equal(cart_registers(cart, 30, function='TIC'), expected)
+
+
+def test_stream_player_plays_and_loops_as_sequencer(tmp_path):
+    layout = build_mod_data(ModFile.open(GUITAROU))
+    stream = build_register_stream(layout, layout['positions'])
+    (first, second), _ = song_passes(layout, layout['positions'])
+    ticks, loop_tick = stream['ticks'], stream['loop_tick']
+    assert len(first) <= ticks <= len(first) + len(second)
+    assert 0 <= loop_tick < len(first)
+    assert stream['raw_size'] == ticks * 4 * 18
+    assert stream['spans'][-1]['end'] == len(stream['data'])
+
+    cart = str(tmp_path / 'cart.tic')
+    build_cart(GUITAROU, cart, player='stream')
+    registers = cart_registers(cart, ticks + 300)
+    # the stored ticks are the first pass and as much of the second as differs from it,
+    # after which the player goes back to the loop tick
+    assert np.array_equal(registers[:ticks], np.concatenate([first, second])[:ticks])
+    assert np.array_equal(registers[ticks:], registers[loop_tick:loop_tick + 300])
+
+
+def test_cart_plays_two_banks_as_sequencer(tmp_path):
+    # 31 long samples stored as raw frames need a second bank, which the player syncs in
+    # for the samples kept there
+    mod_filename = str(tmp_path / 'synthetic.mod')
+    with open(mod_filename, 'wb') as f:
+        f.write(make_synthetic_mod(patterns=4))
+    options = {'wave_layout': 'raw', 'max_waves': None, 'banks': 2}
+    cart = str(tmp_path / 'cart.tic')
+    assert len(build_cart(mod_filename, cart, **options)['bank_sizes']) == 2
+    expected = sequencer_registers(mod_filename, TICKS, **options)
+    assert np.array_equal(cart_registers(cart, TICKS), expected)
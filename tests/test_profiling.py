@@ -0,0 +1,22 @@
+import os
+
+import numpy as np
+
+from modfile import ModFile
+from profiling import NullProfiler, profiler, run_profiled
+from wavetable import decode_sample, make_wavetable
+
+
+def test_counters_match_between_analysis_paths():
+    # the batched and per-block analyses count the same blocks and resampled waves
+    mod = ModFile.open(os.path.join(os.path.dirname(__file__), '..', 'GUITAROU.MOD'))
+    mono_wave = decode_sample(mod.samples[0].data)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        batched, batched_profile = run_profiled(False, make_wavetable, mono_wave, 8000)
+        blockwise, blockwise_profile = run_profiled(False, make_wavetable, mono_wave, 8000, 'loop', False)
+    for name in ('blocks_analysed', 'low_confidence', 'waves_resampled'):
+        assert batched_profile['counters'].get(name, 0) == blockwise_profile['counters'].get(name, 0)
+    assert batched_profile['counters']['waves_resampled'] > 0
+    # resampling is batched by period
+    assert batched_profile['counters']['interp_calls'] < blockwise_profile['counters']['interp_calls']
+    assert isinstance(profiler(), NullProfiler)
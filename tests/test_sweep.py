@@ -0,0 +1,32 @@
+import pytest
+
+from analysisparams import DEFAULT_PARAMS
+from sweep import format_param, make_settings
+
+
+def test_make_settings_grid():
+    settings = make_settings({'start_offset': [5, 10], 'fallback_freq': [110.0, 220.0, 440.0]})
+    assert len(settings) == 6
+    assert {(s.start_offset, s.fallback_freq) for s in settings} == {
+        (offset, freq) for offset in (5, 10) for freq in (110.0, 220.0, 440.0)
+    }
+    assert all(s.noise_amplitude == DEFAULT_PARAMS.noise_amplitude for s in settings)
+
+
+def test_make_settings_random():
+    settings = make_settings({'start_offset': (5, 12), 'fallback_freq': (100.0, 400.0)}, count=20)
+    assert len(settings) == 20
+    assert all(5 <= s.start_offset <= 12 and 100 <= s.fallback_freq <= 400 for s in settings)
+    assert settings == make_settings({'start_offset': (5, 12), 'fallback_freq': (100.0, 400.0)}, count=20)
+
+
+def test_make_settings_rejects_bad_values():
+    with pytest.raises(ValueError):
+        make_settings({'start_offset': [0, 10]})
+    with pytest.raises(ValueError):
+        make_settings({'start_offset': (5, 12)})
+
+
+def test_format_param():
+    assert format_param(327.38632088209073) == "327.39"
+    assert format_param(10) == "10"
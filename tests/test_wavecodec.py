@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from sequencer import decode_bank_frames
+from wavecodec import (
+    KEYFRAME_RUN_LENGTH, WaveDictionary, decode_keyframes, encode_frame_refs, encode_keyframes,
+    quantise_wavetables,
+)
+from wavetable import FrameTable, FRAME_SIZE
+
+
+def repeating_table(seed=0, frame_count=200, wave_count=12):
+    # frames drawing their waves from a small set, so that most repeat
+    rng = np.random.default_rng(seed)
+    waves = rng.integers(0, 16, (wave_count, 32))
+    return FrameTable(
+        rng.integers(0, 4096, frame_count), rng.integers(0, 16, frame_count),
+        waves[rng.integers(0, wave_count, frame_count)]
+    )
+
+
+def test_wave_dictionary():
+    table = repeating_table()
+    dictionary = WaveDictionary()
+    indices = dictionary.add(table.packed_waves())
+    assert len(dictionary) == len(np.unique(table.waves, axis=0))
+    # waves already in the dictionary keep their index
+    assert np.array_equal(dictionary.add(table.packed_waves()), indices)
+    assert len(dictionary) == len(np.unique(table.waves, axis=0))
+    waves = np.frombuffer(dictionary.packed_data(), dtype=np.uint8).reshape(-1, 16)
+    assert np.array_equal(waves[indices], table.packed_waves())
+
+
+def test_frame_refs_round_trip():
+    table = repeating_table(1)
+    dictionary = WaveDictionary()
+    indices = dictionary.add(table.packed_waves())
+    bank = {
+        'frame_data': encode_frame_refs(table, indices).tobytes(),
+        'wave_data': dictionary.packed_data(),
+    }
+    packed = decode_bank_frames(bank, 'dedup', 4)
+    assert np.array_equal(packed, table.packed())
+    assert packed.shape == (len(table), FRAME_SIZE)
+
+
+def test_quantise_wavetables():
+    tables = [repeating_table(2, wave_count=40), repeating_table(3, frame_count=50, wave_count=30)]
+    # one all-zero wave, which is kept as it is
+    tables[1].waves[7] = 0
+    quantised, error = quantise_wavetables(tables, 20)
+    waves = np.concatenate([table.waves for table in quantised])
+    assert len(np.unique(waves, axis=0)) <= 20
+    assert not waves[len(tables[0]) + 7].any()
+    assert 0 < error < 8
+    for (table, new_table) in zip(tables, quantised):
+        assert np.array_equal(table.frequencies, new_table.frequencies)
+        assert np.array_equal(table.amplitudes, new_table.amplitudes)
+
+
+def test_quantise_wavetables_already_small():
+    tables = [repeating_table(4, wave_count=5)]
+    quantised, error = quantise_wavetables(tables, 5)
+    assert quantised is tables and error == 0.0
+
+
+def test_quantise_wavetables_too_few():
+    tables = [repeating_table(5)]
+    tables[0].waves[0] = 0
+    with pytest.raises(ValueError):
+        quantise_wavetables(tables, 1)
+
+
+def sustained_table(seed=0):
+    # frames that hold a wave and header for a while before changing, with some runs
+    # longer than KEYFRAME_RUN_LENGTH
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 2 * KEYFRAME_RUN_LENGTH, 12)
+    waves = np.repeat(rng.integers(0, 16, (len(lengths), 32)), lengths, axis=0)
+    frame_count = len(waves)
+    frequencies = np.repeat(rng.integers(0, 4096, frame_count // 3 + 1), 3)[:frame_count]
+    amplitudes = np.repeat(rng.integers(0, 16, frame_count // 5 + 1), 5)[:frame_count]
+    return FrameTable(frequencies, amplitudes, waves)
+
+
+def test_keyframe_round_trip():
+    table = sustained_table()
+    dictionary = WaveDictionary()
+    wave_indices = dictionary.add(table.packed_waves())
+    data, offsets = encode_keyframes(table, wave_indices, keys=[7])
+    waves = np.frombuffer(dictionary.packed_data(), dtype=np.uint8).reshape(-1, 16)
+    headers, frame_waves = decode_keyframes(data, waves)
+    assert np.array_equal(headers, table.packed_headers())
+    assert np.array_equal(frame_waves, table.packed_waves())
+    assert len(offsets) == len(table) and offsets[0] == 0
+    assert len(data) < len(table) * 4
+
+
+def test_keyframe_runs_restart_at_keys():
+    table = sustained_table(1)
+    wave_indices = WaveDictionary().add(table.packed_waves())
+    data, offsets = encode_keyframes(table, wave_indices, keys=[20])
+    # frame 20 starts a run that names its wave, so the player can jump straight to it
+    waves = np.zeros((len(set(wave_indices.tolist())) + 1, 16), dtype=np.uint8)
+    headers, frame_waves = decode_keyframes(data[offsets[20]:], waves)
+    assert np.array_equal(headers, table.packed_headers()[20:])
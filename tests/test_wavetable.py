@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pytest
+
+from wavetable import FrameTable, PERIOD_BACKENDS, decode_sample, get_period, make_wavetable, resample
+
+
+def blocks():
+    # a block of noise, a pure tone and a tone with harmonics, as the analysis sees them
+    rng = np.random.default_rng(1)
+    t = np.arange(1200)
+    yield decode_sample(rng.integers(-128, 128, len(t), dtype=np.int8).tobytes())
+    yield decode_sample(np.round(100 * np.sin(2 * np.pi * t / 36.81)).astype(np.int8).tobytes())
+    yield decode_sample(np.round(
+        60 * np.sin(2 * np.pi * t / 91.7) + 40 * np.sin(2 * np.pi * t / 30.57)
+    ).astype(np.int8).tobytes())
+
+
+@pytest.mark.parametrize('start_offset', [4, 10])
+def test_period_backends_agree(start_offset):
+    for block in blocks():
+        results = [
+            get_period(block, len(block) // 2, backend, start_offset) for backend in PERIOD_BACKENDS
+        ]
+        for (period, confidence) in results[1:]:
+            assert period == results[0][0]
+            assert confidence == pytest.approx(results[0][1])
+
+
+def test_period_of_tone():
+    block = list(blocks())[1]
+    period, confidence = get_period(block, len(block) // 2)
+    # a whole number of cycles, near enough
+    cycles = round(period / 36.81)
+    assert cycles >= 1 and abs(period - cycles * 36.81) < 1
+    assert confidence > 1.3
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_period(list(blocks())[0], 600, 'fft')
+
+
+@pytest.fixture(scope='module')
+def guitarou():
+    from modfile import ModFile
+    return ModFile.open(os.path.join(os.path.dirname(__file__), '..', 'GUITAROU.MOD'))
+
+
+@pytest.mark.parametrize('samplerate', [4000, 8000, 11084])
+def test_batched_analysis_matches_blocks(guitarou, samplerate):
+    # the batched analysis gives the same frames as analysing one block at a time, at
+    # rates where rounding of the resampled waves used to differ between the two
+    for sample in guitarou.samples:
+        if sample.length == 0:
+            continue
+        mono_wave = decode_sample(sample.data)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            batched = make_wavetable(mono_wave, samplerate)
+            blockwise = make_wavetable(mono_wave, samplerate, backend='loop', batch=False)
+        assert np.array_equal(batched.frequencies, blockwise.frequencies)
+        assert np.array_equal(batched.amplitudes, blockwise.amplitudes)
+        assert np.array_equal(batched.waves, blockwise.waves)
+
+
+@pytest.mark.parametrize('period', [4, 5, 17, 100])
+def test_resample_reproduces_cubics(period):
+    # a not-a-knot cubic spline through points of a cubic is the cubic itself
+    def cubic(x):
+        return 2 * x ** 3 - 3 * x ** 2 + 0.5 * x - 0.25
+    resampled = resample(cubic(np.linspace(0, 1, period)))
+    assert resampled == pytest.approx(cubic(np.linspace(0, 1, 32)))
+
+
+def test_resample_batch():
+    rng = np.random.default_rng(3)
+    waves = rng.normal(size=(5, 23))
+    assert np.array_equal(resample(waves), np.stack([resample(wave) for wave in waves]))
+    assert resample(waves).shape == (5, 32)
+
+
+def random_table(frame_count, seed=2):
+    rng = np.random.default_rng(seed)
+    return FrameTable(
+        rng.integers(0, 4096, frame_count), rng.integers(0, 16, frame_count),
+        rng.integers(0, 16, (frame_count, 32))
+    )
+
+
+@pytest.mark.parametrize('frame_count', [0, 1, 50])
+def test_frame_table_round_trip(frame_count):
+    table = random_table(frame_count)
+    unpacked = FrameTable.from_packed(bytes(table.packed_data()))
+    assert np.array_equal(unpacked.frequencies, table.frequencies)
+    assert np.array_equal(unpacked.amplitudes, table.amplitudes)
+    assert np.array_equal(unpacked.waves, table.waves)
+
+
+def test_frame_table_matches_frames():
+    table = random_table(10)
+    frames = [table[i] for i in range(len(table))]
+    assert bytes(FrameTable.from_frames(frames).packed_data()) == bytes(table.packed_data())
+    assert b''.join(frame.packed_data() for frame in frames) == bytes(table.packed_data())
+    concatenated = FrameTable.concatenate([table, FrameTable.empty(), random_table(3, seed=4)])
+    assert len(concatenated) == 13
+    assert np.array_equal(concatenated.waves[:10], table.waves)
@@ -0,0 +1,296 @@
+import math
+
+# The visualisers draw in the area above the scroller, 240x96 pixels of 4 bits each,
+# and are shown in turn, each for 15360ms, in this order
+VISUALISERS = ['oscilloscope', 'firescope', 'circularscope', 'zoomscope']
+
+# Lua instructions per frame of each visualiser, as measured by
+# `playercost.py --function NAME` on a cart built from GUITAROU.MOD; used to pick the
+# visualisers that fit a budget
+VISUALISER_COSTS = {
+    'oscilloscope': 23188,
+    'firescope': 105279,
+    'circularscope': 271411,
+    'zoomscope': 49510,
+}
+
+SCOPE_WIDTH = 240
+SCOPE_HEIGHT = 96
+ROW_BYTES = SCOPE_WIDTH // 2
+
+# zoomscope's scale factor from one frame to the next
+ZOOM = 1.1
+
+# circularscope draws bands BAND_WIDTH pixels wide around the centre. Its angle and
+# radius maps cover the lower right quadrant of the scope area, the other three being
+# mirror images, and are stored in cart memory after the mod data: a byte per pixel of
+# angle, in 1/119ths of a half turn, then a byte per pixel of distance from the
+# centre, in 1/RADIUS_SCALE ths of a band
+BAND_WIDTH = 24
+RADIUS_SCALE = 40
+QUADRANT_WIDTH = SCOPE_WIDTH // 2
+QUADRANT_HEIGHT = SCOPE_HEIGHT // 2
+CIRCLE_MAP_SIZE = QUADRANT_WIDTH * QUADRANT_HEIGHT
+
+# bytes of cart memory that each visualiser's lookup tables take up
+VISUALISER_DATA_SIZES = {
+    'oscilloscope': 0,
+    'firescope': 0,
+    'circularscope': 2 * CIRCLE_MAP_SIZE,
+    'zoomscope': 0,
+}
+
+
+def plan_visualisers(free_bytes, names=None, budget=None):
+    # The visualisers to include, in play order: those in names (default: all) that cost
+    # no more than budget Lua instructions per frame (default: no limit), and whose
+    # lookup tables fit in the free_bytes of cart memory left after the mod data
+    selected = []
+    for name in VISUALISERS:
+        if names is not None and name not in names:
+            continue
+        if budget is not None and VISUALISER_COSTS[name] > budget:
+            continue
+        if VISUALISER_DATA_SIZES[name] > free_bytes:
+            continue
+        selected.append(name)
+        free_bytes -= VISUALISER_DATA_SIZES[name]
+    return selected
+
+
+def parse_visualisers(value):
+    # comma-separated visualiser names, for the command line
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    for name in names:
+        if name not in VISUALISERS:
+            raise ValueError("Unknown visualiser: %r (choose from %s)" % (name, ", ".join(VISUALISERS)))
+    return names
+
+
+def circle_maps():
+    # angle and radius maps for circularscope, as bytes (numpy is only loaded when
+    # building the mod data that they go with)
+    import numpy as np
+    y0, x0 = np.mgrid[0:QUADRANT_HEIGHT, 0:QUADRANT_WIDTH] + 0.5
+    angles = np.floor(np.arctan2(x0, y0) / math.pi * 119)
+    radii = np.round(np.hypot(x0, y0) / BAND_WIDTH * RADIUS_SCALE)
+    return angles.astype(np.uint8).tobytes() + radii.astype(np.uint8).tobytes()
+
+
+def fire_fade_table():
+    # for each byte of the screen (a pair of pixels, low nibble on the left), the byte
+    # that firescope replaces the one above it with: the pair, blurred and dimmed
+    table = []
+    for byte in range(256):
+        left, right = byte & 0x0f, byte >> 4
+        table.append(int((3 * left + right) / 4.1) | (int((left + 3 * right) / 4.1) << 4))
+    return table
+
+
+def zoom_tables():
+    # zoomscope's copying plan, in byte offsets within the screen. rows lists pairs of
+    # (row to write, row further from the centre to copy it from, or -1 to clear it),
+    # nearest the centre first, so that every row is copied before it is overwritten.
+    # runs lists the runs of bytes within a row as triples of (destination, source or -1
+    # to clear, length). Copying whole bytes moves pixels in pairs.
+    rows = []
+    for y in range(QUADRANT_HEIGHT):
+        distance = math.floor(y * ZOOM) + 1
+        for (dest, src) in ((QUADRANT_HEIGHT - 1 - y, QUADRANT_HEIGHT - 1 - distance),
+                            (QUADRANT_HEIGHT + y, QUADRANT_HEIGHT + distance)):
+            rows += [dest * ROW_BYTES, src * ROW_BYTES if 0 <= src < SCOPE_HEIGHT else -1]
+
+    half = ROW_BYTES // 2
+    sources = [None] * ROW_BYTES
+    for k in range(half):
+        distance = math.floor(k * ZOOM) + 1
+        right, left = half + distance, half - 1 - distance
+        sources[half + k] = right if right < ROW_BYTES else -1
+        sources[half - 1 - k] = left if left >= 0 else -1
+
+    runs = []
+    for (dest, src) in enumerate(sources):
+        if runs and runs[-3] + runs[-1] == dest and (
+            src == -1 if runs[-2] == -1 else runs[-2] + runs[-1] == src
+        ):
+            runs[-1] += 1
+        else:
+            runs += [dest, src, 1]
+    return rows, runs
+
+
+def visualiser_data(names):
+    # the lookup tables of the named visualisers, to go in cart memory after the mod data
+    return circle_maps() if 'circularscope' in names else b''
+
+
+def lua_table(values, zero_based=False):
+    return "{%s%s}" % ("[0]=" if zero_based else "", ",".join(str(v) for v in values))
+
+
+def make_visualiser_code(names, data_addr):
+    # Lua code defining the named visualisers and the list of them, for TIC() to cycle
+    # through; data_addr is where visualiser_data(names) is in memory
+    parts = []
+    for name in names:
+        if name == 'firescope':
+            parts.append("fire_fade = %s\n" % lua_table(fire_fade_table(), zero_based=True))
+        elif name == 'zoomscope':
+            rows, runs = zoom_tables()
+            parts.append("zoom_rows = %s\nzoom_runs = %s\n" % (lua_table(rows), lua_table(runs)))
+        elif name == 'circularscope':
+            parts.append(CIRCLE_MAPS_CODE % {
+                'angle_addr': data_addr, 'radius_addr': data_addr + CIRCLE_MAP_SIZE,
+                'last': CIRCLE_MAP_SIZE - 1, 'radius_scale': RADIUS_SCALE,
+            })
+        parts.append(VISUALISER_CODE[name])
+    parts.append("visualisers = {%s}\n" % ", ".join(names))
+    return "\n".join(parts)
+
+
+CIRCLE_MAPS_CODE = '''waves = {}
+for chan=0,3 do
+  waves[chan] = {}
+end
+-- for a band index that rounds up to 4 (band+0.5 a hair below a multiple of 4)
+waves[4] = waves[0]
+
+-- circularscope's angle and radius maps, read into tables once
+circle_angle = {}
+circle_radius = {}
+for i=0,%(last)d do
+  circle_angle[i] = peek(%(angle_addr)d + i)
+  circle_radius[i] = peek(%(radius_addr)d + i) / %(radius_scale)d
+end
+'''
+
+VISUALISER_CODE = {
+    'oscilloscope': '''function oscilloscope()
+  cls()
+  for chan=0,3 do
+    addr = 0xff9c+chan*18
+    a=0
+    b1 = peek(addr)
+    b2 = peek(addr+1)
+    freq = b1 | ((b2 & 0x0f) << 8)
+    ampl = b2 >> 4
+    step = freq/480
+    wave_addr = (addr + 2) * 2
+    for x=0,239 do
+      v = ampl * (peek4(wave_addr + a) - 7)
+      pix(x, v/16 + chan*24 + 16, chan+4)
+      a = (a + step) % 32
+    end
+  end
+end
+''',
+
+    'firescope': '''function firescope()
+  -- the flames rise a row each frame, every byte (pair of pixels) being replaced by
+  -- the faded byte below it
+  local fade = fire_fade
+  for a=0,11519 do
+    poke(a, fade[peek(a+120)])
+  end
+  for chan=0,3 do
+    addr = 0xff9c+chan*18
+    a=0
+    b1 = peek(addr)
+    b2 = peek(addr+1)
+    freq = b1 | ((b2 & 0x0f) << 8)
+    ampl = b2 >> 4
+    step = freq/480
+    wave_addr = (addr + 2) * 2
+    for x=0,119 do
+      v = ampl * (peek4(wave_addr + a) - 7)
+      pix(x + 120*(chan%2), v/16 + (chan//2)*48 + 32, 12)
+      a = (a + step) % 32
+    end
+  end
+  -- clear scroller area
+  rect(0,96,240,135,0)
+end
+''',
+
+    'circularscope': '''function circularscope()
+  for chan=0,3 do
+    addr = 0xff9c+chan*18
+    a=0
+    b1 = peek(addr)
+    b2 = peek(addr+1)
+    freq = b1 | ((b2 & 0x0f) << 8)
+    ampl = b2 >> 4
+    step = freq/480
+    wave_addr = (addr + 2) * 2
+    for x=0,239 do
+      -- half the wave's value, as the bands use
+      waves[chan][x] = ampl * (peek4(wave_addr + a) - 7) / 256
+      a = (a + step) % 32
+    end
+  end
+
+  -- each entry of the maps gives the colours of four pixels, one in each quadrant;
+  -- entries are taken in horizontal pairs, so that the pixels are written a byte
+  -- (with colour 8 added to both nibbles) at a time
+  local t0 = time()/1000
+  local angles, radii = circle_angle, circle_radius
+  for y=0,47 do
+    local below, above, i = (48+y)*120, (47-y)*120, y*120
+    for j=0,59 do
+      local z, band = angles[i], radii[i] - t0
+      local w = waves[(band+0.5)%4//1]
+      local z2, band2 = angles[i+1], radii[i+1] - t0
+      local w2 = waves[(band2+0.5)%4//1]
+      poke(below+60+j, (band+w[120+z])%4//1 + (band2+w2[120+z2])%4//1*16 + 136)
+      poke(below+59-j, (band2+w2[119-z2])%4//1 + (band+w[119-z])%4//1*16 + 136)
+      poke(above+60+j, (band+w[238-z])%4//1 + (band2+w2[238-z2])%4//1*16 + 136)
+      poke(above+59-j, (band2+w2[1+z2])%4//1 + (band+w[1+z])%4//1*16 + 136)
+      i = i + 2
+    end
+  end
+  -- clear scroller area
+  rect(0,96,240,135,0)
+end
+''',
+
+    'zoomscope': '''function zoomscope()
+  -- zoom the picture in towards the centre, row by row and a run of bytes at a time
+  -- (see zoom_rows and zoom_runs)
+  local runs = zoom_runs
+  for i=1,#zoom_rows,2 do
+    local dest, src = zoom_rows[i], zoom_rows[i+1]
+    if src < 0 then
+      memset(dest, 0, 120)
+    else
+      for j=1,#runs,3 do
+        if runs[j+1] < 0 then
+          memset(dest + runs[j], 0, runs[j+2])
+        else
+          memcpy(dest + runs[j], src + runs[j+1], runs[j+2])
+        end
+      end
+    end
+  end
+  for chan=0,3 do
+    addr = 0xff9c+chan*18
+    a=0
+    b1 = peek(addr)
+    b2 = peek(addr+1)
+    freq = b1 | ((b2 & 0x0f) << 8)
+    ampl = b2 >> 4
+    step = freq/480
+    wave_addr = (addr + 2) * 2
+    rot = time() / 2000 + math.pi * chan / 2
+    local c, s = math.cos(rot), math.sin(rot)
+    for i=0,239 do
+      x = i - 120
+      y = ampl * (peek4(wave_addr + a) - 7) / 8 + 32
+      pix(120 + x*c + y*s, 48 + y*c - x*s, ampl)
+      a = (a + step) % 32
+    end
+  end
+  -- clear scroller area
+  rect(0,96,240,135,0)
+end
+''',
+}
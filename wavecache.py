@@ -0,0 +1,94 @@
+import hashlib
+import os
+import tempfile
+
+from analysisparams import analysis_key, DEFAULT_PARAMS
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ticmodplayer')
+
+
+class WavetableCache:
+    # On-disk cache of converted wavetables, stored as packed frame tables and keyed by
+    # a hash of the sample bytes, base frequency and analysis parameters. The least
+    # recently used entries are evicted once the cache grows beyond max_size bytes.
+    def __init__(self, path=None, max_size=64 * 1024 * 1024):
+        self.path = path or default_cache_dir()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, data, samplerate, params=DEFAULT_PARAMS):
+        h = hashlib.sha256()
+        h.update(analysis_key(params=params).encode('ascii'))
+        h.update(b'\0%r\0' % samplerate)
+        h.update(data)
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.frames')
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # mark as recently used
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        self.hits += 1
+        # wavetable needs numpy, which builds that find nothing to convert don't load
+        from wavetable import FrameTable
+        return FrameTable.from_packed(data)
+
+    def put(self, key, table):
+        # write to a temporary file and rename, so concurrent builds never see a partial entry
+        fd, tmp_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(table.packed_data())
+        os.replace(tmp_filename, self.filename(key))
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.frames'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        return sum(size for (mtime, size, filename) in self.entries())
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for (mtime, size, filename) in entries)
+        for (mtime, size, filename) in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for (mtime, size, filename) in self.entries():
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def report(self):
+        return "Wavetable cache: %d hits, %d misses (%s)" % (self.hits, self.misses, self.path)
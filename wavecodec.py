@@ -0,0 +1,206 @@
+import numpy as np
+
+from wavetable import FrameTable
+
+
+WAVE_SIZE = 16  # bytes per packed 32-nibble wave
+FRAME_REF_SIZE = 4  # bytes per frame that refers to a wave by index
+
+
+class WaveDictionary:
+    # Stores each distinct packed wave once, with a hash index from wave bytes to position
+    def __init__(self):
+        self.index = {}
+        self.waves = []
+
+    def add(self, packed_waves):
+        # returns the dictionary index of each row of packed_waves, adding any new ones
+        indices = np.empty(len(packed_waves), dtype=np.uint16)
+        for (i, wave) in enumerate(packed_waves):
+            key = wave.tobytes()
+            try:
+                indices[i] = self.index[key]
+            except KeyError:
+                indices[i] = self.index[key] = len(self.waves)
+                self.waves.append(key)
+        return indices
+
+    def __len__(self):
+        return len(self.waves)
+
+    def packed_data(self):
+        return b''.join(self.waves)
+
+
+def encode_frame_refs(table, wave_indices):
+    # 4 bytes per frame: frequency low byte, amplitude/frequency high nibble (as in the
+    # full frame layout), then the wave index as a little-endian 16-bit value
+    records = np.empty((len(table), FRAME_REF_SIZE), dtype=np.uint8)
+    records[:, 0:2] = table.packed_headers()
+    records[:, 2] = wave_indices & 0xff
+    records[:, 3] = wave_indices >> 8
+    return records
+
+
+def nearest_codes(points, codebook, chunk_size=4096):
+    # index of the nearest codebook row to each point (squared euclidean distance)
+    codebook_norms = (codebook * codebook).sum(axis=1)
+    labels = np.empty(len(points), dtype=np.intp)
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        distances = codebook_norms - 2 * (chunk @ codebook.T)
+        labels[start:start + chunk_size] = distances.argmin(axis=1)
+    return labels
+
+
+def cluster_waves(waves, weights, size, iterations=10):
+    # Weighted k-means over rows of nibbles, starting from the most used waves.
+    # Returns a codebook of at most `size` integer waves and each wave's code.
+    points = waves.astype(np.float32)
+    weights = np.asarray(weights, dtype=np.float32)
+    codebook = points[np.argsort(-weights, kind='stable')[:size]]
+    for i in range(iterations):
+        labels = nearest_codes(points, codebook)
+        totals = np.bincount(labels, weights, minlength=len(codebook))
+        sums = np.zeros_like(codebook)
+        np.add.at(sums, labels, points * weights[:, None])
+        used = totals > 0
+        codebook[used] = sums[used] / totals[used, None]
+    codebook = np.unique(np.clip(np.round(codebook), 0, 15), axis=0)
+    labels = nearest_codes(points, codebook)
+    return codebook.astype(np.uint8), labels
+
+
+def quantise_wavetables(tables, max_waves):
+    # Replace the waves of all frames in `tables` by at most max_waves distinct waves,
+    # returning new tables and the RMS error in nibbles over all frames. All-zero waves
+    # are kept exactly, since TIC-80 plays them as noise.
+    all_waves = np.concatenate([table.waves for table in tables])
+    distinct, inverse, counts = np.unique(all_waves, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    if len(distinct) <= max_waves:
+        return tables, 0.0
+
+    silent = ~distinct.any(axis=1)
+    if max_waves < 1 + int(silent.any()):
+        raise ValueError("Cannot quantise waves to %d entries" % max_waves)
+    codebook, labels = cluster_waves(distinct[~silent], counts[~silent], max_waves - int(silent.any()))
+    mapped = distinct.copy()
+    mapped[~silent] = codebook[labels]
+    new_waves = mapped[inverse]
+    error = float(np.sqrt(np.mean((new_waves.astype(float) - all_waves) ** 2)))
+
+    quantised = []
+    start = 0
+    for table in tables:
+        end = start + len(table)
+        quantised.append(FrameTable(table.frequencies, table.amplitudes, new_waves[start:end]))
+        start = end
+    return quantised, error
+
+
+# The 'keyframe' layout stores each sample's frames as runs of up to KEYFRAME_RUN_LENGTH
+# frames, each starting with a byte of the run's kind | (frames - 1):
+# - NEW_WAVE: the index of a wave in the dictionary (as a little-endian 16-bit value),
+#   then the frequency/amplitude bytes of each frame, which all play that wave
+# - SAME_WAVE: the frequency/amplitude bytes of each frame, playing the wave before
+# - HOLD: nothing more; the frames play the same registers as the one before
+# Each sample, and its repeat, starts with a NEW_WAVE run.
+KEYFRAME_RUN_LENGTH = 64
+NEW_WAVE = 0x00
+SAME_WAVE = 0x40
+HOLD = 0x80
+
+
+def keyframe_waves(table, threshold=0.0, keys=()):
+    # The frames of table, with the wave of each replaced by that of the keyframe before
+    # it. A frame becomes a keyframe when the waves since the last keyframe have drifted
+    # by more than threshold (RMS nibbles, summed frame to frame, so that no frame ends
+    # up further than that from its own wave), when it starts or ends a silent (all-zero)
+    # wave, which TIC-80 plays as noise, and when it is in keys. Returns the new table and
+    # the keyframe indices.
+    if len(table) == 0:
+        return table, np.zeros(0, dtype=np.intp)
+    waves = table.waves
+    steps = np.sqrt(np.mean(np.diff(waves.astype(np.float32), axis=0) ** 2, axis=1))
+    drift = np.concatenate([[0], np.cumsum(steps)])
+    silent = ~waves.any(axis=1)
+    forced = np.zeros(len(table), dtype=bool)
+    forced[0] = True
+    forced[1:] = silent[1:] != silent[:-1]
+    forced[[key for key in keys if 0 <= key < len(table)]] = True
+    forced = np.flatnonzero(forced)
+
+    keyframes = [0]
+    while True:
+        drifted = np.searchsorted(drift, drift[keyframes[-1]] + threshold, side='right')
+        next_forced = forced[np.searchsorted(forced, keyframes[-1], side='right'):][:1]
+        following = min(drifted, next_forced[0]) if len(next_forced) else drifted
+        if following >= len(table):
+            break
+        keyframes.append(following)
+    keyframes = np.array(keyframes)
+    key_of_frame = np.repeat(keyframes, np.diff(np.append(keyframes, len(table))))
+    return FrameTable(table.frequencies, table.amplitudes, waves[key_of_frame]), keyframes
+
+
+def encode_keyframes(table, wave_indices, keys=()):
+    # The runs storing the frames of table, given the dictionary index of each frame's
+    # wave, with a NEW_WAVE run starting at the first frame and at each of keys. Returns
+    # the run bytes and the offset within them at which each frame's bytes start.
+    frame_count = len(table)
+    frames = np.arange(frame_count)
+    headers = table.packed_headers()
+    new_wave = np.ones(frame_count, dtype=bool)
+    new_wave[1:] = wave_indices[1:] != wave_indices[:-1]
+    new_wave[[key for key in keys if 0 <= key < frame_count]] = True
+    hold = np.zeros(frame_count, dtype=bool)
+    hold[1:] = ~new_wave[1:] & (headers[1:] == headers[:-1]).all(axis=1)
+
+    # runs start at new waves and where holding starts or stops, and are split into
+    # runs of up to KEYFRAME_RUN_LENGTH frames
+    starts = new_wave.copy()
+    starts[1:] |= hold[1:] != hold[:-1]
+    run_start = np.maximum.accumulate(np.where(starts, frames, 0))
+    starts |= (frames - run_start) % KEYFRAME_RUN_LENGTH == 0
+    run_lengths = np.diff(np.append(np.flatnonzero(starts), frame_count))
+    kinds = np.where(hold, HOLD, np.where(new_wave, NEW_WAVE, SAME_WAVE))
+
+    # every byte a frame could have, and which of them it does
+    frame_bytes = np.zeros((frame_count, 5), dtype=np.uint8)
+    frame_bytes[starts, 0] = kinds[starts] | (run_lengths - 1)
+    frame_bytes[:, 1] = wave_indices & 0xff
+    frame_bytes[:, 2] = wave_indices >> 8
+    frame_bytes[:, 3:5] = headers
+    stored = np.empty(frame_bytes.shape, dtype=bool)
+    stored[:, 0] = starts
+    stored[:, 1:3] = (starts & new_wave)[:, np.newaxis]
+    stored[:, 3:5] = ~hold[:, np.newaxis]
+    offsets = np.concatenate([[0], np.cumsum(stored.sum(axis=1))[:-1]]).astype(np.intp)
+    return frame_bytes[stored].tobytes(), offsets
+
+
+def decode_keyframes(data, waves):
+    # (frames, 2) frequency/amplitude bytes and (frames, 16) packed waves of every frame
+    # stored in runs in data, given the (waves, 16) wave dictionary
+    headers = []
+    wave_indices = []
+    header = (0, 0)
+    wave_index = 0
+    addr = 0
+    while addr < len(data):
+        run = data[addr]
+        addr += 1
+        if run & HOLD == 0 and run & SAME_WAVE == 0:
+            wave_index = data[addr] | (data[addr + 1] << 8)
+            addr += 2
+        for i in range((run & (KEYFRAME_RUN_LENGTH - 1)) + 1):
+            if run & HOLD == 0:
+                header = (data[addr], data[addr + 1])
+                addr += 2
+            headers.append(header)
+            wave_indices.append(wave_index)
+    return (
+        np.array(headers, dtype=np.uint8).reshape(-1, 2),
+        waves[np.array(wave_indices, dtype=np.intp)].reshape(-1, WAVE_SIZE),
+    )
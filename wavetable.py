@@ -1,20 +1,23 @@
 #! /usr/bin/env python
 
 import numpy as np
-from scipy.interpolate import interp1d
-from io import BytesIO
+from numpy.lib.stride_tricks import sliding_window_view
+from functools import lru_cache
+
+from analysisparams import DEFAULT_PARAMS, FRAME_RATE
+from profiling import profiler
 
 
 # filename = "1.wav"
 # samplerate = 22168  # frequency for F-3
 
 
-def get_period(block, window_size):
+def get_period_loop(block, window_size, start_offset=10):
     orig = np.asarray(block[0:window_size])
     results = []
     best_diff = 999999
     best_offset = None
-    for offset in range(10, len(block) - window_size, 1):
+    for offset in range(start_offset, len(block) - window_size, 1):
         shifted_wave = np.asarray(block[offset:window_size+offset])
         diffs = abs(orig - shifted_wave)
         diff = np.add.reduce(diffs)
@@ -28,8 +31,46 @@ def get_period(block, window_size):
     # print("best %f, avg %f, confidence %f" % (best_diff, avg_diff, confidence))
     return best_offset, confidence
 
+
+def lag_scores(block, window_size, start_offset=10):
+    # sum of absolute differences (AMDF) between the leading window and the window
+    # at every candidate lag, computed as one pass over a strided view of the block
+    block = np.asarray(block)
+    lag_count = len(block) - window_size - start_offset
+    if lag_count <= 0:
+        return np.empty(0)
+    windows = sliding_window_view(block[start_offset:len(block) - 1], window_size)
+    return np.add.reduce(abs(block[0:window_size] - windows), axis=1)
+
+
+def best_lag(scores, start_offset=10):
+    if len(scores) == 0:
+        return None, np.nan
+    best = scores.argmin()
+    confidence = np.mean(scores) / scores[best]
+    return int(best) + start_offset, confidence
+
+
+def get_period_amdf(block, window_size, start_offset=10):
+    return best_lag(lag_scores(block, window_size, start_offset), start_offset)
+
+
+PERIOD_BACKENDS = {
+    'loop': get_period_loop,
+    'amdf': get_period_amdf,
+}
+
+
+def get_period(block, window_size, backend='amdf', start_offset=10):
+    try:
+        fn = PERIOD_BACKENDS[backend]
+    except KeyError:
+        raise ValueError("Unknown period detection backend: %r" % backend)
+    return fn(block, window_size, start_offset)
+
+
 def get_single_wave(block, period):
-    slice = np.asarray(block[0:period])
+    slice = np.asarray(block[0:period], dtype=float)
     if slice.max() < 0 or slice.min() > 0:
         return slice
     i = slice.argmax()
@@ -38,6 +79,47 @@ def get_single_wave(block, period):
     return np.concatenate((slice[i+1:], slice[0:i+1]))
 
 
+@lru_cache(maxsize=256)
+def resample_matrix(period, length=32):
+    # Weights that evaluate the not-a-knot cubic spline through `period` evenly spaced
+    # points (as scipy's interp1d 'cubic' would) at `length` evenly spaced points,
+    # so that resampling becomes a single matrix product.
+    h = 1 / (period - 1)
+    # second derivatives m of the spline satisfy a @ m == b @ y
+    a = np.zeros((period, period))
+    b = np.zeros((period, period))
+    for i in range(1, period - 1):
+        a[i, i-1:i+2] = (1, 4, 1)
+        b[i, i-1:i+2] = np.array((1, -2, 1)) * 6 / (h * h)
+    a[0, 0:3] = (1, -2, 1)
+    a[-1, -3:] = (1, -2, 1)
+    second_derivs = np.linalg.solve(a, b)
+
+    x = np.linspace(0, 1, length)
+    k = np.minimum((x * (period - 1)).astype(int), period - 2)
+    left = (np.linspace(0, 1, period)[k + 1] - x) / h
+    right = 1 - left
+    identity = np.eye(period)
+    weights = (
+        left[:, None] * identity[k] + right[:, None] * identity[k + 1]
+        + (h * h / 6) * (
+            (left ** 3 - left)[:, None] * second_derivs[k]
+            + (right ** 3 - right)[:, None] * second_derivs[k + 1]
+        )
+    )
+    weights.flags.writeable = False
+    return weights
+
+
+def resample(waves, length=32):
+    # resample a single wave, or a batch of waves sharing a period (one per row). einsum
+    # sums each output in the same order whatever the number of rows, unlike a matrix
+    # product, which can round differently for a batch than for a single wave and so
+    # tip a nibble that lands on a .5 tie
+    waves = np.ascontiguousarray(waves, dtype=float)
+    return np.einsum('...j,kj->...k', waves, resample_matrix(waves.shape[-1], length))
+
+
 class Frame:
     def __init__(self, frequency, amplitude, wave):
         self.frequency = frequency
@@ -45,18 +127,100 @@ class Frame:
         self.wave = wave
 
     def packed_data(self):
-        data_buffer = BytesIO()
-        data_buffer.write(bytes([self.frequency & 255, (self.amplitude << 4) | (self.frequency >> 8)]))
-        for i in range(0, 32, 2):
-            data_buffer.write(bytes([
-                self.wave[i] | (self.wave[i + 1] << 4)
-            ]))
-        return data_buffer.getvalue()
+        return bytes(FrameTable.from_frames([self]).packed_data())
 
     def __repr__(self):
         return "<Frame: %f Hz, ampl %d, %r>" % (self.frequency, self.amplitude, self.wave)
 
 
+FRAME_SIZE = 18  # bytes per frame in the TIC-80 sound register layout
+
+
+class FrameTable:
+    # Columnar store of frames: a frequency and amplitude per frame, plus a
+    # 32-wide matrix of wave nibbles. Indexing yields Frame objects.
+    def __init__(self, frequencies, amplitudes, waves):
+        self.frequencies = np.asarray(frequencies, dtype=np.uint16)
+        self.amplitudes = np.asarray(amplitudes, dtype=np.uint8)
+        self.waves = np.asarray(waves, dtype=np.uint8).reshape(-1, 32)
+
+    @staticmethod
+    def empty():
+        return FrameTable([], [], [])
+
+    @staticmethod
+    def from_frames(frames):
+        return FrameTable(
+            [frame.frequency for frame in frames],
+            [frame.amplitude for frame in frames],
+            [frame.wave for frame in frames],
+        )
+
+    @staticmethod
+    def from_packed(data):
+        packed = np.frombuffer(data, dtype=np.uint8).reshape(-1, FRAME_SIZE)
+        waves = np.empty((len(packed), 32), dtype=np.uint8)
+        waves[:, 0::2] = packed[:, 2:] & 0x0f
+        waves[:, 1::2] = packed[:, 2:] >> 4
+        return FrameTable(
+            packed[:, 0] | ((packed[:, 1].astype(np.uint16) & 0x0f) << 8),
+            packed[:, 1] >> 4,
+            waves,
+        )
+
+    @staticmethod
+    def concatenate(tables):
+        tables = list(tables)
+        if not tables:
+            return FrameTable.empty()
+        return FrameTable(
+            np.concatenate([table.frequencies for table in tables]),
+            np.concatenate([table.amplitudes for table in tables]),
+            np.concatenate([table.waves for table in tables]),
+        )
+
+    def packed(self):
+        # (frames, 18) array: frequency low byte, amplitude/frequency high nibble,
+        # then 16 bytes of wave nibbles
+        packed = np.empty((len(self), FRAME_SIZE), dtype=np.uint8)
+        packed[:, 0:2] = self.packed_headers()
+        packed[:, 2:] = self.packed_waves()
+        return packed
+
+    def packed_headers(self):
+        # (frames, 2) array of frequency and amplitude register bytes
+        headers = np.empty((len(self), 2), dtype=np.uint8)
+        headers[:, 0] = self.frequencies & 255
+        headers[:, 1] = (self.amplitudes << 4) | (self.frequencies >> 8)
+        return headers
+
+    def packed_waves(self):
+        # (frames, 16) array of wave bytes, low nibble first
+        return self.waves[:, 0::2] | (self.waves[:, 1::2] << 4)
+
+    def packed_data(self):
+        # flattened first, as memoryview can't cast an empty 2-D array
+        return memoryview(self.packed().reshape(-1)).cast('B')
+
+    def __len__(self):
+        return len(self.frequencies)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return FrameTable(self.frequencies[index], self.amplitudes[index], self.waves[index])
+        return Frame(
+            int(self.frequencies[index]), int(self.amplitudes[index]),
+            tuple(int(v) for v in self.waves[index])
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return "<FrameTable: %d frames>" % len(self)
+
+
 def iter_blocks(mono_wave, block_step, block_size):
     i = 0
     while True:
@@ -66,39 +230,174 @@ def iter_blocks(mono_wave, block_step, block_size):
             break
 
 
-def make_frame(block, samplerate):
-    period, confidence = get_period(block, int(len(block) / 2))
-    if confidence < 1.3:
-        period = int(samplerate / 220)
+def make_frame(block, samplerate, backend='amdf', params=DEFAULT_PARAMS):
+    period, confidence = get_period(block, int(len(block) / 2), backend, params.start_offset)
+    profiler().count('blocks_analysed')
+    if confidence < params.confidence_threshold:
+        profiler().count('low_confidence')
+        period = max(1, int(samplerate / params.fallback_freq))
     freq = samplerate / period
-    single_wave = get_single_wave(block, period)
+    # normalised in doubles, as analyse_wave does; resample then rounds the same way for both
+    single_wave = get_single_wave(block, period).astype(float)
     amplitude = abs(single_wave).max()
     norm_single_wave = single_wave / amplitude
-    x_axis = np.linspace(0, 1, period)
-    fn = interp1d(x_axis, norm_single_wave, 'cubic')
 
     final_ampl = min(int(amplitude*16), 15)
     if final_ampl == 0:
         final_wave = tuple([0]*32)
-    elif confidence < 1.3:
+    elif confidence < params.confidence_threshold:
         final_wave = tuple([0]*32)
-        final_ampl = int(amplitude * 11)
+        final_ampl = int(amplitude * params.noise_amplitude)
     else:
+        profiler().count('interp_calls')
+        profiler().count('waves_resampled')
         final_wave = tuple(
-            round(max(-0.999999, min(0.999999, fn(i))) * 7 + 8)
-            for i in np.linspace(0, 1, 32)
+            int(v) for v in np.round(np.clip(resample(norm_single_wave), -0.999999, 0.999999) * 7 + 8)
         )
 
     return Frame(round(freq), final_ampl, final_wave)
 
 
-def make_wavetable(mono_wave, samplerate):
+def get_single_waves(slices):
+    # batched get_single_wave over the rows of an (n, period) array
+    period = slices.shape[1]
+    rows = np.arange(len(slices))[:, None]
+    peaks = slices.argmax(axis=1)
+    # walk backwards from each peak to the nearest non-positive sample
+    backwards = (peaks[:, None] - np.arange(period)) % period
+    steps = (slices[rows, backwards] <= 0).argmax(axis=1)
+    starts = (peaks - steps + 1) % period
+    one_signed = (slices.max(axis=1) < 0) | (slices.min(axis=1) > 0)
+    starts[one_signed] = 0
+    return slices[rows, (starts[:, None] + np.arange(period)) % period]
+
+
+def block_starts(sample_length, block_step):
+    # offsets of the blocks yielded by iter_blocks
+    block_count = max(1, int(sample_length // block_step))
+    return (np.arange(block_count) * block_step).astype(int)
+
+
+class BlockLagScores:
+    # AMDF scores of every lag from first_lag upwards for each complete block of a sample,
+    # along with the strided view of those blocks. These depend only on the sample, its
+    # rate and the frame rate, so they can be shared between analyses with other settings.
+    def __init__(self, mono_wave, samplerate, frame_rate=FRAME_RATE, first_lag=1):
+        mono_wave = np.asarray(mono_wave)
+        if not np.issubdtype(mono_wave.dtype, np.floating):
+            mono_wave = mono_wave.astype(float)
+        self.mono_wave = mono_wave
+        self.samplerate = samplerate
+        self.frame_rate = frame_rate
+        self.first_lag = first_lag
+        self.block_step = block_step = samplerate // frame_rate  # hop size
+        self.block_size = block_size = int(block_step*2)
+        window_size = int(block_size / 2)
+        self.starts = starts = block_starts(len(mono_wave), block_step)
+        self.full_count = full_count = np.count_nonzero(starts + block_size <= len(mono_wave))
+
+        if not full_count:
+            self.blocks = np.empty((0, block_size))
+        elif block_step == int(block_step):
+            # strided view over the sample; no copies
+            self.blocks = sliding_window_view(mono_wave, block_size)[::int(block_step)][:full_count]
+        else:
+            self.blocks = sliding_window_view(mono_wave, block_size)[starts[:full_count]]
+
+        blocks = self.blocks
+        self.scores = np.empty((full_count, max(0, block_size - window_size - first_lag)))
+        for j in range(self.scores.shape[1]):
+            lag = j + first_lag
+            self.scores[:, j] = np.add.reduce(
+                abs(blocks[:, 0:window_size] - blocks[:, lag:lag + window_size]), axis=1
+            )
+
+
+# Batched equivalent of running make_frame over every block from iter_blocks.
+# Returns arrays of frequencies, amplitudes and 32-nibble waves, one row per frame.
+# Precomputed BlockLagScores for the sample may be passed in as lag_scores.
+def analyse_wave(mono_wave, samplerate, backend='amdf', params=DEFAULT_PARAMS, lag_scores=None):
+    prof = profiler()
+    if lag_scores is None:
+        with prof.stage('lag_scores'):
+            lag_scores = BlockLagScores(mono_wave, samplerate, params.frame_rate, params.start_offset)
+    mono_wave = lag_scores.mono_wave
+    block_size = lag_scores.block_size
+    starts = lag_scores.starts
+    full_count = lag_scores.full_count
+    blocks = lag_scores.blocks
+
+    frame_count = len(starts)
+    freqs = np.zeros(frame_count, dtype=int)
+    amplitudes = np.zeros(frame_count, dtype=int)
+    waves = np.zeros((frame_count, 32), dtype=np.uint8)
+
+    if full_count:
+        prof.count('blocks_analysed', full_count)
+        start_offset = params.start_offset
+        scores = lag_scores.scores[:, start_offset - lag_scores.first_lag:]
+        periods = scores.argmin(axis=1) + start_offset
+        best_diffs = scores[np.arange(full_count), periods - start_offset]
+        confidences = np.mean(scores, axis=1) / best_diffs
+        noisy = confidences < params.confidence_threshold
+        periods[noisy] = max(1, int(samplerate / params.fallback_freq))
+        prof.count('low_confidence', np.count_nonzero(noisy))
+
+        freqs[:full_count] = np.round(samplerate / periods)
+        for period in np.unique(periods):
+            rows = np.flatnonzero(periods == period)
+            # float32 samples give exact AMDF sums; the waves are normalised in doubles, as
+            # in make_frame, which handles the blocks after these
+            single_waves = get_single_waves(blocks[rows, 0:period].astype(float))
+            amplitude = abs(single_waves).max(axis=1)
+            final_ampl = np.minimum((amplitude*16).astype(int), 15)
+            noise_rows = noisy[rows] & (final_ampl > 0)
+            final_ampl[noise_rows] = (amplitude[noise_rows] * params.noise_amplitude).astype(int)
+            amplitudes[rows] = final_ampl
+
+            tonal = (final_ampl > 0) & ~noise_rows
+            if tonal.any():
+                norm_single_waves = single_waves[tonal] / amplitude[tonal, None]
+                with prof.stage('interpolation'):
+                    resampled = resample(norm_single_waves)
+                prof.count('interp_calls')
+                prof.count('waves_resampled', len(norm_single_waves))
+                waves[rows[tonal]] = np.round(np.clip(resampled, -0.999999, 0.999999) * 7 + 8)
+
+    # blocks running off the end of the sample are shorter, so take them one at a time
+    for i in range(full_count, frame_count):
+        frame = make_frame(mono_wave[starts[i]:starts[i] + block_size], samplerate, backend, params)
+        freqs[i] = frame.frequency
+        amplitudes[i] = frame.amplitude
+        waves[i] = frame.wave
+
+    return freqs, amplitudes, waves
+
+
+def decode_sample(data):
+    # signed 8-bit sample bytes to float32 values in [-1, 1), exactly (each is a multiple of 1/128)
+    mono_wave = np.frombuffer(data, dtype=np.int8).astype(np.float32)
+    mono_wave *= 1 / 128
+    return mono_wave
+
+
+def convert_sample(data, samplerate, params=DEFAULT_PARAMS):
+    with profiler().stage('decode'):
+        mono_wave = decode_sample(data)
+    with profiler().stage('analyse'):
+        return make_wavetable(mono_wave, samplerate, params=params)
+
+
+def make_wavetable(mono_wave, samplerate, backend='amdf', batch=True, params=DEFAULT_PARAMS):
+    if batch and backend == 'amdf':
+        return FrameTable(*analyse_wave(mono_wave, samplerate, backend, params))
+
     seen_waves = set()
     frames = []
-    block_step = samplerate // 60  # hop size
+    block_step = samplerate // params.frame_rate  # hop size
 
     for block in iter_blocks(mono_wave, block_step, int(block_step*2)):
-        frame = make_frame(block, samplerate)
+        frame = make_frame(block, samplerate, backend, params)
         #if frame.wave in seen_waves:
         #    print("seen wave: %r" % (frame.wave, ))
         seen_waves.add(frame.wave)
@@ -107,4 +406,4 @@ def make_wavetable(mono_wave, samplerate):
         # print("{%d, %d, {%s}}," % (round(freq), final_ampl, ", ".join([str(v) for v in final_wave])))
         frames.append(frame)
 
-    return frames
+    return FrameTable.from_frames(frames)